@@ -11,14 +11,25 @@ from psycogreen.gevent import patch_psycopg # pylint: disable=import-error
 patch_psycopg()
 
 import django
+from flask import jsonify # pylint: disable=import-error
 from zconnect.messages import get_listener
 from zconnect.util.profiling.stats_server import get_flask_server
 
 django.setup(set_prefix=False)
 
+from django_demo.ingest import get_ingest_pipeline
+
+ingest_pipeline = get_ingest_pipeline()
+ingest_pipeline.start()
+
 listener = get_listener()
 listener.start()
 
 # different wsgi things use different names
 app = application = get_flask_server()
 
+
+@app.route("/ingest")
+def ingest_stats():
+    """Queue depth, wait time and overflow counters for the ingest pipeline"""
+    return jsonify(ingest_pipeline.stats())
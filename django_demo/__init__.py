@@ -5,6 +5,8 @@ from .celery import app as celery_app
 
 __version__ = "0.7.4"
 
+default_app_config = "django_demo.apps.DjangoDemoConfig"
+
 
 __all__ = [
     "celery_app",
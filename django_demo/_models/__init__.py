@@ -1,5 +1,7 @@
 from .device import DemoDevice
+from .rollup import SensorRollup
 
 __all__ = [
     "DemoDevice",
+    "SensorRollup",
 ]
@@ -1,8 +1,11 @@
 import logging
+import numbers
 
+from django.conf import settings
 from django.db import models
 
 from zconnect.models import AbstractDevice
+from zconnect.zc_timeseries.models import TimeSeriesData
 
 logger = logging.getLogger(__name__)
 
@@ -26,5 +29,60 @@ class DemoDevice(AbstractDevice):
     sim_number = models.CharField(max_length=25, blank=True)
 
     class Meta:
-        ordering = ["product"]
+        # id makes the ordering stable, and matches the index used for keyset
+        # pagination
+        ordering = ["product", "id"]
+        indexes = [
+            models.Index(fields=["product", "id"], name="demodevice_product_id_idx"),
+        ]
         default_permissions = ["view", "change", "add", "delete"]
+
+    def optimised_data_fetch(self, data_start, data_end, resolution):
+        """Readings for each of the device's sensors, for zconnect's
+        timeseries and chart endpoints
+
+        zconnect aggregates these with ZCONNECT_TS_AGGREGATION_ENGINE, which
+        loads every reading in the window. This uses django_demo.aggregation
+        instead - rollups where there are some, otherwise
+        DEMO_TS_AGGREGATION["engine"] - unless DEMO_TS_AGGREGATION["device_data"]
+        is False. As in zconnect, sensors which record at the requested
+        resolution or coarser return their readings as they are.
+
+        Args:
+            data_start (datetime): start of the window
+            data_end (datetime): end of the window
+            resolution (float): bucket size in seconds
+
+        Returns:
+            dict: sensor name to a list of TimeSeriesData, oldest first.
+                Aggregated buckets aren't saved.
+        """
+        if not getattr(settings, "DEMO_TS_AGGREGATION", {}).get("device_data", True):
+            return super().optimised_data_fetch(data_start, data_end, resolution)
+
+        # Imported here as aggregation imports the models
+        from ..aggregation import aggregate
+        from ..util.timestamps import from_unix
+
+        if isinstance(data_start, numbers.Number):
+            data_start = from_unix(data_start)
+        if isinstance(data_end, numbers.Number):
+            data_end = from_unix(data_end)
+
+        sensors = list(self.sensors.select_related("sensor_type"))
+        aggregated = [s for s in sensors if resolution > s.resolution]
+        buckets = aggregate(aggregated, data_start, data_end, int(resolution)) if aggregated else {}
+
+        result = {}
+        for sensor in sensors:
+            if sensor.pk in buckets:
+                result[sensor.sensor_type.sensor_name] = [
+                    TimeSeriesData(sensor=sensor, ts=bucket["ts"], value=bucket["value"])
+                    for bucket in buckets[sensor.pk]
+                ]
+            else:
+                result[sensor.sensor_type.sensor_name] = list(
+                    TimeSeriesData.objects.filter(sensor=sensor, ts__gte=data_start, ts__lt=data_end).order_by("ts")
+                )
+
+        return result
@@ -0,0 +1,39 @@
+from django.db import models
+
+
+class SensorRollup(models.Model):
+    """Aggregated readings for one bucket of a device sensor
+
+    Kept up to date as readings are ingested, see django_demo.rollups.
+
+    Attributes:
+        sensor (DeviceSensor): sensor the readings are for
+        resolution (int): bucket size in seconds
+        bucket (datetime): start of the bucket, a multiple of resolution
+            since the epoch
+        count (int): number of readings
+        sum (float): sum of the values
+        min (float): smallest value
+        max (float): largest value
+        last (float): value of the latest reading
+        last_ts (datetime): time of the latest reading
+    """
+
+    sensor = models.ForeignKey(
+        "zc_timeseries.DeviceSensor",
+        models.CASCADE,
+        related_name="rollups",
+    )
+    resolution = models.IntegerField()
+    bucket = models.DateTimeField()
+
+    count = models.IntegerField()
+    sum = models.FloatField()
+    min = models.FloatField()
+    max = models.FloatField()
+    last = models.FloatField()
+    last_ts = models.DateTimeField()
+
+    class Meta:
+        # Also the index used to read a range of buckets for a sensor
+        unique_together = [("sensor", "resolution", "bucket")]
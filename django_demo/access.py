@@ -0,0 +1,182 @@
+"""Resolve which devices a user can see with a single queryset filter
+
+A user can see a device if:
+
+- they are a superuser
+- they are a member of one of the device's orgs (what the rules backend checks)
+- they, or one of their groups, has been given ``view_demodevice`` on that
+  device with guardian
+
+and can change a device they can see if they have the ``change_demodevice``
+model permission, or have been given it on that device with guardian.
+
+Rather than checking each device against the authentication backends, the
+user's org ids are resolved once per request (and cached in redis between
+requests) and the guardian grants are folded into the same query as
+subqueries, so filtering a list of devices is one query no matter how many
+devices there are.
+
+The cached org ids are removed whenever the user's org memberships change
+(see django_demo.handlers).
+"""
+import json
+import logging
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import IntegerField, Q
+from django.db.models.functions import Cast
+from guardian.models import GroupObjectPermission, UserObjectPermission
+from organizations.models import OrganizationUser
+from redis.exceptions import RedisError
+
+from .models import DemoDevice
+from .util import redis_util
+
+logger = logging.getLogger(__name__)
+
+ORGS_KEY_PREFIX = "demo_user_orgs"
+ORGS_TTL = 60 * 60
+
+# Attribute on the request used to memoise access for the request
+_REQUEST_ATTR = "_demo_device_access"
+
+
+def orgs_key(user_id):
+    return "{}:{}".format(ORGS_KEY_PREFIX, user_id)
+
+
+def _load_org_ids(user):
+    try:
+        cached = redis_util.get_redis().get(orgs_key(user.pk))
+    except RedisError:
+        logger.exception("Unable to load orgs for user %s from cache", user.pk)
+        cached = None
+
+    if cached is not None:
+        return set(json.loads(cached.decode("utf8") if isinstance(cached, bytes) else cached))
+
+    org_ids = list(OrganizationUser.objects.filter(user_id=user.pk).values_list("organization_id", flat=True))
+
+    try:
+        redis_util.get_redis().setex(orgs_key(user.pk), ORGS_TTL, json.dumps(org_ids))
+    except RedisError:
+        logger.exception("Unable to cache orgs for user %s", user.pk)
+
+    return set(org_ids)
+
+
+def invalidate_user_orgs(user_ids):
+    """Forget cached org memberships for these users"""
+    user_ids = [i for i in set(user_ids) if i is not None]
+    if not user_ids:
+        return
+
+    try:
+        redis_util.get_redis().delete(*[orgs_key(i) for i in user_ids])
+    except RedisError:
+        logger.exception("Unable to invalidate cached orgs for users %s", user_ids)
+
+
+class DeviceAccess:
+    """What devices a user can see and change
+
+    Attributes:
+        user (User): the user
+        org_ids (set(int)): orgs the user is a member of
+    """
+
+    view_codename = "view_{}".format(DemoDevice._meta.model_name)
+    change_codename = "change_{}".format(DemoDevice._meta.model_name)
+
+    def __init__(self, user):
+        self.user = user
+        self.is_superuser = bool(getattr(user, "is_superuser", False))
+
+        if not user or not user.is_authenticated:
+            self.org_ids = set()
+        elif self.is_superuser:
+            # Not needed
+            self.org_ids = None
+        else:
+            self.org_ids = _load_org_ids(user)
+
+    def granted_q(self, codename=None):
+        """Devices which the user has been given a permission on (by default
+        view_demodevice) with guardian"""
+        content_type = ContentType.objects.get_for_model(DemoDevice)
+        codename = codename or self.view_codename
+
+        user_grants = UserObjectPermission.objects.filter(
+            user_id=self.user.pk,
+            content_type=content_type,
+            permission__codename=codename,
+        ).annotate(device_id=Cast("object_pk", IntegerField())).values("device_id")
+
+        group_grants = GroupObjectPermission.objects.filter(
+            group__user=self.user.pk,
+            content_type=content_type,
+            permission__codename=codename,
+        ).annotate(device_id=Cast("object_pk", IntegerField())).values("device_id")
+
+        return Q(pk__in=user_grants) | Q(pk__in=group_grants)
+
+    def filter(self, queryset):
+        """Filter a device queryset down to what the user can see"""
+        if self.is_superuser:
+            return queryset
+
+        if not self.user or not self.user.is_authenticated:
+            return queryset.none()
+
+        # Use a subquery for the orgs rather than a join, so that devices in
+        # more than one of the user's orgs don't need a DISTINCT
+        in_orgs = Q(pk__in=DemoDevice.objects.filter(orgs__in=self.org_ids).values("pk"))
+
+        return queryset.filter(in_orgs | self.granted_q())
+
+    def filter_changeable(self, queryset):
+        """Filter a device queryset down to what the user can change
+
+        Being able to see a device (eg, as a member of one of its orgs) isn't
+        enough - the user needs change_demodevice, either for all devices or
+        on the device itself.
+        """
+        queryset = self.filter(queryset)
+
+        if self.is_superuser or not self.user or not self.user.is_authenticated:
+            return queryset
+
+        if self.user.has_perm("{}.{}".format(DemoDevice._meta.app_label, self.change_codename)):
+            return queryset
+
+        return queryset.filter(self.granted_q(self.change_codename))
+
+    def can_add(self):
+        """Whether the user can create devices"""
+        if self.is_superuser:
+            return True
+        if not self.user or not self.user.is_authenticated:
+            return False
+        return self.user.has_perm("{}.add_{}".format(DemoDevice._meta.app_label, DemoDevice._meta.model_name))
+
+
+def get_access(request):
+    """Get DeviceAccess for the user making the request
+
+    This is only resolved once per request.
+
+    Args:
+        request (Request): DRF or django request
+
+    Returns:
+        DeviceAccess: access for request.user
+    """
+    # Store it on the underlying django request so DRF and django views share it
+    django_request = getattr(request, "_request", request)
+
+    access = getattr(django_request, _REQUEST_ATTR, None)
+    if access is None or access.user is not request.user:
+        access = DeviceAccess(request.user)
+        setattr(django_request, _REQUEST_ATTR, access)
+
+    return access
@@ -0,0 +1,86 @@
+"""Aggregation of sensor readings into time buckets
+
+Engines are chosen with DEMO_TS_AGGREGATION["engine"]:
+
+- ``numpy``: load the whole window and aggregate in memory
+- ``numpy_chunked``: stream the window and aggregate one bucket at a time,
+  with bounded memory
+- ``sql``: aggregate in the database, on SQLite or PostgreSQL (the default)
+
+The numpy engines give exactly the same results, and the sql engine matches
+them to floating point precision.
+
+Unless an engine is asked for, aggregations at a resolution rollups are kept
+for (15 minutes and 6 hours by default) are read from the rollups instead,
+except for sensors which haven't got rollups for the window yet - see
+:mod:`.rollup_engine`.
+
+This is used by devices/{id}/aggregated/ and, in place of zconnect's
+ZCONNECT_TS_AGGREGATION_ENGINE, for zconnect's timeseries and chart endpoints
+(see DemoDevice.optimised_data_fetch).
+"""
+from django.conf import settings
+
+from .numpy_engine import ChunkedNumpyEngine, NumpyEngine
+from .reductions import REDUCTIONS, get_reduction
+from .rollup_engine import RollupEngine
+from .sql_engine import SqlEngine, TimeBucket
+
+__all__ = [
+    "ChunkedNumpyEngine",
+    "NumpyEngine",
+    "REDUCTIONS",
+    "RollupEngine",
+    "SqlEngine",
+    "TimeBucket",
+    "aggregate",
+    "get_engine",
+    "get_reduction",
+]
+
+
+def get_engine(name=None):
+    """Get an aggregation engine by name, or the configured one"""
+    options = getattr(settings, "DEMO_TS_AGGREGATION", {})
+    name = name or options.get("engine", "sql")
+
+    if name == "numpy":
+        return NumpyEngine()
+    if name == "numpy_chunked":
+        return ChunkedNumpyEngine(chunk_size=options.get("chunk_size", 5000))
+    if name == "sql":
+        return SqlEngine(fallback=ChunkedNumpyEngine(chunk_size=options.get("chunk_size", 5000)))
+
+    raise ValueError("Unknown aggregation engine {}".format(name))
+
+
+def aggregate(device_sensors, start, end, resolution, engine=None):
+    """Aggregate readings for some device sensors
+
+    Each sensor is aggregated with its sensor type's aggregation_type.
+
+    Args:
+        device_sensors (list(DeviceSensor)): sensors, with sensor_type loaded
+        start (datetime): start of the window (inclusive)
+        end (datetime): end of the window (exclusive)
+        resolution (int): bucket size in seconds
+        engine (str, optional): engine name, instead of the configured one.
+            If this is given rollups are not used.
+
+    Returns:
+        dict: sensor id to a list of {"ts", "value"}, oldest first
+    """
+    sensors = {s.pk: s.sensor_type.aggregation_type for s in device_sensors}
+    result = {}
+
+    rollup_engine = RollupEngine()
+    if engine is None and rollup_engine.can_aggregate(start, end, resolution):
+        supported = rollup_engine.supported(sensors)
+        if supported:
+            result.update(rollup_engine.aggregate(supported, start, end, resolution))
+
+    remaining = {pk: t for pk, t in sensors.items() if pk not in result}
+    if remaining:
+        result.update(get_engine(engine).aggregate(remaining, start, end, resolution))
+
+    return result
@@ -0,0 +1,115 @@
+"""Bucketed aggregation of readings in python with numpy
+
+``NumpyEngine`` loads every reading in the window into arrays and then
+aggregates each bucket. Its memory use grows with the size of the window, so
+a 30 day window across many sensors can need hundreds of MB.
+
+``ChunkedNumpyEngine`` gives exactly the same results, but streams the
+readings from the database in (sensor, time) order in chunks of
+``chunk_size`` rows - through a server-side cursor on PostgreSQL - and only
+keeps the values of the bucket it is currently in. When the bucket changes,
+the same numpy reduction is applied to the collected values, so results are
+identical to NumpyEngine's. Peak memory is one chunk of rows plus the values
+of a single bucket.
+"""
+import numpy as np
+
+from zconnect.zc_timeseries.models import TimeSeriesData
+
+from ..util.timestamps import from_unix, to_unix
+from .reductions import get_reduction, reduce_bucket
+
+
+def _readings(sensor_ids, start, end):
+    # pk breaks ties between readings at the same time, so every engine
+    # reduces the values of a bucket in the same order
+    return TimeSeriesData.objects.filter(
+        sensor_id__in=sensor_ids,
+        ts__gte=start,
+        ts__lt=end,
+    ).order_by("sensor_id", "ts", "pk").values_list("sensor_id", "ts", "value")
+
+
+class NumpyEngine:
+    """Load the whole window into numpy arrays and aggregate it"""
+
+    def aggregate(self, sensors, start, end, resolution):
+        """Aggregate readings into buckets of ``resolution`` seconds
+
+        Buckets are aligned to multiples of the resolution since the epoch, and
+        buckets without any readings are left out.
+
+        Args:
+            sensors (dict): DeviceSensor id to aggregation_type
+            start (datetime): start of the window (inclusive)
+            end (datetime): end of the window (exclusive)
+            resolution (int): bucket size in seconds
+
+        Returns:
+            dict: sensor id to a list of {"ts", "value"}, oldest first
+        """
+        rows = list(_readings(list(sensors), start, end))
+        result = {sensor_id: [] for sensor_id in sensors}
+        if not rows:
+            return result
+
+        sensor_ids = np.array([r[0] for r in rows])
+        buckets = np.floor_divide(np.array([to_unix(r[1]) for r in rows]), resolution) * resolution
+        values = np.array([r[2] for r in rows], dtype=np.float64)
+
+        for sensor_id, aggregation_type in sensors.items():
+            reduction = get_reduction(aggregation_type)
+            mask = sensor_ids == sensor_id
+            sensor_buckets = buckets[mask]
+            sensor_values = values[mask]
+
+            for bucket in np.unique(sensor_buckets):
+                result[sensor_id].append({
+                    "ts": from_unix(bucket),
+                    "value": reduce_bucket(reduction, sensor_values[sensor_buckets == bucket]),
+                })
+
+        return result
+
+
+class ChunkedNumpyEngine:
+    """Stream readings and aggregate one bucket at a time
+
+    Args:
+        chunk_size (int): rows fetched from the database at a time
+    """
+
+    def __init__(self, chunk_size=5000):
+        self.chunk_size = chunk_size
+
+    def aggregate(self, sensors, start, end, resolution):
+        """Same as NumpyEngine.aggregate"""
+        result = {sensor_id: [] for sensor_id in sensors}
+        reductions = {sensor_id: get_reduction(t) for sensor_id, t in sensors.items()}
+
+        current = None
+        collected = []
+
+        def finish():
+            sensor_id, bucket = current
+            result[sensor_id].append({
+                "ts": from_unix(bucket),
+                "value": reduce_bucket(reductions[sensor_id], collected),
+            })
+
+        rows = _readings(list(sensors), start, end).iterator(chunk_size=self.chunk_size)
+        for sensor_id, ts, value in rows:
+            key = (sensor_id, (to_unix(ts) // resolution) * resolution)
+
+            if key != current:
+                if current is not None:
+                    finish()
+                current = key
+                collected = []
+
+            collected.append(value)
+
+        if current is not None:
+            finish()
+
+        return result
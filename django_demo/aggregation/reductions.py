@@ -0,0 +1,35 @@
+"""Reductions used to aggregate the readings in a time bucket
+
+Every engine applies these same functions to the values in a bucket (in time
+order), so that they all give exactly the same results.
+"""
+import numpy as np
+
+REDUCTIONS = {
+    "mean": np.mean,
+    "sum": np.sum,
+    "median": np.median,
+    "min": np.min,
+    "max": np.max,
+    "count": np.size,
+}
+
+# Used for sensor types without an aggregation_type
+DEFAULT_AGGREGATION = "mean"
+
+
+def get_reduction(aggregation_type):
+    """Look up the reduction for a SensorType.aggregation_type
+
+    Raises:
+        ValueError: if it isn't a known aggregation
+    """
+    try:
+        return REDUCTIONS[aggregation_type or DEFAULT_AGGREGATION]
+    except KeyError:
+        raise ValueError("Unknown aggregation type {}".format(aggregation_type))
+
+
+def reduce_bucket(reduction, values):
+    """Apply a reduction to a list of values, as float64"""
+    return float(reduction(np.asarray(values, dtype=np.float64)))
@@ -0,0 +1,80 @@
+"""Read aggregated readings from SensorRollup
+
+Rollups are kept for the resolutions in DEMO_ROLLUPS (see
+django_demo.rollups), with the count, sum, min, max and latest value of each
+bucket. For those resolutions, windows aligned to the resolution and sensors
+aggregated by anything except median are read directly from the rollups
+instead of aggregating the raw readings.
+
+Readings stored before rollups were kept have no rollups until
+rebuild_rollups is run. Sensors which have no rollups in a window, but do
+have readings in it, are left out of the result so that the caller falls
+back to aggregating their raw readings.
+"""
+from zconnect.zc_timeseries.models import TimeSeriesData
+
+from ..models import SensorRollup
+from ..rollups import get_resolutions
+from ..util.timestamps import to_unix
+from .reductions import DEFAULT_AGGREGATION
+
+ROLLUP_VALUES = {
+    "mean": lambda r: r.sum / r.count,
+    "sum": lambda r: r.sum,
+    "min": lambda r: r.min,
+    "max": lambda r: r.max,
+    "count": lambda r: float(r.count),
+}
+
+
+class RollupEngine:
+    """Aggregate readings using rollups where possible"""
+
+    def can_aggregate(self, start, end, resolution):
+        """Whether rollups cover exactly the buckets in a window"""
+        return (
+            resolution in get_resolutions() and
+            to_unix(start) % resolution == 0 and
+            to_unix(end) % resolution == 0
+        )
+
+    def supported(self, sensors):
+        """The sensors whose aggregation type can be read from rollups"""
+        return {
+            sensor_id: aggregation_type for sensor_id, aggregation_type in sensors.items()
+            if (aggregation_type or DEFAULT_AGGREGATION) in ROLLUP_VALUES
+        }
+
+    def aggregate(self, sensors, start, end, resolution):
+        """Same as NumpyEngine.aggregate, but only for windows where
+        can_aggregate is true and sensors which are supported
+
+        Sensors with readings but no rollups in the window are left out.
+        """
+        result = {sensor_id: [] for sensor_id in sensors}
+
+        rollups = SensorRollup.objects.filter(
+            sensor_id__in=list(sensors),
+            resolution=resolution,
+            bucket__gte=start,
+            bucket__lt=end,
+        ).order_by("sensor_id", "bucket").only(
+            "sensor_id", "bucket", "count", "sum", "min", "max",
+        )
+
+        for rollup in rollups:
+            value = ROLLUP_VALUES[sensors[rollup.sensor_id] or DEFAULT_AGGREGATION]
+            result[rollup.sensor_id].append({"ts": rollup.bucket, "value": value(rollup)})
+
+        empty = [sensor_id for sensor_id, buckets in result.items() if not buckets]
+        if empty:
+            not_rolled_up = TimeSeriesData.objects.filter(
+                sensor_id__in=empty,
+                ts__gte=start,
+                ts__lt=end,
+            ).order_by().values_list("sensor_id", flat=True).distinct()
+
+            for sensor_id in not_rolled_up:
+                del result[sensor_id]
+
+        return result
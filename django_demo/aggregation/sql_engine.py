@@ -0,0 +1,129 @@
+"""Bucketed aggregation of readings in the database
+
+Readings are grouped by sensor and bucket with one GROUP BY query per
+aggregation type, so only one row per bucket comes back from the database.
+Buckets are worked out with a dialect-specific expression (see
+:class:`TimeBucket`), matching the epoch-aligned buckets of the numpy
+engines.
+
+SQLite has no median aggregate, so sensors aggregated by median are handed
+to ChunkedNumpyEngine there. Averages and sums are calculated by the
+database, so they can differ from numpy in the last few bits.
+"""
+from django.db import NotSupportedError, connection
+from django.db.models import Aggregate, Avg, Count, FloatField, Func, Max, Min, Sum
+
+from zconnect.zc_timeseries.models import TimeSeriesData
+
+from ..util.timestamps import from_unix
+from .numpy_engine import ChunkedNumpyEngine
+from .reductions import DEFAULT_AGGREGATION, get_reduction
+
+
+class TimeBucket(Func):
+    """Start of the ``resolution`` second bucket a timestamp is in, as a unix
+    time
+
+    Args:
+        expression: timestamp column
+        resolution (int): bucket size in seconds
+    """
+
+    output_field = FloatField()
+
+    def __init__(self, expression, resolution, **extra):
+        super().__init__(expression, resolution=int(resolution), **extra)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        raise NotSupportedError("Time buckets aren't supported on {}".format(connection.vendor))
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # strftime('%s') is whole seconds since the epoch. The %s is escaped
+        # twice - once for this template and once for the query parameters.
+        template = "(CAST(strftime('%%%%s', %(expressions)s) AS INTEGER) / %(resolution)d) * %(resolution)d"
+        return super().as_sql(compiler, connection, template=template, **extra_context)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        template = "FLOOR(EXTRACT(EPOCH FROM %(expressions)s) / %(resolution)d) * %(resolution)d"
+        return super().as_sql(compiler, connection, template=template, **extra_context)
+
+
+class Median(Aggregate):
+    """Interpolated median, the same as numpy.median (PostgreSQL only)"""
+
+    function = "PERCENTILE_CONT"
+    template = "%(function)s(0.5) WITHIN GROUP (ORDER BY %(expressions)s)"
+    output_field = FloatField()
+
+    def as_sql(self, compiler, connection, **extra_context):
+        raise NotSupportedError("Median isn't supported on {}".format(connection.vendor))
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, **extra_context)
+
+
+SQL_AGGREGATES = {
+    "mean": Avg,
+    "sum": Sum,
+    "median": Median,
+    "min": Min,
+    "max": Max,
+    "count": Count,
+}
+
+# Aggregates the database can calculate, by connection vendor. Other
+# aggregation types fall back to ChunkedNumpyEngine.
+SUPPORTED = {
+    "sqlite": {"mean", "sum", "min", "max", "count"},
+    "postgresql": set(SQL_AGGREGATES),
+}
+
+
+class SqlEngine:
+    """Aggregate in the database
+
+    Args:
+        fallback: engine used for aggregation types the database doesn't
+            support
+    """
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback or ChunkedNumpyEngine()
+
+    def aggregate(self, sensors, start, end, resolution):
+        """Same as NumpyEngine.aggregate"""
+        result = {sensor_id: [] for sensor_id in sensors}
+        supported = SUPPORTED.get(connection.vendor, set())
+
+        by_type = {}
+        for sensor_id, aggregation_type in sensors.items():
+            # Raises for unknown types, like the other engines
+            get_reduction(aggregation_type)
+            by_type.setdefault(aggregation_type or DEFAULT_AGGREGATION, []).append(sensor_id)
+
+        unsupported = {}
+        for aggregation_type, sensor_ids in by_type.items():
+            if aggregation_type not in supported:
+                unsupported.update({s: aggregation_type for s in sensor_ids})
+                continue
+
+            rows = TimeSeriesData.objects.filter(
+                sensor_id__in=sensor_ids,
+                ts__gte=start,
+                ts__lt=end,
+            ).annotate(
+                bucket=TimeBucket("ts", resolution),
+            ).values("sensor_id", "bucket").annotate(
+                aggregated=SQL_AGGREGATES[aggregation_type]("value"),
+            ).order_by("sensor_id", "bucket")
+
+            for row in rows:
+                result[row["sensor_id"]].append({
+                    "ts": from_unix(row["bucket"]),
+                    "value": float(row["aggregated"]),
+                })
+
+        if unsupported:
+            result.update(self.fallback.aggregate(unsupported, start, end, resolution))
+
+        return result
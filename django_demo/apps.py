@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class DjangoDemoConfig(AppConfig):
+    name = "django_demo"
+
+    def ready(self):
+        # Connect signal handlers
+        from . import handlers # noqa pylint: disable=unused-import
@@ -0,0 +1,189 @@
+"""JWT authentication with a cache of verified tokens
+
+Verifying an RS256 signature is one of the most expensive things done on
+every API request. Tokens are sent again and again by the same client until
+they expire, so the result of verification is kept in a bounded LRU keyed by a
+digest of the raw token. Entries are only used until the token expires.
+
+Optionally (``DEMO_JWT_AUTH["stateless_reads"]``), safe requests to views
+which opt in with ``stateless_auth_actions`` don't load the user from the
+database either - the user is built from the token claims instead, in the same
+way as ``JWTTokenUserAuthentication``. This is only valid for views which only
+need the user's id and superuser status (see django_demo.access). Those are
+added to tokens when they are created (see create_token) - tokens without
+them still load the user.
+
+The stateless user is never checked against the database, so ``is_active`` is
+not checked either: a user who is deactivated (or whose superuser status is
+removed) can still read through these views until their token expires. Only
+turn this on if tokens are short lived enough for that to be acceptable.
+Anything which isn't a safe request to one of those views still loads the
+user as normal.
+"""
+from collections import OrderedDict
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.models import TokenUser
+
+from zconnect.serializers import jwt_create_token
+
+logger = logging.getLogger(__name__)
+
+
+class VerifiedTokenCache:
+    """Bounded LRU of verified tokens, which expire with the token
+
+    Safe to use from multiple threads/greenlets.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._tokens = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(raw_token):
+        if isinstance(raw_token, str):
+            raw_token = raw_token.encode("utf8")
+        return hashlib.sha256(raw_token).digest()
+
+    def get(self, raw_token):
+        key = self.digest(raw_token)
+
+        with self._lock:
+            try:
+                validated_token, expires = self._tokens[key]
+            except KeyError:
+                return None
+
+            if expires <= time.time():
+                del self._tokens[key]
+                return None
+
+            self._tokens.move_to_end(key)
+            return validated_token
+
+    def set(self, raw_token, validated_token):
+        expires = validated_token.payload.get("exp")
+        if expires is None:
+            # Don't cache anything that never expires
+            return
+
+        key = self.digest(raw_token)
+
+        with self._lock:
+            self._tokens[key] = (validated_token, expires)
+            self._tokens.move_to_end(key)
+
+            while len(self._tokens) > self.max_size:
+                self._tokens.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+    def __len__(self):
+        return len(self._tokens)
+
+
+# Claims added to tokens when they are created, for StatelessUser
+USER_CLAIMS = ("is_superuser", "is_staff")
+
+
+def create_token(token_model, user, serializer):
+    """Create a token on login, with the claims StatelessUser needs
+
+    This is REST_AUTH_TOKEN_CREATOR, and otherwise does the same as zconnect's
+    """
+    token = jwt_create_token(token_model, user, serializer)
+    for claim in USER_CLAIMS:
+        token[claim] = bool(getattr(user, claim))
+    return token
+
+
+def get_auth_settings():
+    return getattr(settings, "DEMO_JWT_AUTH", {})
+
+
+_token_cache = VerifiedTokenCache(get_auth_settings().get("cache_size", 10000))
+
+
+class StatelessUser(TokenUser):
+    """User built only from token claims
+
+    Unlike TokenUser this reads is_staff/is_superuser from the token if they
+    are present. Superusers have all permissions and everyone else has none,
+    so model permission checks only pass for superusers (or when no
+    permissions are needed, as for safe requests with DjangoModelPermissions).
+    Access to devices is worked out by django_demo.access instead.
+
+    Note that is_active is always True - see the module docstring.
+    """
+
+    @property
+    def is_staff(self):
+        return bool(self.token.get("is_staff", False))
+
+    @property
+    def is_superuser(self):
+        return bool(self.token.get("is_superuser", False))
+
+    def has_perm(self, perm, obj=None):
+        return self.is_superuser
+
+    def has_perms(self, perm_list, obj=None):
+        return all(self.has_perm(perm, obj) for perm in perm_list)
+
+    def has_module_perms(self, module):
+        return self.is_superuser
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication which caches verified tokens"""
+
+    token_cache = _token_cache
+
+    def get_validated_token(self, raw_token):
+        validated_token = self.token_cache.get(raw_token)
+        if validated_token is None:
+            validated_token = super().get_validated_token(raw_token)
+            self.token_cache.set(raw_token, validated_token)
+
+        return validated_token
+
+    def use_stateless_user(self, request, validated_token):
+        if not get_auth_settings().get("stateless_reads", False):
+            return False
+
+        if any(claim not in validated_token.payload for claim in USER_CLAIMS):
+            # Created before the claims were added - a superuser would be
+            # treated as a normal user
+            return False
+
+        if request.method not in SAFE_METHODS:
+            return False
+
+        view = getattr(request, "parser_context", {}).get("view")
+        return getattr(view, "action", None) in getattr(view, "stateless_auth_actions", ())
+
+    def authenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        validated_token = self.get_validated_token(raw_token)
+
+        if self.use_stateless_user(request, validated_token):
+            return StatelessUser(validated_token), validated_token
+
+        return self.get_user(validated_token), validated_token
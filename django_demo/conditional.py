@@ -0,0 +1,206 @@
+"""Conditional GET support (ETag / Last-Modified) for viewsets
+
+Validators are computed from the ``updated_at`` of each object and, for
+devices, a per-device 'state version' kept in redis which is bumped whenever
+something not reflected in ``updated_at`` changes (new sensor readings, org
+membership). This means a request with a matching ``If-None-Match`` or
+``If-Modified-Since`` can be answered with a 304 after one cheap query for the
+ids and timestamps, without running the serializer.
+
+Lists only get an ETag. Which objects are in a list can change without any of
+them being modified (eg, a device is deleted or the user joins an org), which
+the ETag covers but a Last-Modified can't.
+
+If the device states can't be loaded from redis no validators are sent, so
+clients always get a full response.
+"""
+import calendar
+import hashlib
+import json
+import logging
+import time
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from redis.exceptions import RedisError
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .util import redis_util
+
+logger = logging.getLogger(__name__)
+
+STATE_KEY_PREFIX = "demo_device_state"
+
+
+def state_key(device_id):
+    return "{}:{}".format(STATE_KEY_PREFIX, device_id)
+
+
+def bump_device_states(device_ids, changed_at=None):
+    """Mark that something about these devices has changed
+
+    Args:
+        device_ids (iterable(int)): device ids
+        changed_at (float, optional): unix timestamp of the change. Defaults
+            to now.
+    """
+    device_ids = [i for i in set(device_ids) if i is not None]
+    if not device_ids:
+        return
+
+    changed_at = int(changed_at or time.time())
+
+    try:
+        pipe = redis_util.get_redis().pipeline(transaction=False)
+        for device_id in device_ids:
+            pipe.hincrby(state_key(device_id), "version", 1)
+            pipe.hset(state_key(device_id), "changed_at", changed_at)
+        pipe.execute()
+    except RedisError:
+        logger.exception("Unable to update state for devices %s", device_ids)
+
+
+def get_device_states(device_ids):
+    """Get the state version and last change time for these devices
+
+    Args:
+        device_ids (list(int)): device ids
+
+    Returns:
+        dict: device id to (version, changed_at) for devices which have a
+            recorded state, or None if the states couldn't be loaded
+    """
+    if not device_ids:
+        return {}
+
+    try:
+        pipe = redis_util.get_redis().pipeline(transaction=False)
+        for device_id in device_ids:
+            pipe.hmget(state_key(device_id), "version", "changed_at")
+        results = pipe.execute()
+    except RedisError:
+        logger.exception("Unable to load state for devices %s", device_ids)
+        return None
+
+    return {
+        device_id: (int(version), int(changed_at))
+        for device_id, (version, changed_at) in zip(device_ids, results)
+        if version is not None
+    }
+
+
+def _timestamp(dt):
+    # Naive datetimes are in UTC (TIME_ZONE = "UTC")
+    return calendar.timegm(dt.utctimetuple())
+
+
+class ConditionalGetMixin:
+    """Add ETag and Last-Modified to list and retrieve, and return 304s
+
+    Views can override:
+
+    - ``get_object_states`` to add extra version information per object
+    - ``serialize_many`` to control how objects are turned into response data
+      (for example if ``get_queryset`` only loads the fields needed for the
+      validators)
+    """
+
+    def get_object_states(self, pks):
+        """Extra state for each object, which is not captured by updated_at
+
+        Returns:
+            dict: pk to (version, changed_at), or None if it isn't known - in
+                which case no validators are sent
+        """
+        return {}
+
+    def serialize_many(self, objects):
+        return self.get_serializer(objects, many=True).data
+
+    def get_validators(self, objects, envelope=None):
+        """Compute ETag and Last-Modified for some objects
+
+        Args:
+            objects (list): objects from get_queryset
+            envelope (dict, optional): any other data in the response which
+                might change independently of the objects (eg, pagination
+                counts and links)
+
+        Returns:
+            tuple(str, int): quoted etag and last modified unix timestamp, or
+                (None, None) if they can't be worked out
+        """
+        states = self.get_object_states([o.pk for o in objects])
+        if states is None:
+            return None, None
+
+        digest = hashlib.sha1()
+        # Anything in the query string (eg, a sparse fieldset) can change the
+        # response
+        digest.update(self.request.get_full_path().encode("utf8"))
+        if envelope is not None:
+            digest.update(json.dumps(envelope, cls=JSONEncoder, sort_keys=True).encode("utf8"))
+
+        last_modified = 0
+        for obj in objects:
+            version, changed_at = states.get(obj.pk, (0, 0))
+            # Full precision for the etag, Last-Modified only has seconds
+            digest.update("{}:{}:{};".format(obj.pk, obj.updated_at, version).encode("utf8"))
+            updated_at = _timestamp(obj.updated_at) if obj.updated_at else 0
+            last_modified = max(last_modified, updated_at, changed_at)
+
+        return quote_etag(digest.hexdigest()), last_modified or None
+
+    def conditional_response(self, objects, envelope, get_response, with_last_modified=True):
+        etag, last_modified = self.get_validators(objects, envelope)
+        if etag is None:
+            return get_response()
+
+        if not with_last_modified:
+            last_modified = None
+
+        response = get_conditional_response(
+            self.request,
+            etag=etag,
+            last_modified=last_modified,
+        )
+        if response is None:
+            response = get_response()
+
+        response["ETag"] = etag
+        if last_modified:
+            response["Last-Modified"] = http_date(last_modified)
+
+        return response
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            # pagination metadata without any results
+            envelope = self.get_paginated_response([]).data
+            return self.conditional_response(
+                page,
+                envelope,
+                lambda: self.get_paginated_response(self.serialize_many(page)),
+                with_last_modified=False,
+            )
+
+        objects = list(queryset)
+        return self.conditional_response(
+            objects,
+            None,
+            lambda: Response(self.serialize_many(objects)),
+            with_last_modified=False,
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+
+        return self.conditional_response(
+            [instance],
+            None,
+            lambda: Response(self.serialize_many([instance])[0]),
+        )
@@ -0,0 +1,170 @@
+"""Redis cache of serialized DemoDevice representations
+
+The output of DemoDeviceSerializer for each device is stored as JSON under a
+key made from the device id and a schema version. List and detail views fetch
+all the devices they need with one MGET and only go to the database for the
+ones which are missing.
+
+Entries are removed (see django_demo.handlers) whenever something that goes
+into the serialized representation changes:
+
+- the device is saved or deleted
+- the device's orgs change
+- a new sensor or sensor reading is stored for the device
+
+Each entry also records the device's state version (see
+django_demo.conditional) from before it was loaded, and is only used while
+that is still the current version. Invalidating a device bumps its version
+once the change has been committed, so a read which loaded the device just
+before a change can't put the old representation back in the cache for
+good. As invalidate bumps the version anyway, callers don't need to bump it
+themselves.
+
+Bump ``SCHEMA_VERSION`` whenever the serialized representation changes in a
+way that is not reflected in the serializer field names, so that old entries
+are ignored.
+"""
+import functools
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from redis.exceptions import RedisError
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import conditional
+from .util import redis_util
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 2
+
+KEY_PREFIX = "demo_device_repr"
+
+
+@functools.lru_cache()
+def _fields_digest():
+    # Imported here to avoid a circular import through the serializers
+    from .serializers import DemoDeviceSerializer
+    fields = ",".join(DemoDeviceSerializer.Meta.fields)
+    return hashlib.sha1(fields.encode("utf8")).hexdigest()[:8]
+
+
+def get_settings():
+    return getattr(settings, "DEMO_DEVICE_CACHE", {})
+
+
+def enabled():
+    return get_settings().get("enabled", False)
+
+
+def cache_key(device_id):
+    return "{}:v{}-{}:{}".format(KEY_PREFIX, SCHEMA_VERSION, _fields_digest(), device_id)
+
+
+def _versions(device_ids):
+    states = conditional.get_device_states(device_ids)
+    if states is None:
+        return None
+    return {i: states.get(i, (0, 0))[0] for i in device_ids}
+
+
+def get_many(device_ids, versions=None):
+    """Load cached representations for these devices
+
+    Args:
+        device_ids (list(int)): device ids
+        versions (dict, optional): filled in with the current state version
+            of each device, to pass to set_many for devices which weren't
+            cached
+
+    Returns:
+        dict: device id to serialized device, for the devices which were in
+            the cache at their current version. If redis is not available
+            this will be empty.
+    """
+    if not device_ids:
+        return {}
+
+    current = _versions(device_ids)
+    if current is None:
+        return {}
+    if versions is not None:
+        versions.update(current)
+
+    keys = [cache_key(i) for i in device_ids]
+
+    try:
+        values = redis_util.get_redis().mget(keys)
+    except RedisError:
+        logger.exception("Unable to load devices from cache")
+        return {}
+
+    found = {}
+    for device_id, value in zip(device_ids, values):
+        if value is None:
+            continue
+        entry = json.loads(value.decode("utf8") if isinstance(value, bytes) else value)
+        if entry["version"] == current[device_id]:
+            found[device_id] = entry["data"]
+
+    return found
+
+
+def set_many(representations, versions=None):
+    """Store serialized devices
+
+    Args:
+        representations (dict): device id to serialized device
+        versions (dict, optional): device id to the state version from
+            before the devices were loaded (see get_many). Defaults to the
+            current versions.
+    """
+    if not representations:
+        return
+
+    if versions is None:
+        versions = _versions(list(representations))
+        if versions is None:
+            return
+
+    ttl = get_settings().get("ttl", 3600)
+
+    try:
+        pipe = redis_util.get_redis().pipeline(transaction=False)
+        for device_id, data in representations.items():
+            entry = {"version": versions[device_id], "data": data}
+            pipe.setex(cache_key(device_id), ttl, json.dumps(entry, cls=JSONEncoder))
+        pipe.execute()
+    except RedisError:
+        logger.exception("Unable to store devices in cache")
+
+
+def invalidate(device_ids):
+    """Remove cached representations for these devices
+
+    This happens straight away, and again once the current transaction (if
+    any) commits. Their state versions are bumped at the same times, so an
+    entry stored by a read which started before the change is visible isn't
+    used.
+
+    Args:
+        device_ids (iterable(int)): device ids
+    """
+    device_ids = [i for i in set(device_ids) if i is not None]
+    if not device_ids:
+        return
+
+    def delete():
+        conditional.bump_device_states(device_ids)
+        try:
+            redis_util.get_redis().delete(*[cache_key(i) for i in device_ids])
+        except RedisError:
+            logger.exception("Unable to invalidate cached devices %s", device_ids)
+
+    delete()
+
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(delete)
@@ -0,0 +1,31 @@
+"""Event definitions evaluated against incoming readings
+
+Conditions are compiled once per product (see :mod:`.conditions` and
+:mod:`.engine`) and evaluated against each reading written by the ingest
+pipeline.
+
+Unscheduled definitions are only evaluated here, once for each batch of
+readings, by ``django_demo.ingest.write_readings``. This covers the listener
+(whose "periodic" handler, registered in django_demo.handlers, replaces
+zconnect's own periodic handler, so readings are not also evaluated by
+zconnect), the sharded listener's workers and simulate_fleet. Readings saved
+any other way (eg, ``TimeSeriesData.objects.create``) don't trigger events,
+as before.
+
+Scheduled definitions are never evaluated against readings - see
+:mod:`.schedule` and ``django_demo.tasks.trigger_scheduled_events``.
+"""
+from .actions import register_action
+from .conditions import ConditionSyntaxError, compile_condition, evaluate_condition
+from .engine import ProductEvaluator, device_products, evaluator_cache, process_readings
+
+__all__ = [
+    "ConditionSyntaxError",
+    "ProductEvaluator",
+    "compile_condition",
+    "device_products",
+    "evaluate_condition",
+    "evaluator_cache",
+    "process_readings",
+    "register_action",
+]
@@ -0,0 +1,96 @@
+"""Actions performed when an event fires
+
+``EventDefinition.actions`` maps an action name to its parameters, eg::
+
+    {
+        "activity": {
+            "verb": "reported",
+            "description": "Fridge door has been opened",
+            "severity": 20,
+            "category": "business metrics",
+            "notify": True
+        },
+    }
+
+Actions which are specific to the demo are handled by functions registered
+with ``register_action``. Anything else (including "activity") is handed to
+zconnect's action handlers, the same as when zconnect evaluates definitions
+itself, so those actions behave exactly as they do in zconnect - eg, "notify"
+sending notifications. An action which neither has a handler for is logged as
+an error each time the event fires.
+"""
+import logging
+
+from zconnect.registry import get_action_handlers
+
+logger = logging.getLogger(__name__)
+
+# action name: handler, for actions which aren't handled by zconnect
+ACTIONS = {}
+
+
+def register_action(name):
+    """Register a handler for an action name
+
+    The handler is called with the device, the event definition, the reading
+    which made it fire and the action's parameters as keyword arguments.
+    Handlers registered here are used instead of zconnect's for the same name.
+    """
+    def decorator(func):
+        ACTIONS[name] = func
+        return func
+    return decorator
+
+
+def _zconnect_context(device, definition, reading):
+    """Context passed to zconnect's action handlers"""
+    return {
+        "device": device,
+        "event_def": definition,
+        "ts_data": reading.values,
+        "timestamp": reading.timestamp,
+    }
+
+
+def _perform(name, params, device, definition, reading):
+    """Perform one action
+
+    Returns:
+        bool: whether there was a handler for it
+    """
+    handler = ACTIONS.get(name)
+    if handler is not None:
+        handler(device, definition, reading, **params)
+        return True
+
+    zconnect_handler = get_action_handlers().get(name)
+    if zconnect_handler is not None:
+        zconnect_handler(_zconnect_context(device, definition, reading), params)
+        return True
+
+    return False
+
+
+def perform_actions(device, definition, reading):
+    """Perform all the actions for an event which has fired
+
+    Errors in one action are logged and don't stop the others.
+
+    Returns:
+        list(str): names of the actions which were performed
+    """
+    performed = []
+
+    for name, params in (definition.actions or {}).items():
+        try:
+            handled = _perform(name, params or {}, device, definition, reading)
+        except Exception: # pylint: disable=broad-except
+            logger.exception("Error performing %s for event definition %s", name, definition.pk)
+            continue
+
+        if handled:
+            performed.append(name)
+        else:
+            logger.error("No handler for action %s in event definition %s - not performed", name, definition.pk)
+
+    return performed
@@ -0,0 +1,200 @@
+"""Compile event definition conditions into python functions
+
+Conditions are comparisons between sensor values and numbers, combined with
+``&&``, ``||`` and brackets, eg::
+
+    process_box_temp<4
+    property_door_opened==1
+    (process_box_temp>8||process_box_temp<2)&&property_door_opened==0
+
+Instead of parsing the condition every time it is evaluated it is compiled
+once into nested closures. Variables are looked up by position in a list of
+values (a 'slot'), so that when many conditions are evaluated together (see
+:mod:`.engine`) each sensor is only looked up in the message once, however
+many conditions use it.
+
+A comparison with a variable which isn't in the message is false.
+"""
+import operator
+import re
+
+COMPARISONS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+_TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<number>-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|-?\.\d+) |
+        (?P<name>[A-Za-z_][A-Za-z0-9_]*) |
+        (?P<op><=|>=|==|!=|<|>|&&|\|\||\(|\))
+    )""", re.VERBOSE)
+
+
+class ConditionSyntaxError(ValueError):
+    """Condition couldn't be parsed"""
+
+
+def tokenize(source):
+    """Split a condition into (kind, value) tokens"""
+    tokens = []
+    pos = 0
+    source = source.rstrip()
+
+    while pos < len(source):
+        match = _TOKEN_RE.match(source, pos)
+        if not match:
+            raise ConditionSyntaxError("Unexpected {!r} in condition {!r}".format(source[pos:], source))
+
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "number":
+            value = float(value)
+
+        tokens.append((kind, value))
+        pos = match.end()
+
+    return tokens
+
+
+class _Parser:
+    """Recursive descent parser producing closures over slot indexes"""
+
+    def __init__(self, source, slots):
+        self.source = source
+        self.tokens = tokenize(source)
+        self.pos = 0
+        self.slots = slots
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        if token[0] is None:
+            raise ConditionSyntaxError("Unexpected end of condition {!r}".format(self.source))
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise ConditionSyntaxError("Empty condition")
+
+        func = self.parse_or()
+
+        if self.pos != len(self.tokens):
+            raise ConditionSyntaxError("Unexpected {!r} in condition {!r}".format(self.peek()[1], self.source))
+
+        return func
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.peek() == ("op", "||"):
+            self.take()
+            terms.append(self.parse_and())
+
+        if len(terms) == 1:
+            return terms[0]
+        return lambda values: any(term(values) for term in terms)
+
+    def parse_and(self):
+        terms = [self.parse_unary()]
+        while self.peek() == ("op", "&&"):
+            self.take()
+            terms.append(self.parse_unary())
+
+        if len(terms) == 1:
+            return terms[0]
+        return lambda values: all(term(values) for term in terms)
+
+    def parse_unary(self):
+        if self.peek() == ("op", "("):
+            self.take()
+            func = self.parse_or()
+            if self.take() != ("op", ")"):
+                raise ConditionSyntaxError("Missing ) in condition {!r}".format(self.source))
+            return func
+
+        return self.parse_comparison()
+
+    def parse_operand(self):
+        kind, value = self.take()
+
+        if kind == "number":
+            return None, value
+        if kind == "name":
+            return self.slots.setdefault(value, len(self.slots)), None
+
+        raise ConditionSyntaxError("Expected a sensor name or number, got {!r} in {!r}".format(value, self.source))
+
+    def parse_comparison(self):
+        left_slot, left_value = self.parse_operand()
+
+        kind, op = self.take()
+        if kind != "op" or op not in COMPARISONS:
+            raise ConditionSyntaxError("Expected a comparison, got {!r} in {!r}".format(op, self.source))
+        compare = COMPARISONS[op]
+
+        right_slot, right_value = self.parse_operand()
+
+        # Specialise the common cases so evaluating doesn't need to check
+        # which side is a variable
+        if left_slot is not None and right_slot is None:
+            def comparison(values):
+                value = values[left_slot]
+                return value is not None and compare(value, right_value)
+        elif left_slot is None and right_slot is not None:
+            def comparison(values):
+                value = values[right_slot]
+                return value is not None and compare(left_value, value)
+        elif left_slot is not None:
+            def comparison(values):
+                left, right = values[left_slot], values[right_slot]
+                return left is not None and right is not None and compare(left, right)
+        else:
+            result = compare(left_value, right_value)
+
+            def comparison(values):
+                return result
+
+        return comparison
+
+
+def compile_condition(source, slots=None):
+    """Compile a condition
+
+    Args:
+        source (str): condition
+        slots (dict, optional): sensor name to position in the values list
+            passed to the compiled function. New names are added to the end.
+            Pass the same dict when compiling several conditions so they can
+            share one values list.
+
+    Returns:
+        tuple(callable, dict): function taking a list of values (None for a
+            missing sensor) and returning whether the condition holds, and
+            the slots it uses
+
+    Raises:
+        ConditionSyntaxError: if the condition is invalid
+    """
+    slots = {} if slots is None else slots
+    func = _Parser(source, slots).parse()
+    return func, slots
+
+
+def evaluate_condition(source, values):
+    """Compile and evaluate a condition against a dict of sensor values
+
+    Convenient for one-off evaluation - use :mod:`.engine` for anything
+    evaluated repeatedly.
+    """
+    func, slots = compile_condition(source)
+    ordered = [None] * len(slots)
+    for name, index in slots.items():
+        ordered[index] = values.get(name)
+    return func(ordered)
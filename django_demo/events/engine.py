@@ -0,0 +1,276 @@
+"""Evaluate event definitions against incoming readings
+
+Each product's enabled, unscheduled event definitions are compiled into one
+ProductEvaluator (see :mod:`.conditions`), which evaluates all of them against
+a reading in one pass, looking up each sensor in the reading once.
+
+Evaluators are cached per product in each process. Saving or deleting an
+EventDefinition bumps a version number for its product in redis, and the
+versions for all the products in a batch of readings are checked with one
+MGET, so every process (the listener, shard workers) recompiles a product's
+conditions the next time it sees a reading after they change.
+"""
+import logging
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+from zconnect.models import EventDefinition
+
+from ..models import DemoDevice
+from ..util import redis_util
+from ..util.timestamps import to_unix
+from .actions import perform_actions
+from .conditions import ConditionSyntaxError, compile_condition
+from .state import EventStateStore
+
+logger = logging.getLogger(__name__)
+
+
+def version_key(product_id):
+    return "demo_event_definitions_version:{}".format(product_id)
+
+
+class ProductEvaluator:
+    """All the event definitions for a product, compiled together
+
+    Args:
+        definitions (list(EventDefinition)): definitions. Any with an invalid
+            condition are logged and ignored.
+    """
+
+    def __init__(self, definitions):
+        slots = {}
+        self.compiled = []
+
+        for definition in definitions:
+            try:
+                func, _ = compile_condition(definition.condition, slots)
+            except ConditionSyntaxError as e:
+                logger.warning("Ignoring event definition %s: %s", definition.pk, e)
+                continue
+
+            self.compiled.append((definition, func))
+
+        # Sensor name for each slot, in slot order
+        self.names = sorted(slots, key=slots.get)
+
+    def __len__(self):
+        return len(self.compiled)
+
+    def evaluate(self, values):
+        """Evaluate every definition against some sensor values
+
+        Args:
+            values (dict): sensor name to value
+
+        Returns:
+            list(tuple(EventDefinition, bool)): each definition and whether its
+                condition holds
+        """
+        ordered = [values.get(name) for name in self.names]
+        return [(definition, func(ordered)) for definition, func in self.compiled]
+
+
+class EvaluatorCache:
+    """ProductEvaluators for each product, checked against redis versions"""
+
+    def __init__(self):
+        # product id: (version, evaluator)
+        self._evaluators = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._evaluators.clear()
+
+    def invalidate(self, product_id):
+        """Make every process reload the definitions for a product"""
+        with self._lock:
+            self._evaluators.pop(product_id, None)
+
+        try:
+            redis_util.get_redis().incr(version_key(product_id))
+        except RedisError:
+            logger.exception("Unable to invalidate event definitions for product %s", product_id)
+
+    def get_many(self, product_ids):
+        """Get evaluators for some products
+
+        Returns:
+            dict: product id to ProductEvaluator
+        """
+        product_ids = sorted(product_ids)
+        if not product_ids:
+            return {}
+
+        try:
+            raw = redis_util.get_redis().mget([version_key(pid) for pid in product_ids])
+            versions = dict(zip(product_ids, (int(v) if v is not None else 0 for v in raw)))
+        except RedisError:
+            logger.exception("Unable to check event definition versions - using cached definitions")
+            versions = None
+
+        with self._lock:
+            cached = dict(self._evaluators)
+
+        found = {}
+        stale = []
+        for pid in product_ids:
+            if pid in cached and (versions is None or cached[pid][0] == versions[pid]):
+                found[pid] = cached[pid][1]
+            else:
+                stale.append(pid)
+
+        if stale:
+            definitions = {pid: [] for pid in stale}
+            queryset = EventDefinition.objects.filter(product_id__in=stale, enabled=True, scheduled=False)
+            for definition in queryset.order_by("pk"):
+                definitions[definition.product_id].append(definition)
+
+            loaded = {pid: ProductEvaluator(defs) for pid, defs in definitions.items()}
+
+            with self._lock:
+                for pid, evaluator in loaded.items():
+                    self._evaluators[pid] = ((versions or {}).get(pid, 0), evaluator)
+
+            found.update(loaded)
+
+        return found
+
+
+class DeviceProductCache:
+    """Cache of device id to product id
+
+    A device's product can't be changed through the API, but it can be by
+    saving the device (eg, in the admin). Saving or deleting a device
+    invalidates it in the process which did it (see django_demo.handlers), and
+    entries expire after ``ttl`` seconds so that other processes pick up the
+    change as well.
+
+    Args:
+        ttl (float): seconds to keep an entry for
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        # device id: (product id, expires at)
+        self._products = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._products.clear()
+
+    def invalidate(self, device_ids):
+        with self._lock:
+            for device_id in device_ids:
+                self._products.pop(device_id, None)
+
+    def get_many(self, device_ids):
+        now = time.monotonic()
+
+        with self._lock:
+            found = {
+                d: self._products[d][0] for d in device_ids
+                if d in self._products and self._products[d][1] > now
+            }
+
+        missing = set(device_ids) - set(found)
+        if missing:
+            loaded = dict(DemoDevice.objects.filter(pk__in=missing).values_list("id", "product_id"))
+
+            with self._lock:
+                self._products.update({d: (p, now + self.ttl) for d, p in loaded.items()})
+
+            found.update(loaded)
+
+        return found
+
+
+evaluator_cache = EvaluatorCache()
+device_products = DeviceProductCache()
+
+
+def _decide(results, state, retries):
+    """Decide which events fire and save the new debounce state
+
+    Devices whose state was changed by another process in the meantime have
+    their state loaded again and are decided again, so only one of the
+    processes fires for an edge.
+
+    Args:
+        results (list(tuple)): (reading, definition, result) in time order
+        state (EventStateStore): loaded state
+        retries (int): times to decide again for conflicting devices
+
+    Returns:
+        list(tuple(Reading, EventDefinition)): events which fired
+    """
+    fired = []
+
+    for _ in range(retries + 1):
+        decided = [
+            (reading, definition) for reading, definition, result in results
+            if state.should_fire(reading.device_id, definition, result, to_unix(reading.timestamp))
+        ]
+
+        conflicts = state.save()
+        fired.extend((reading, definition) for reading, definition in decided if reading.device_id not in conflicts)
+
+        if not conflicts:
+            break
+
+        state.reload(conflicts)
+        results = [r for r in results if r[0].device_id in conflicts]
+    else:
+        logger.warning("Event state for devices %s kept changing - not evaluated", sorted(conflicts))
+
+    return fired
+
+
+def process_readings(readings, state=None, retries=3):
+    """Evaluate event definitions for some readings and perform the actions of
+    any which fire
+
+    Args:
+        readings (list(Reading)): readings which have been stored
+        state (EventStateStore, optional): debounce state. Loaded for all the
+            devices at once and saved once at the end.
+        retries (int): times to decide again for devices whose debounce state
+            was changed by another process while evaluating
+
+    Returns:
+        list(tuple(Reading, EventDefinition)): events which fired
+    """
+    if not readings:
+        return []
+
+    state = state or EventStateStore()
+
+    products = device_products.get_many({r.device_id for r in readings})
+    evaluators = evaluator_cache.get_many(set(products.values()))
+
+    state.load([d for d, p in products.items() if evaluators.get(p)])
+
+    results = []
+
+    for reading in sorted(readings, key=lambda r: r.timestamp):
+        evaluator = evaluators.get(products.get(reading.device_id))
+        if not evaluator:
+            continue
+
+        for definition, result in evaluator.evaluate(reading.values):
+            results.append((reading, definition, result))
+
+    fired = _decide(results, state, retries)
+
+    if fired:
+        devices = DemoDevice.objects.in_bulk({reading.device_id for reading, _ in fired})
+        for reading, definition in fired:
+            device = devices.get(reading.device_id)
+            if device is not None:
+                perform_actions(device, definition, reading)
+
+    return fired
@@ -0,0 +1,328 @@
+"""Index of when scheduled event definitions next fire
+
+Scheduled event definitions have conditions on the time of day (``time``,
+seconds since midnight UTC) and day of the week (``day``, 0 is Monday), for
+example ``time==28800&&day==0`` for 8am every Monday. Instead of evaluating
+every scheduled definition on every tick, the next time each one fires is
+kept in a redis sorted set, and each tick only takes the ones which are due.
+
+Conditions which are made up of ``time==`` and ``day==`` comparisons (joined
+with ``&&`` and ``||``) are indexed by when they next match. Anything else
+can't be worked out in advance, so it is put in the index for every minute
+and its condition is checked when it fires. Each of those is claimed and
+fanned out on every tick whether or not its condition holds, so the cost of
+a tick grows with the number of non-indexed scheduled definitions as well as
+with the number of events which are actually due - write scheduled
+conditions in terms of ``time`` and ``day`` where possible.
+
+Due definitions are claimed with WATCH/MULTI - their scores are moved on to
+the next time they fire in the same transaction - so if two ticks overlap
+only one of them fires each occurrence. If ticks were missed (beat or the
+workers were down) every occurrence since the definition was last due is
+fired, up to ``max_catch_up`` of them.
+
+Claimed occurrences are also added to a 'pending' sorted set in the same
+transaction, scored by when they were claimed, and are only removed with
+``ack`` once they have been handed to celery. If the tick dies in between
+(or the broker is down) they are picked up again by ``reclaim_stale`` on a
+later tick, once they have been pending for longer than the lease, so an
+occurrence is fired at least once rather than possibly never.
+"""
+import datetime
+import logging
+import math
+
+from redis.exceptions import WatchError
+
+from ..util import redis_util
+from ..util.timestamps import from_unix
+from .conditions import ConditionSyntaxError, tokenize
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_KEY = "demo_scheduled_events"
+# Set once SCHEDULE_KEY has been filled from the database
+BUILT_KEY = "demo_scheduled_events_built"
+# Occurrences which have been claimed but not yet fanned out
+PENDING_KEY = "demo_scheduled_events_pending"
+
+DAY_SECONDS = 24 * 60 * 60
+# 1970-01-01 was a Thursday
+EPOCH_WEEKDAY = 3
+
+
+class Schedule:
+    """When a scheduled condition holds
+
+    Args:
+        clauses (list(tuple)): (time, day) pairs, either of which may be None
+            for 'any'. The schedule matches if any clause does. None means the
+            condition can't be indexed, and it is checked every minute.
+    """
+
+    def __init__(self, clauses):
+        self.clauses = clauses
+
+    @property
+    def indexed(self):
+        return self.clauses is not None
+
+    def next_after(self, after):
+        """First time this schedule fires strictly after a unix time"""
+        if not self.indexed:
+            return (math.floor(after / 60) + 1) * 60
+
+        candidates = []
+        for time_of_day, day in self.clauses:
+            if time_of_day is None:
+                # Any time of day - once a minute on matching days
+                step = 60
+                offsets = range(0, DAY_SECONDS, step)
+            else:
+                offsets = [time_of_day]
+
+            start_of_day = math.floor(after / DAY_SECONDS) * DAY_SECONDS
+            for days_ahead in range(8):
+                day_start = start_of_day + days_ahead * DAY_SECONDS
+                weekday = (int(day_start // DAY_SECONDS) + EPOCH_WEEKDAY) % 7
+                if day is not None and weekday != day:
+                    continue
+
+                later = [day_start + o for o in offsets if day_start + o > after]
+                if later:
+                    candidates.append(min(later))
+                    break
+
+        return min(candidates)
+
+    def occurrences(self, start, end):
+        """All the times this schedule fires in [start, end]
+
+        start should be a time it fires (eg, when it was last due)
+        """
+        times = []
+        t = start
+        while t <= end:
+            times.append(t)
+            t = self.next_after(t)
+        return times
+
+
+def parse_schedule(condition):
+    """Work out when a scheduled condition holds
+
+    Returns:
+        Schedule: the schedule. If the condition isn't just ``time==`` and
+            ``day==`` comparisons the schedule isn't indexed.
+    """
+    try:
+        tokens = tokenize(condition)
+    except ConditionSyntaxError:
+        return Schedule(None)
+
+    clauses = []
+    clause = {}
+    i = 0
+
+    while i < len(tokens):
+        if i + 2 >= len(tokens):
+            return Schedule(None)
+
+        (name_kind, name), (op_kind, op), (value_kind, value) = tokens[i:i + 3]
+        if (name_kind, op_kind, op, value_kind) != ("name", "op", "==", "number") or \
+                name not in ("time", "day") or name in clause:
+            return Schedule(None)
+        clause[name] = int(value)
+        i += 3
+
+        if i == len(tokens) or tokens[i] == ("op", "||"):
+            clauses.append((clause.get("time"), clause.get("day")))
+            clause = {}
+        elif tokens[i] != ("op", "&&"):
+            return Schedule(None)
+        i += 1
+
+    if not clauses or any(
+            (t is not None and not 0 <= t < DAY_SECONDS) or (d is not None and not 0 <= d < 7)
+            for t, d in clauses):
+        return Schedule(None)
+
+    return Schedule(clauses)
+
+
+def schedule_context(fire_at):
+    """Values for ``time`` and ``day`` at a unix time"""
+    ts = datetime.datetime.utcfromtimestamp(fire_at)
+    return {
+        "time": float(ts.hour * 3600 + ts.minute * 60 + ts.second),
+        "day": float(ts.weekday()),
+    }
+
+
+def schedule_definition(definition, now):
+    """Add, move or remove a definition in the index"""
+    r = redis_util.get_redis()
+
+    if not (definition.enabled and definition.scheduled):
+        r.zrem(SCHEDULE_KEY, str(definition.pk))
+        return
+
+    next_fire = parse_schedule(definition.condition).next_after(now)
+    r.zadd(SCHEDULE_KEY, **{str(definition.pk): next_fire})
+
+
+def unschedule_definition(definition_id):
+    redis_util.get_redis().zrem(SCHEDULE_KEY, str(definition_id))
+
+
+def build_index(definitions, now):
+    """Fill the index from scratch
+
+    Args:
+        definitions (iterable(EventDefinition)): every enabled, scheduled
+            definition
+        now (float): unix time
+    """
+    scores = {
+        str(d.pk): parse_schedule(d.condition).next_after(now)
+        for d in definitions
+    }
+
+    pipe = redis_util.get_redis().pipeline()
+    pipe.delete(SCHEDULE_KEY)
+    if scores:
+        pipe.zadd(SCHEDULE_KEY, **scores)
+    pipe.set(BUILT_KEY, 1)
+    pipe.execute()
+
+    return len(scores)
+
+
+def index_built():
+    return redis_util.get_redis().exists(BUILT_KEY)
+
+
+def _pending_member(definition_id, fire_at):
+    return "{}:{!r}".format(definition_id, float(fire_at))
+
+
+def _parse_pending(member):
+    if isinstance(member, bytes):
+        member = member.decode("utf8")
+    definition_id, fire_at = member.split(":", 1)
+    return int(definition_id), float(fire_at)
+
+
+def claim_due(conditions, now, max_catch_up=60, retries=5):
+    """Take every definition which is due and move it on to its next time
+
+    Args:
+        conditions (callable): takes a list of definition ids and returns a
+            dict of id to condition, for working out the next time. Ids which
+            aren't returned are removed from the index.
+        now (float): unix time
+        max_catch_up (int): most missed occurrences of one definition to fire
+
+    Returns:
+        list(tuple(int, float)): (definition id, time it was due) for each
+            occurrence to fire, oldest first. Each one must be passed to
+            ``ack`` once it has been fired.
+    """
+    r = redis_util.get_redis()
+
+    for _ in range(retries):
+        with r.pipeline() as pipe:
+            try:
+                pipe.watch(SCHEDULE_KEY)
+
+                due = pipe.zrangebyscore(SCHEDULE_KEY, "-inf", now, withscores=True)
+                if not due:
+                    pipe.unwatch()
+                    return []
+
+                due_ids = [int(member) for member, _ in due]
+                found = conditions(due_ids)
+
+                claimed = []
+                moved = {}
+                removed = []
+
+                for definition_id, (_, score) in zip(due_ids, due):
+                    if definition_id not in found:
+                        removed.append(str(definition_id))
+                        continue
+
+                    schedule = parse_schedule(found[definition_id])
+                    occurrences = schedule.occurrences(score, now)
+                    if len(occurrences) > max_catch_up:
+                        logger.warning("Skipping %d missed occurrences of scheduled event %s",
+                                       len(occurrences) - max_catch_up, definition_id)
+                        occurrences = occurrences[-max_catch_up:]
+
+                    claimed.extend((definition_id, t) for t in occurrences)
+                    moved[str(definition_id)] = schedule.next_after(now)
+
+                pipe.multi()
+                if moved:
+                    pipe.zadd(SCHEDULE_KEY, **moved)
+                if removed:
+                    pipe.zrem(SCHEDULE_KEY, *removed)
+                if claimed:
+                    pipe.zadd(PENDING_KEY, **{_pending_member(d, t): now for d, t in claimed})
+                pipe.execute()
+            except WatchError:
+                # Someone else claimed them (or a definition changed) - look
+                # again
+                continue
+
+        return sorted(claimed, key=lambda c: c[1])
+
+    logger.warning("Could not claim scheduled events after %d attempts", retries)
+    return []
+
+
+def reclaim_stale(now, lease=300, retries=5):
+    """Take occurrences which were claimed but never acked
+
+    Occurrences which have been pending for longer than ``lease`` seconds are
+    assumed to have been lost by the tick which claimed them, and are leased
+    again to this one.
+
+    Returns:
+        list(tuple(int, float)): (definition id, time it was due), oldest first
+    """
+    r = redis_util.get_redis()
+
+    for _ in range(retries):
+        with r.pipeline() as pipe:
+            try:
+                pipe.watch(PENDING_KEY)
+
+                stale = pipe.zrangebyscore(PENDING_KEY, "-inf", now - lease)
+                if not stale:
+                    pipe.unwatch()
+                    return []
+
+                pipe.multi()
+                pipe.zadd(PENDING_KEY, **{
+                    (m.decode("utf8") if isinstance(m, bytes) else m): now for m in stale
+                })
+                pipe.execute()
+            except WatchError:
+                continue
+
+        reclaimed = sorted((_parse_pending(m) for m in stale), key=lambda c: c[1])
+        logger.warning("Re-firing %d scheduled event occurrences which were never fanned out", len(reclaimed))
+        return reclaimed
+
+    return []
+
+
+def ack(definition_id, fire_at):
+    """Mark a claimed occurrence as fired"""
+    redis_util.get_redis().zrem(PENDING_KEY, _pending_member(definition_id, fire_at))
+
+
+def fire_time(fire_at):
+    """Datetime of an occurrence, for activity stream timestamps"""
+    return from_unix(fire_at)
@@ -0,0 +1,221 @@
+"""Debounce state for event definitions
+
+For each device redis holds one hash (under
+REDIS["event_definition_state_key"]), with a field per event definition packing
+together whether its condition held the last time it was evaluated and when
+it last fired.
+
+An event fires when its condition becomes true, unless it already fired
+less than ``debounce_window`` seconds before.
+
+The state for every device in a batch of readings is loaded with one
+pipelined round trip before evaluating, and whatever changed is written back
+with one more, so the number of redis calls doesn't depend on how many
+definitions the product has or how many readings are in the batch.
+
+Several processes can evaluate readings for the same device at once (eg, the
+listener and a celery worker), so the write is a compare-and-set per device:
+it only goes through if none of the fields it changes have changed since they
+were loaded. Otherwise ``save`` reports the device as conflicting, and its
+decisions have to be made again from the current state (see
+``django_demo.events.engine``), so an event can't fire twice for the same
+edge.
+"""
+import logging
+
+from django.conf import settings
+from redis.exceptions import WatchError
+
+from ..util import redis_util
+
+logger = logging.getLogger(__name__)
+
+# KEYS[1]: state hash for a device
+# ARGV: field, expected value ("" if it didn't exist) and new value, for each
+# changed field
+# Sets all the fields and returns 1 if they all had the expected values,
+# otherwise changes nothing and returns 0.
+COMPARE_AND_SET_SCRIPT = """
+for i = 1, #ARGV, 3 do
+    local current = redis.call("HGET", KEYS[1], ARGV[i]) or ""
+    if current ~= ARGV[i + 1] then
+        return 0
+    end
+end
+
+for i = 1, #ARGV, 3 do
+    redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 2])
+end
+
+return 1
+"""
+
+
+def _key_prefix():
+    return getattr(settings, "REDIS", {}).get("event_definition_state_key", "event_def_state")
+
+
+def _decode(raw):
+    return raw.decode("utf8") if isinstance(raw, bytes) else raw
+
+
+def _pack(held, last_fired):
+    return "{}:{}".format(int(held), "" if last_fired is None else last_fired)
+
+
+def _unpack(raw):
+    held, last_fired = _decode(raw).split(":", 1)
+    return held == "1", float(last_fired) if last_fired else None
+
+
+class EventStateStore:
+    """Debounce state for a batch of devices, loaded and saved in bulk"""
+
+    # Whether the redis client can run Lua scripts - shared by all stores
+    _use_lua = True
+
+    def __init__(self):
+        self.prefix = _key_prefix()
+        # device id: {definition id: (held, last_fired)}
+        self._states = {}
+        # device id: {definition id: packed state when loaded, or ""}
+        self._loaded = {}
+        # device id: {definition id: packed state}
+        self._dirty = {}
+
+    def state_key(self, device_id):
+        return "{}:{}".format(self.prefix, device_id)
+
+    def load(self, device_ids):
+        """Load the state for some devices with one round trip"""
+        device_ids = [d for d in device_ids if d not in self._states]
+        if not device_ids:
+            return
+
+        pipe = redis_util.get_redis().pipeline(transaction=False)
+        for device_id in device_ids:
+            pipe.hgetall(self.state_key(device_id))
+
+        for device_id, fields in zip(device_ids, pipe.execute()):
+            self._loaded[device_id] = {
+                int(_decode(definition_id)): _decode(raw) for definition_id, raw in fields.items()
+            }
+            self._states[device_id] = {
+                definition_id: _unpack(raw) for definition_id, raw in self._loaded[device_id].items()
+            }
+
+    def reload(self, device_ids):
+        """Forget the state (and any unsaved changes) for some devices and load
+        it again"""
+        for device_id in device_ids:
+            self._states.pop(device_id, None)
+            self._loaded.pop(device_id, None)
+            self._dirty.pop(device_id, None)
+
+        self.load(device_ids)
+
+    def should_fire(self, device_id, definition, result, now):
+        """Record the result of evaluating a definition and decide whether the
+        event fires
+
+        The state must have been loaded for the device, and is only stored
+        in redis by ``save``.
+
+        Args:
+            device_id (int): device the reading came from
+            definition (EventDefinition): definition that was evaluated
+            result (bool): whether its condition held
+            now (float): unix time of the reading
+
+        Returns:
+            bool: whether to perform the definition's actions, if ``save``
+                doesn't report a conflict for the device
+        """
+        states = self._states.setdefault(device_id, {})
+        previous = states.get(definition.pk, (False, None))
+        held, last_fired = previous
+
+        fire = (
+            result and not held and
+            (last_fired is None or now - last_fired >= (definition.debounce_window or 0))
+        )
+        if fire:
+            last_fired = now
+
+        if (result, last_fired) != previous:
+            states[definition.pk] = (result, last_fired)
+            self._dirty.setdefault(device_id, {})[definition.pk] = _pack(result, last_fired)
+
+        return fire
+
+    def _changes(self, device_id):
+        """(field, expected, new) for each changed field of a device"""
+        loaded = self._loaded.get(device_id, {})
+        return [
+            (str(definition_id), loaded.get(definition_id, ""), packed)
+            for definition_id, packed in self._dirty[device_id].items()
+        ]
+
+    def save(self):
+        """Write any changed state with one round trip
+
+        Returns:
+            set(int): devices whose state had been changed by something else
+                since it was loaded. Nothing was written for these, and any
+                events decided for them must not fire.
+        """
+        if not self._dirty:
+            return set()
+
+        client = redis_util.get_redis()
+        device_ids = list(self._dirty)
+
+        if EventStateStore._use_lua:
+            try:
+                script = client.register_script(COMPARE_AND_SET_SCRIPT)
+
+                pipe = client.pipeline(transaction=False)
+                for device_id in device_ids:
+                    script(
+                        keys=[self.state_key(device_id)],
+                        args=[v for change in self._changes(device_id) for v in change],
+                        client=pipe,
+                    )
+                saved = [bool(int(s)) for s in pipe.execute()]
+            except (ImportError, NotImplementedError, AttributeError, TypeError) as e:
+                logger.warning("Redis client can't run Lua scripts (%s) - using WATCH for event state", e)
+                EventStateStore._use_lua = False
+
+        if not EventStateStore._use_lua:
+            saved = [self._compare_and_set_watch(client, device_id) for device_id in device_ids]
+
+        conflicts = {device_id for device_id, ok in zip(device_ids, saved) if not ok}
+        for device_id, ok in zip(device_ids, saved):
+            if ok:
+                self._loaded.setdefault(device_id, {}).update(self._dirty[device_id])
+
+        self._dirty = {}
+        return conflicts
+
+    def _compare_and_set_watch(self, client, device_id):
+        """Same as COMPARE_AND_SET_SCRIPT, with WATCH/MULTI (one round trip
+        per device)"""
+        key = self.state_key(device_id)
+        changes = self._changes(device_id)
+
+        with client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+
+                current = pipe.hmget(key, [field for field, _, _ in changes])
+                if any((_decode(c) or "") != expected for c, (_, expected, _) in zip(current, changes)):
+                    pipe.unwatch()
+                    return False
+
+                pipe.multi()
+                pipe.hmset(key, {field: new for field, _, new in changes})
+                pipe.execute()
+            except WatchError:
+                return False
+
+        return True
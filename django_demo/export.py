@@ -0,0 +1,95 @@
+"""Streaming export of serialized objects as NDJSON or CSV
+
+Objects are read from the database with a server side cursor (where the
+database supports one) and serialized in fixed size batches, so memory use
+does not depend on how many objects are exported and the first rows are sent
+before the whole query has finished.
+"""
+import csv
+import json
+import logging
+
+from django.db.models import prefetch_related_objects
+from rest_framework.utils.encoders import JSONEncoder
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def iter_batches(queryset, batch_size, prefetch=()):
+    """Iterate over a queryset in batches using a server side cursor
+
+    ``prefetch_related`` is ignored by ``QuerySet.iterator``, so any prefetches
+    are done per batch instead.
+
+    Args:
+        queryset (QuerySet): objects to iterate over
+        batch_size (int): number of objects per batch (and per cursor fetch)
+        prefetch (list): lookups to prefetch for each batch
+
+    Yields:
+        list: batches of objects
+    """
+    batch = []
+
+    for obj in queryset.iterator(chunk_size=batch_size):
+        batch.append(obj)
+        if len(batch) >= batch_size:
+            prefetch_related_objects(batch, *prefetch)
+            yield batch
+            batch = []
+
+    if batch:
+        prefetch_related_objects(batch, *prefetch)
+        yield batch
+
+
+def stream_ndjson(batches, serialize):
+    """Yield one JSON document per line
+
+    Args:
+        batches (iterable(list)): batches of objects
+        serialize (callable): turns a batch of objects into a list of dicts
+    """
+    for batch in batches:
+        yield "".join(json.dumps(row, cls=JSONEncoder) + "\n" for row in serialize(batch))
+
+
+class _Echo:
+    """File-like object which just returns what is written to it"""
+
+    def write(self, value):
+        return value
+
+
+def _csv_cell(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, cls=JSONEncoder)
+    if value is None:
+        return ""
+    return value
+
+
+def stream_csv(batches, serialize, fields):
+    """Yield CSV rows, starting with a header
+
+    Nested values (eg lists of orgs) are written as JSON.
+
+    Args:
+        batches (iterable(list)): batches of objects
+        serialize (callable): turns a batch of objects into a list of dicts
+        fields (list(str)): columns to write
+    """
+    writer = csv.writer(_Echo())
+
+    yield writer.writerow(fields)
+
+    for batch in batches:
+        yield "".join(
+            writer.writerow([_csv_cell(row.get(f)) for f in fields])
+            for row in serialize(batch)
+        )
@@ -0,0 +1,137 @@
+"""Signal and message handlers for the demo app
+
+Imported in DjangoDemoConfig.ready
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from organizations.models import OrganizationUser
+
+from zconnect.models import EventDefinition
+from zconnect.registry import message_handler
+from zconnect.zc_timeseries.models import DeviceSensor, TimeSeriesData
+
+from . import access, device_cache, events, presence, rollups, sensor_store
+from .events import schedule
+from .ingest import get_ingest_pipeline, reading_from_message
+from .ingest.ratelimit import get_rate_limiter
+from .ingest.writer import sensor_cache
+from .models import DemoDevice
+
+logger = logging.getLogger(__name__)
+
+
+@message_handler(name="periodic")
+def buffered_periodic_handler(message, listener):
+    """Store readings and update last_seen/online for a periodic message
+
+    This replaces writing each message separately. The reading is put on the
+    ingest pipeline's bounded queue and written in a batch by one of a fixed
+    number of writers, so a burst of messages doesn't turn into hundreds of
+    greenlets waiting for a database connection. What happens when the queue
+    is full depends on DEMO_INGEST["overflow"]. See django_demo.ingest.
+
+    The handler waits until the batch has been committed (and raises if it
+    failed or the reading was shed), so the message is only acknowledged once
+    the reading is stored - unless DEMO_INGEST["ack_before_write"] is set.
+
+    Messages over the periodic rate limit for their device are dropped (see
+    django_demo.ingest.ratelimit), as they are by the sharded listener.
+    """
+    if not get_rate_limiter().admit("periodic", message.device.pk):
+        logger.debug("Rate limited periodic message from device %s", message.device.pk)
+        return
+
+    wait = not getattr(settings, "DEMO_INGEST", {}).get("ack_before_write", False)
+    get_ingest_pipeline().submit(reading_from_message(message), wait=wait)
+
+
+@receiver(post_save, sender=DemoDevice)
+@receiver(post_delete, sender=DemoDevice)
+def invalidate_device(sender, instance, **kwargs):
+    device_cache.invalidate([instance.pk])
+    events.device_products.invalidate([instance.pk])
+
+
+@receiver(post_delete, sender=DemoDevice)
+def forget_device(sender, instance, **kwargs):
+    presence.forget([instance.pk])
+    sensor_store.invalidate([instance.pk])
+    sensor_cache.invalidate([instance.pk])
+
+
+@receiver(m2m_changed, sender=DemoDevice.orgs.through)
+def invalidate_device_orgs(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear" and reverse:
+        # The devices are gone by the time post_clear is sent
+        instance._cleared_device_ids = list(instance.devices.values_list("pk", flat=True))
+        return
+
+    if not action.startswith("post_"):
+        return
+
+    if not reverse:
+        # device.orgs.add(...)
+        device_ids = [instance.pk]
+    elif pk_set:
+        # org.devices.add(...)
+        device_ids = list(pk_set)
+    else:
+        # org.devices.clear() - pk_set is not given
+        device_ids = getattr(instance, "_cleared_device_ids", [])
+
+    # updated_at on the device doesn't change, but this bumps the state version
+    device_cache.invalidate(device_ids)
+
+
+@receiver(post_save, sender=DeviceSensor)
+@receiver(post_delete, sender=DeviceSensor)
+def invalidate_device_sensor(sender, instance, **kwargs):
+    device_cache.invalidate([instance.device_id])
+    sensor_store.invalidate([instance.device_id])
+    sensor_cache.invalidate([instance.device_id])
+
+
+def _reading_device_id(reading):
+    """Device id for a reading, without loading the whole sensor"""
+    if TimeSeriesData._meta.get_field("sensor").is_cached(reading):
+        return reading.sensor.device_id
+    return DeviceSensor.objects.filter(pk=reading.sensor_id).values_list("device_id", flat=True).first()
+
+
+@receiver(post_save, sender=TimeSeriesData)
+def invalidate_device_reading(sender, instance, created, **kwargs):
+    # The ingest pipeline writes readings with bulk_create, which doesn't send
+    # this
+    if created:
+        # Not written by the ingest pipeline, so not in the sensor store either
+        device_id = _reading_device_id(instance)
+        device_cache.invalidate([device_id])
+        sensor_store.invalidate([device_id])
+        rollups.update([(instance.sensor_id, instance.ts, instance.value)])
+
+
+@receiver(post_save, sender=OrganizationUser)
+@receiver(post_delete, sender=OrganizationUser)
+def invalidate_user_orgs(sender, instance, **kwargs):
+    access.invalidate_user_orgs([instance.user_id])
+
+
+@receiver(post_save, sender=EventDefinition)
+@receiver(post_delete, sender=EventDefinition)
+def invalidate_event_definitions(sender, instance, **kwargs):
+    if instance.product_id is not None:
+        events.evaluator_cache.invalidate(instance.product_id)
+
+
+@receiver(post_save, sender=EventDefinition)
+def index_scheduled_event(sender, instance, **kwargs):
+    schedule.schedule_definition(instance, time.time())
+
+
+@receiver(post_delete, sender=EventDefinition)
+def unindex_scheduled_event(sender, instance, **kwargs):
+    schedule.unschedule_definition(instance.pk)
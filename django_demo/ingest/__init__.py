@@ -0,0 +1,71 @@
+"""Write-behind ingestion of device readings
+
+Messages from the listener are not written to the database one at a time.
+Instead they are collected into micro-batches (see :mod:`.buffer`) which are
+written with a few bulk statements (see :mod:`.writer`). In the listener the
+batches are written by a fixed pool of writers fed from a bounded queue (see
+:mod:`.pipeline`).
+"""
+from .buffer import WriteBehindBuffer
+from .pipeline import IngestPipeline, ReadingShed
+from .readings import Reading, reading_from_message, reading_from_payload
+from .writer import PartialWriteError, write_readings
+
+__all__ = [
+    "IngestPipeline",
+    "PartialWriteError",
+    "Reading",
+    "ReadingShed",
+    "WriteBehindBuffer",
+    "get_ingest_buffer",
+    "get_ingest_pipeline",
+    "reading_from_message",
+    "reading_from_payload",
+    "use_ingest_pipeline",
+    "write_readings",
+]
+
+_buffer = None
+_pipeline = None
+
+
+def get_ingest_buffer():
+    """Get the buffer shared by all message handlers in this process"""
+    global _buffer # pylint: disable=global-statement
+
+    if _buffer is None:
+        from django.conf import settings
+        options = getattr(settings, "DEMO_INGEST", {})
+        _buffer = WriteBehindBuffer(
+            write_readings,
+            max_size=options.get("batch_size", 500),
+            max_delay=options.get("max_delay", 0.5),
+        )
+
+    return _buffer
+
+
+def use_ingest_pipeline(pipeline):
+    """Make get_ingest_pipeline return this pipeline (eg, in simulate_fleet)"""
+    global _pipeline # pylint: disable=global-statement
+    _pipeline = pipeline
+
+
+def get_ingest_pipeline():
+    """Get the queue and writer pool used by the listener in this process"""
+    global _pipeline # pylint: disable=global-statement
+
+    if _pipeline is None:
+        from django.conf import settings
+        options = getattr(settings, "DEMO_INGEST", {})
+        _pipeline = IngestPipeline(
+            write_readings,
+            writers=options.get("writers", 2),
+            queue_size=options.get("queue_size", 10000),
+            overflow=options.get("overflow", "block"),
+            batch_size=options.get("batch_size", 500),
+            max_delay=options.get("max_delay", 0.5),
+            block_timeout=options.get("block_timeout"),
+        )
+
+    return _pipeline
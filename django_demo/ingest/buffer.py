@@ -0,0 +1,130 @@
+"""Micro-batching of items which need to be written to the database
+
+Items are collected until either ``max_size`` of them are waiting, or the
+oldest has been waiting for ``max_delay`` seconds, and then the whole batch is
+passed to a flush function in a background thread (a greenlet, when running
+under gevent).
+
+By default ``submit`` blocks until the batch containing the item has been
+flushed, and re-raises any error from flushing it. A message handler which
+submits a reading therefore only returns - and the message is only
+acknowledged - once the reading has been committed, the same as when it was
+written directly. With many handlers running concurrently they all share a
+handful of bulk writes instead of doing a round trip each.
+"""
+import logging
+import threading
+import time
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class _Batch:
+    def __init__(self):
+        self.items = []
+        self.started = None
+        self.done = threading.Event()
+        self.error = None
+
+
+class WriteBehindBuffer:
+    """Collect items into batches bounded by size and time
+
+    Args:
+        flush (callable): called with a list of items to write them
+        max_size (int): flush when this many items are waiting
+        max_delay (float): flush when the oldest item has waited this many
+            seconds
+    """
+
+    def __init__(self, flush, max_size=500, max_delay=0.5):
+        self.flush = flush
+        self.max_size = max_size
+        self.max_delay = max_delay
+
+        self._cond = threading.Condition()
+        self._batch = _Batch()
+        self._thread = None
+
+        # Stats
+        self.flushed_batches = 0
+        self.flushed_items = 0
+        self.failed_batches = 0
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="write-behind-flusher", daemon=True)
+            self._thread.start()
+
+    def submit(self, item, wait=True):
+        """Add an item to the current batch
+
+        Args:
+            item: item to write
+            wait (bool): if True, block until the item has been written
+
+        Raises:
+            Exception: if wait is True and writing the batch failed
+        """
+        with self._cond:
+            self._ensure_started()
+
+            batch = self._batch
+            if not batch.items:
+                batch.started = time.monotonic()
+            batch.items.append(item)
+
+            if len(batch.items) == 1 or len(batch.items) >= self.max_size:
+                self._cond.notify()
+
+        if wait:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+
+    def _take_batch(self):
+        """Wait until a batch is ready and swap it for a new one"""
+        with self._cond:
+            while not self._batch.items:
+                self._cond.wait()
+
+            while len(self._batch.items) < self.max_size:
+                remaining = self._batch.started + self.max_delay - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch, self._batch = self._batch, _Batch()
+
+        return batch
+
+    def _flush_batch(self, batch):
+        close_old_connections()
+
+        try:
+            self.flush(batch.items)
+        except Exception as e: # pylint: disable=broad-except
+            logger.exception("Error writing batch of %d items", len(batch.items))
+            batch.error = e
+            self.failed_batches += 1
+        else:
+            self.flushed_batches += 1
+            self.flushed_items += len(batch.items)
+        finally:
+            batch.done.set()
+
+    def _run(self):
+        while True:
+            self._flush_batch(self._take_batch())
+
+    def flush_now(self):
+        """Write whatever is waiting in the calling thread"""
+        with self._cond:
+            batch, self._batch = self._batch, _Batch()
+
+        if batch.items:
+            self._flush_batch(batch)
+        else:
+            batch.done.set()
@@ -0,0 +1,368 @@
+"""Bounded queue between the listener and a fixed pool of database writers
+
+Under gevent every incoming message is handled in its own greenlet, so if
+handlers write to the database directly a burst of messages turns into
+hundreds of greenlets all waiting for one of the few pooled database
+connections. Instead the message handler only converts the message into a
+Reading and puts it on a bounded queue, and a fixed number of writer threads
+(greenlets, under gevent) take batches off the queue and write them. At most
+``writers`` database connections are used however many messages arrive.
+
+By default ``submit`` waits until the batch containing the reading has been
+committed, and raises if it couldn't be written or was shed, so the message
+handler - and so the acknowledgement of the message - still only completes
+once the reading is stored (as with :class:`.buffer.WriteBehindBuffer`). The
+handler greenlets wait on an event rather than a database connection.
+Passing ``wait=False`` returns as soon as the reading is queued, trading that
+guarantee for throughput: anything queued is lost if the process dies, and
+failed batches are only logged and counted.
+
+When the queue is full the ``overflow`` policy decides what happens:
+
+- ``block``: the handler waits for space (up to ``block_timeout`` seconds, after
+  which the reading is shed). This pushes back on the MQTT client, and so on
+  the broker.
+- ``shed``: the reading is dropped and counted.
+- ``spill``: the reading is pushed onto a list in redis, and written once the
+  queue has drained. A spilled reading counts as stored as soon as it is in
+  redis.
+"""
+from collections import deque
+import datetime
+import json
+import logging
+import queue
+import threading
+import time
+
+from django.db import close_old_connections
+from redis.exceptions import RedisError
+
+from django_demo.util import redis_util
+
+from .readings import Reading
+from .writer import PartialWriteError
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("block", "shed", "spill")
+
+SPILL_KEY = "demo_ingest_spill"
+
+
+class ReadingShed(Exception):
+    """The ingest queue was full and the reading was dropped"""
+
+
+class _Pending:
+    """Completion handle for a reading which is waiting to be written"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+    def finish(self, error=None):
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+
+def _dump_reading(reading):
+    return json.dumps([
+        reading.device_id,
+        reading.timestamp.isoformat(),
+        reading.values,
+    ])
+
+
+def _load_reading(raw):
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf8")
+
+    device_id, timestamp, values = json.loads(raw)
+    try:
+        timestamp = datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%f")
+    except ValueError:
+        timestamp = datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S")
+
+    return Reading(device_id, timestamp, values)
+
+
+class IngestPipeline:
+    """Bounded receive queue feeding a fixed pool of batch writers
+
+    Args:
+        write (callable): called with a list of Readings to write them
+        writers (int): number of writer threads. This should be no more than
+            the number of database connections available.
+        queue_size (int): readings waiting before the overflow policy applies
+        overflow (str): one of OVERFLOW_POLICIES
+        batch_size (int): most readings written at once by a writer
+        max_delay (float): seconds a writer waits to fill a batch
+        block_timeout (float): for the 'block' policy, seconds to wait for
+            space before shedding the reading. None waits forever.
+        spill_key (str): redis list used by the 'spill' policy
+    """
+
+    def __init__(self, write, writers=2, queue_size=10000, overflow="block",
+                 batch_size=500, max_delay=0.5, block_timeout=None, spill_key=SPILL_KEY):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of {}".format(", ".join(OVERFLOW_POLICIES)))
+
+        self.write = write
+        self.num_writers = writers
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.block_timeout = block_timeout
+        self.spill_key = spill_key
+
+        # (enqueued_at, reading, _Pending or None)
+        self._queue = queue.Queue(maxsize=queue_size)
+        # Readings taken from the spill list which couldn't be queued or put
+        # back in redis
+        self._unspilled = deque()
+        self._writers = []
+        self._lock = threading.Lock()
+        self._stopping = False
+
+        # Stats
+        self.submitted = 0
+        self.shed = 0
+        self.spilled = 0
+        self.written = 0
+        self.failed = 0
+        self._blocked = 0
+        # Seconds the oldest reading in recent batches had been queued
+        self._waits = deque(maxlen=1000)
+
+    def start(self):
+        """Start (or restart any dead) writers"""
+        with self._lock:
+            self._stopping = False
+            self._writers = [w for w in self._writers if w.is_alive()]
+
+            while len(self._writers) < self.num_writers:
+                writer = threading.Thread(
+                    target=self._run,
+                    name="ingest-writer-{}".format(len(self._writers)),
+                    daemon=True,
+                )
+                writer.start()
+                self._writers.append(writer)
+
+    def stop(self, timeout=None):
+        """Write what is queued and stop the writers"""
+        self._stopping = True
+        for writer in self._writers:
+            writer.join(timeout)
+
+    def submit(self, reading, wait=True):
+        """Queue a reading to be written
+
+        Args:
+            reading (Reading): reading to write
+            wait (bool): if True, block until the batch containing the
+                reading has been written
+
+        Returns:
+            bool: True if the reading was queued (and written, if waiting) or
+                spilled, False if it was shed and wait is False
+
+        Raises:
+            ReadingShed: if wait is True and the reading was shed
+            Exception: if wait is True and writing the batch failed
+        """
+        if not self._writers:
+            self.start()
+
+        pending = _Pending() if wait else None
+        item = (time.monotonic(), reading, pending)
+
+        try:
+            if self.overflow == "block":
+                self._blocked += 1
+                try:
+                    self._queue.put(item, timeout=self.block_timeout)
+                finally:
+                    self._blocked -= 1
+            else:
+                self._queue.put_nowait(item)
+        except queue.Full:
+            if self.overflow == "spill" and self._spill(reading):
+                return True
+
+            self.shed += 1
+            logger.warning("Ingest queue full - dropping reading from device %s", reading.device_id)
+            if wait:
+                raise ReadingShed("Ingest queue full - dropped reading from device {}".format(reading.device_id))
+            return False
+
+        self.submitted += 1
+
+        if pending is not None:
+            pending.wait()
+
+        return True
+
+    def _spill(self, reading):
+        try:
+            redis_util.get_redis().rpush(self.spill_key, _dump_reading(reading))
+        except RedisError:
+            logger.exception("Could not spill reading to redis")
+            return False
+
+        self.spilled += 1
+        return True
+
+    def _unspill(self):
+        """Move spilled readings back onto the queue while there is room
+
+        Returns:
+            int: number of readings moved
+        """
+        moved = 0
+        now = time.monotonic()
+
+        while self._unspilled:
+            try:
+                reading = self._unspilled.popleft()
+            except IndexError:
+                break
+
+            try:
+                self._queue.put_nowait((now, reading, None))
+            except queue.Full:
+                self._unspilled.appendleft(reading)
+                return moved
+
+            moved += 1
+
+        room = min(self._queue.maxsize - self._queue.qsize(), self.batch_size)
+        if room <= 0:
+            return moved
+
+        try:
+            pipe = redis_util.get_redis().pipeline()
+            pipe.lrange(self.spill_key, 0, room - 1)
+            pipe.ltrim(self.spill_key, room, -1)
+            raw, _ = pipe.execute()
+        except RedisError:
+            logger.exception("Could not read spilled readings from redis")
+            return moved
+
+        for i, r in enumerate(raw):
+            try:
+                self._queue.put_nowait((now, _load_reading(r), None))
+            except queue.Full:
+                # New readings filled the queue in the meantime - put the
+                # rest back at the front of the list, keeping their order
+                try:
+                    redis_util.get_redis().lpush(self.spill_key, *reversed(raw[i:]))
+                except RedisError:
+                    logger.exception("Could not put %d spilled readings back in redis - keeping them in memory",
+                                     len(raw) - i)
+                    self._unspilled.extend(_load_reading(r) for r in raw[i:])
+                return moved + i
+
+        return moved + len(raw)
+
+    def _take_batch(self):
+        """Wait for readings and take up to batch_size of them
+
+        Returns:
+            list: (enqueued_at, reading, pending) tuples, possibly empty
+        """
+        try:
+            first = self._queue.get(timeout=self.max_delay)
+        except queue.Empty:
+            return []
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _write_batch(self, batch):
+        self._waits.append(time.monotonic() - batch[0][0])
+
+        readings = [reading for _, reading, _ in batch]
+        error = None
+        try:
+            close_old_connections()
+            self.write(readings)
+        except PartialWriteError as e:
+            # Only the readings for these devices failed
+            error = e
+        except Exception as e: # pylint: disable=broad-except
+            logger.exception("Error writing batch of %d readings", len(readings))
+            error = e
+
+        for _, reading, pending in batch:
+            failed = error is not None and (
+                not isinstance(error, PartialWriteError) or reading.device_id in error.device_ids
+            )
+            if failed:
+                self.failed += 1
+            else:
+                self.written += 1
+
+            if pending is not None:
+                pending.finish(error if failed else None)
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                self._write_batch(batch)
+
+            unspilled = 0
+            if self.overflow == "spill" and self._queue.qsize() < self.queue_size // 2:
+                unspilled = self._unspill()
+
+            if self._stopping and not (batch or unspilled):
+                break
+
+    def stats(self):
+        """Gauges and counters for the stats server
+
+        Returns:
+            dict: stats
+        """
+        waits = sorted(self._waits)
+
+        def percentile(p):
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(len(waits) * p))]
+
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_size": self.queue_size,
+            "overflow": self.overflow,
+            "writers_alive": sum(w.is_alive() for w in self._writers),
+            "blocked_submitters": self._blocked,
+            "wait_seconds_p50": percentile(0.5),
+            "wait_seconds_p99": percentile(0.99),
+            "wait_seconds_max": waits[-1] if waits else 0.0,
+            "submitted": self.submitted,
+            "shed": self.shed,
+            "spilled": self.spilled,
+            "written": self.written,
+            "failed": self.failed,
+        }
@@ -0,0 +1,293 @@
+"""Token bucket rate limiting for listener event types
+
+Each (event type, device) pair has a token bucket with a capacity of the
+configured limit for that event type, refilled at ``limit / period`` tokens
+per second - the same limits as DEFAULT_LISTENER_SETTINGS
+["worker_events_rate_limits"] and ["rate_limit_period"].
+
+Buckets are kept in redis and updated atomically by a Lua script, so checking
+and taking tokens from several buckets is one round trip. Checks for many
+messages can also be pipelined with :meth:`TokenBucketLimiter.admit_many`.
+
+To avoid a round trip for most messages, tokens are leased from redis in
+blocks of ``lease_size`` and then handed out locally until they run out or
+the lease expires. Tokens left in an expired lease are given back to the
+bucket (with the next round trip), so leasing doesn't make the limits any
+stricter. This works best when all of a device's messages are handled by the
+same process, as they are with the sharded listener.
+
+If the redis client can't run Lua scripts (eg mockredis in tests) the same
+algorithm is run in python, non-atomically.
+"""
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from ..util import redis_util
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "demo_ratelimit"
+
+# KEYS: bucket keys
+# ARGV[1]: current unix time, ARGV[2]: tokens requested
+# ARGV[1 + 2i], ARGV[2 + 2i]: capacity and refill rate (per second) of bucket i
+# Returns the number of tokens granted, up to ARGV[2] - the same from every
+# bucket, or 0 if any bucket has less than one token. If ARGV[2] is negative,
+# that many tokens are given back instead (up to each bucket's capacity).
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local requested = tonumber(ARGV[2])
+local grant = requested
+local tokens = {}
+
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[1 + 2 * i])
+    local rate = tonumber(ARGV[2 + 2 * i])
+    local state = redis.call("HMGET", key, "tokens", "ts")
+    local available = tonumber(state[1]) or capacity
+    local last = tonumber(state[2]) or now
+    available = math.min(capacity, available + math.max(0, now - last) * rate)
+    tokens[i] = available
+    if requested > 0 then
+        grant = math.min(grant, math.floor(available))
+    end
+end
+
+if requested > 0 and grant < 1 then
+    grant = 0
+end
+
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[1 + 2 * i])
+    local rate = tonumber(ARGV[2 + 2 * i])
+    redis.call("HMSET", key, "tokens", math.min(capacity, tokens[i] - grant), "ts", now)
+    redis.call("EXPIRE", key, math.ceil(capacity / rate) + 1)
+end
+
+return grant
+"""
+
+
+def bucket_key(event_type, device_id):
+    return "{}:{}:{}".format(KEY_PREFIX, event_type, device_id)
+
+
+class TokenBucketLimiter:
+    """Per event type and device token bucket limiter
+
+    Args:
+        limits (dict): event type to maximum messages per period. Event types
+            not in here are not limited.
+        period (float): seconds
+        lease_size (int): tokens to take from redis at once. 1 disables local
+            pre-admission.
+        lease_ttl (float): seconds before unused leased tokens are given
+            back
+    """
+
+    def __init__(self, limits, period, lease_size=10, lease_ttl=5.0):
+        self.limits = limits
+        self.period = float(period)
+        self.lease_size = lease_size
+        self.lease_ttl = lease_ttl
+
+        # key to (tokens left, expiry, event type)
+        self._leases = {}
+        # (key, event type, tokens) from expired leases, to give back
+        self._unused = []
+        self._next_sweep = 0
+        self._lock = threading.Lock()
+        self._script = None
+        self._use_lua = True
+
+    @classmethod
+    def from_settings(cls, listener_settings, **kwargs):
+        return cls(
+            listener_settings["worker_events_rate_limits"],
+            listener_settings["rate_limit_period"],
+            **kwargs
+        )
+
+    def _bucket_args(self, event_type):
+        limit = self.limits[event_type]
+        return [limit, limit / self.period]
+
+    def _take_local(self, key):
+        with self._lock:
+            lease = self._leases.get(key)
+            if lease is None:
+                return False
+
+            remaining, expires, event_type = lease
+            if remaining < 1 or expires < time.monotonic():
+                del self._leases[key]
+                if remaining >= 1:
+                    self._unused.append((key, event_type, remaining))
+                return False
+
+            self._leases[key] = (remaining - 1, expires, event_type)
+            return True
+
+    def _store_lease(self, key, event_type, remaining):
+        if remaining > 0:
+            with self._lock:
+                self._leases[key] = (remaining, time.monotonic() + self.lease_ttl, event_type)
+
+    def _take_unused(self):
+        """Remove expired leases, returning the tokens to give back
+
+        Leases which aren't used again (eg, the device stopped sending) are
+        swept up at most once every lease_ttl.
+
+        Returns:
+            list(tuple): (key, event type, unused tokens)
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            if now >= self._next_sweep:
+                self._next_sweep = now + self.lease_ttl
+                for key, (remaining, expires, event_type) in list(self._leases.items()):
+                    if expires < now:
+                        del self._leases[key]
+                        if remaining >= 1:
+                            self._unused.append((key, event_type, remaining))
+
+            unused, self._unused = self._unused, []
+
+        return unused
+
+    def _lease_size_for(self, event_type):
+        return max(1, min(self.lease_size, self.limits[event_type]))
+
+    def _take_python(self, client, key, event_type, requested, now):
+        """Same as TOKEN_BUCKET_SCRIPT, without atomicity"""
+        capacity, rate = self._bucket_args(event_type)
+
+        state = client.hmget(key, "tokens", "ts")
+        available = float(state[0]) if state[0] is not None else capacity
+        last = float(state[1]) if state[1] is not None else now
+        available = min(capacity, available + max(0, now - last) * rate)
+
+        grant = requested
+        if requested > 0:
+            grant = min(requested, math.floor(available))
+            if grant < 1:
+                grant = 0
+
+        client.hmset(key, {"tokens": min(capacity, available - grant), "ts": now})
+        client.expire(key, int(math.ceil(capacity / rate)) + 1)
+        return grant
+
+    def _take_redis(self, pending):
+        """Take tokens from (or give them back to) several buckets in redis
+
+        Args:
+            pending (list(tuple)): (key, event type, tokens). Negative tokens
+                are given back.
+
+        Returns:
+            list(int): tokens granted for each
+        """
+        client = redis_util.get_redis()
+        now = time.time()
+
+        if self._use_lua:
+            try:
+                if self._script is None:
+                    self._script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+                pipe = client.pipeline(transaction=False)
+                for key, event_type, tokens in pending:
+                    self._script(
+                        keys=[key],
+                        args=[now, tokens] + self._bucket_args(event_type),
+                        client=pipe,
+                    )
+                return [int(g) for g in pipe.execute()]
+            except (ImportError, NotImplementedError, AttributeError, TypeError) as e:
+                logger.warning("Redis client can't run Lua scripts (%s) - rate limiting in python", e)
+                self._use_lua = False
+
+        return [
+            self._take_python(client, key, event_type, tokens, now)
+            for key, event_type, tokens in pending
+        ]
+
+    def admit_many(self, messages):
+        """Check whether several messages are allowed
+
+        Args:
+            messages (list(tuple)): (event type, device id) pairs
+
+        Returns:
+            list(bool): whether each message is allowed
+        """
+        results = [True] * len(messages)
+        # key to (event type, indexes of messages waiting on that key)
+        pending = {}
+
+        for index, (event_type, device_id) in enumerate(messages):
+            if event_type not in self.limits:
+                continue
+
+            key = bucket_key(event_type, device_id)
+            if key in pending or not self._take_local(key):
+                pending.setdefault(key, (event_type, []))[1].append(index)
+
+        unused = self._take_unused()
+        if not pending and not unused:
+            return results
+
+        keys = list(pending)
+        requests = [(key, pending[key][0], self._lease_size_for(pending[key][0])) for key in keys]
+        requests.extend((key, event_type, -tokens) for key, event_type, tokens in unused)
+
+        try:
+            granted = self._take_redis(requests)
+        except RedisError:
+            # Fail open - losing data is worse than letting through a burst
+            logger.exception("Unable to check rate limits")
+            return results
+
+        for key, tokens in zip(keys, granted):
+            event_type, indexes = pending[key]
+
+            for index in indexes[tokens:]:
+                results[index] = False
+
+            # Keep anything left over for the next messages
+            self._store_lease(key, event_type, tokens - len(indexes))
+
+        return results
+
+    def admit(self, event_type, device_id):
+        """Check whether a single message is allowed"""
+        return self.admit_many([(event_type, device_id)])[0]
+
+
+_limiter = None
+
+
+def get_rate_limiter():
+    """Get the rate limiter for this process, configured from settings
+
+    Limits come from ZCONNECT_SETTINGS["LISTENER_SETTINGS"] and leasing from
+    DEMO_RATE_LIMITER.
+    """
+    global _limiter # pylint: disable=global-statement
+
+    if _limiter is None:
+        options = getattr(settings, "DEMO_RATE_LIMITER", {})
+        _limiter = TokenBucketLimiter.from_settings(
+            settings.ZCONNECT_SETTINGS["LISTENER_SETTINGS"],
+            lease_size=options.get("lease_size", 10),
+            lease_ttl=options.get("lease_ttl", 5.0),
+        )
+
+    return _limiter
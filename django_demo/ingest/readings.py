@@ -0,0 +1,109 @@
+from collections import namedtuple
+import datetime
+import json
+import logging
+import numbers
+
+logger = logging.getLogger(__name__)
+
+
+Reading = namedtuple("Reading", [
+    # id of the device which sent the reading
+    "device_id",
+    # datetime the reading was taken
+    "timestamp",
+    # dict of sensor name to value
+    "values",
+])
+
+
+def _numeric_values(data):
+    values = {}
+
+    for name, value in data.items():
+        # bool is a Number, so door/leak flags become 0.0/1.0
+        if isinstance(value, numbers.Number):
+            values[name] = float(value)
+
+    return values
+
+
+def reading_from_message(message):
+    """Convert a 'periodic' message from the listener into a Reading
+
+    The body of a periodic message is a dict of sensor name to value, either
+    at the top level or under a "data" key. Anything which isn't a number
+    (booleans are stored as 0/1) is ignored. As for reading_from_payload, a
+    "timestamp" in the body is used as the time of the reading, otherwise the
+    message's timestamp or the time it was received.
+
+    Args:
+        message (zconnect.messages.Message): message from the listener
+
+    Returns:
+        Reading: the reading
+    """
+    body = message.body or {}
+    if not isinstance(body, dict):
+        body = {}
+    data = body.get("data", body)
+
+    timestamp = (
+        _parse_timestamp(body.get("timestamp"))
+        or getattr(message, "timestamp", None)
+        or datetime.datetime.utcnow()
+    )
+
+    return Reading(
+        device_id=message.device.pk,
+        timestamp=timestamp,
+        values=_numeric_values(data),
+    )
+
+
+def _parse_timestamp(value):
+    if isinstance(value, numbers.Number):
+        return datetime.datetime.utcfromtimestamp(value)
+
+    if isinstance(value, str):
+        try:
+            return datetime.datetime.strptime(value[:26].rstrip("Z"), "%Y-%m-%dT%H:%M:%S.%f")
+        except ValueError:
+            try:
+                return datetime.datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+            except ValueError:
+                pass
+
+    return None
+
+
+def reading_from_payload(device_id, payload, received_at=None):
+    """Convert a raw periodic payload (as published by a device) into a Reading
+
+    The payload is JSON, in the same format as the body of a periodic message.
+    If it has a "timestamp" (unix time or ISO 8601, UTC) that is used as the
+    time of the reading, otherwise the time it was received.
+
+    Args:
+        device_id (int): id of the device, from the topic
+        payload (bytes): raw MQTT payload
+        received_at (datetime, optional): when the payload was received
+
+    Returns:
+        Reading: the reading
+
+    Raises:
+        ValueError: if the payload isn't valid JSON
+    """
+    body = json.loads(payload.decode("utf8") if isinstance(payload, bytes) else payload)
+    if not isinstance(body, dict):
+        raise ValueError("Expected a JSON object")
+
+    data = body.get("data", body)
+    timestamp = _parse_timestamp(body.get("timestamp")) or received_at or datetime.datetime.utcnow()
+
+    return Reading(
+        device_id=int(device_id),
+        timestamp=timestamp,
+        values=_numeric_values(data),
+    )
@@ -0,0 +1,329 @@
+"""Sharded, multi-process ingestion of periodic data
+
+One process (the dispatcher, which also supervises the workers) receives
+messages from a source (see :mod:`.sources`). It only looks at the topic to
+find the device id, drops messages from devices which don't exist (see
+:class:`KnownDevices`), and hands the raw payload to the worker process which
+owns that device on a consistent hash ring. Each worker decodes its messages
+and writes them through its own ingest buffer.
+
+Because every message for a device goes through the same queue to the same
+worker, which handles them in order, per-device ordering is preserved. Using a
+consistent hash ring means that changing the number of shards only moves
+about 1/N of the devices to a different worker.
+
+The supervisor restarts any worker which dies and periodically logs the lag
+of each shard - how many messages are waiting, and how long the message most
+recently handled had been queued for.
+
+Delivery is at most once. A message is acknowledged to the broker when the
+dispatcher has put it on a shard's queue, not when the reading is written:
+
+- messages still on the queue of a worker which dies are kept, and handled by
+  the restarted worker
+- the message a worker was handling when it died, and any readings in its
+  write-behind buffer which hadn't been flushed yet (up to ``batch_size``, or
+  ``max_delay`` seconds' worth), are lost
+- if a shard's queue is full the dispatcher waits for space, which stops the
+  MQTT client reading more messages so they stay with the broker. With
+  ``put_timeout`` set, the message is dropped once that has passed instead.
+- when stopping, workers which don't make space for the stop sentinel within
+  the timeout are terminated, losing whatever is still on their queues
+"""
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import queue
+import time
+
+from django import db
+
+logger = logging.getLogger(__name__)
+
+
+class HashRing:
+    """Consistent hash ring mapping device ids to shards
+
+    Args:
+        num_shards (int): number of shards
+        replicas (int): number of points on the ring per shard. More points
+            gives a more even distribution.
+    """
+
+    def __init__(self, num_shards, replicas=128):
+        self.num_shards = num_shards
+
+        points = []
+        for shard in range(num_shards):
+            for replica in range(replicas):
+                points.append((self._hash("shard-{}-{}".format(shard, replica)), shard))
+
+        points.sort()
+        self._hashes = [h for h, _ in points]
+        self._shards = [s for _, s in points]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(str(key).encode("utf8")).hexdigest()[:16], 16)
+
+    def shard_for(self, device_id):
+        index = bisect.bisect(self._hashes, self._hash(device_id)) % len(self._hashes)
+        return self._shards[index]
+
+
+class KnownDevices:
+    """Ids of the devices which exist, to drop messages from any others
+
+    The ids are loaded in one query and reloaded every ``max_age`` seconds, so
+    deleted devices are forgotten. An id which isn't known also causes a
+    reload, at most every ``min_reload`` seconds, so devices provisioned since
+    the last load are picked up quickly without a query for every message from
+    a device which doesn't exist.
+
+    Args:
+        max_age (float): seconds before the ids are reloaded
+        min_reload (float): minimum seconds between reloads for unknown ids
+    """
+
+    def __init__(self, max_age=300, min_reload=10):
+        self.max_age = max_age
+        self.min_reload = min_reload
+        self._ids = set()
+        self._loaded_at = None
+
+    def _load(self):
+        from ..models import DemoDevice
+        self._ids = set(DemoDevice.objects.values_list("pk", flat=True))
+        self._loaded_at = time.monotonic()
+
+    def __contains__(self, device_id):
+        age = None if self._loaded_at is None else time.monotonic() - self._loaded_at
+
+        if age is None or age >= self.max_age or (device_id not in self._ids and age >= self.min_reload):
+            self._load()
+
+        return device_id in self._ids
+
+
+def run_worker(shard, work_queue, processed, last_lag):
+    """Main loop for a shard worker process
+
+    Args:
+        shard (int): shard number, for logging
+        work_queue (multiprocessing.Queue): (device id, event type, payload,
+            enqueued_at) tuples. None means stop.
+        processed (multiprocessing.Value): count of handled messages
+        last_lag (multiprocessing.Value): seconds the last message was queued
+    """
+    from . import get_ingest_buffer, reading_from_payload
+    from .ratelimit import get_rate_limiter
+
+    # Don't share the parent's database connections
+    db.connections.close_all()
+
+    ingest_buffer = get_ingest_buffer()
+    rate_limiter = get_rate_limiter()
+    logger.info("Shard %d started", shard)
+
+    while True:
+        item = work_queue.get()
+        if item is None:
+            break
+
+        device_id, event_type, payload, enqueued_at = item
+
+        if not rate_limiter.admit(event_type, device_id):
+            logger.debug("Rate limited %s from device %s", event_type, device_id)
+        else:
+            try:
+                reading = reading_from_payload(device_id, payload)
+            except (ValueError, UnicodeError):
+                logger.warning("Invalid payload from device %s", device_id)
+            else:
+                # Batches are written in order by one flusher thread, so this
+                # doesn't reorder readings for a device
+                ingest_buffer.submit(reading, wait=False)
+
+        with processed.get_lock():
+            processed.value += 1
+        last_lag.value = time.time() - enqueued_at
+
+    ingest_buffer.flush_now()
+    logger.info("Shard %d stopped", shard)
+
+
+class Shard:
+    """A worker process and the queue of messages waiting for it
+
+    Args:
+        index (int): shard number
+        queue_size (int): maximum messages waiting
+        target (callable): main loop of the worker process, called with the
+            same arguments as run_worker
+    """
+
+    def __init__(self, index, queue_size, target=run_worker):
+        self.index = index
+        self.target = target
+        self.queue = multiprocessing.Queue(queue_size)
+        self.enqueued = 0
+        self.dropped = 0
+        self.restarts = 0
+        self.processed = multiprocessing.Value("L", 0)
+        self.last_lag = multiprocessing.Value("d", 0.0)
+        self.process = None
+
+    def start(self):
+        self.process = multiprocessing.Process(
+            target=self.target,
+            args=(self.index, self.queue, self.processed, self.last_lag),
+            name="ingest-shard-{}".format(self.index),
+            daemon=True,
+        )
+        self.process.start()
+
+    def stats(self):
+        return {
+            "shard": self.index,
+            "alive": bool(self.process and self.process.is_alive()),
+            "enqueued": self.enqueued,
+            "processed": self.processed.value,
+            "waiting": self.enqueued - self.processed.value,
+            "dropped": self.dropped,
+            "lag_seconds": round(self.last_lag.value, 3),
+            "restarts": self.restarts,
+        }
+
+
+class ShardedListener:
+    """Dispatch messages from a source to sharded worker processes
+
+    Args:
+        num_shards (int): number of worker processes
+        make_source (callable): called with an on_message(topic, payload)
+            callback, returns a source
+        queue_size (int): maximum messages waiting per shard. If a shard's
+            queue is full the dispatcher waits for space.
+        put_timeout (float, optional): seconds to wait for space in a shard
+            queue before dropping the message. By default it waits forever.
+        worker (callable): main loop of the worker processes
+        known_devices (container, optional): ids of devices whose messages are
+            handled. Defaults to a :class:`KnownDevices`.
+    """
+
+    def __init__(self, num_shards, make_source, queue_size=10000, put_timeout=None, worker=run_worker,
+                 known_devices=None):
+        from .sources import parse_topic
+        self._parse_topic = parse_topic
+
+        self.ring = HashRing(num_shards)
+        self.shards = [Shard(i, queue_size, worker) for i in range(num_shards)]
+        self.put_timeout = put_timeout
+        self.known_devices = KnownDevices() if known_devices is None else known_devices
+        self.unknown = 0
+        self.source = make_source(self.dispatch)
+        self._running = False
+
+    def dispatch(self, topic, payload):
+        device_id, event_type = self._parse_topic(topic)
+        if device_id is None:
+            logger.warning("Ignoring message on unexpected topic %s", topic)
+            return
+
+        try:
+            device_id = int(device_id)
+        except ValueError:
+            device_id = None
+
+        if device_id is None or device_id not in self.known_devices:
+            # Checked here rather than in the writer so they don't take up
+            # space in the shard queues and buffers
+            self.unknown += 1
+            logger.debug("Ignoring message from unknown device on %s", topic)
+            return
+
+        shard = self.shards[self.ring.shard_for(device_id)]
+
+        try:
+            shard.queue.put((device_id, event_type, payload, time.time()), timeout=self.put_timeout)
+        except queue.Full:
+            shard.dropped += 1
+            logger.error("Shard %d is full, dropping message from device %s", shard.index, device_id)
+        else:
+            shard.enqueued += 1
+
+    def stats(self):
+        return [shard.stats() for shard in self.shards]
+
+    def start(self):
+        # Children get their own connections
+        db.connections.close_all()
+
+        for shard in self.shards:
+            shard.start()
+
+        self.source.start()
+        self._running = True
+
+    def check_workers(self):
+        """Restart any workers which have died
+
+        Returns:
+            list(int): shards which were restarted
+        """
+        restarted = []
+
+        for shard in self.shards:
+            if not shard.process.is_alive():
+                logger.error("Shard %d died (exit code %s) - restarting", shard.index, shard.process.exitcode)
+                shard.restarts += 1
+                shard.start()
+                restarted.append(shard.index)
+
+        return restarted
+
+    def supervise(self, check_interval=1.0, report_interval=30.0):
+        """Restart dead workers and report lag until stop() is called"""
+        last_report = time.monotonic()
+
+        while self._running:
+            self.check_workers()
+
+            if time.monotonic() - last_report >= report_interval:
+                for shard_stats in self.stats():
+                    logger.info("Shard stats: %s", shard_stats)
+                last_report = time.monotonic()
+
+            time.sleep(check_interval)
+
+    def stop(self, timeout=30):
+        """Stop receiving messages, and stop the workers once they have handled
+        the messages already queued
+
+        Args:
+            timeout (float): seconds to wait for all the workers in total.
+                Workers which haven't stopped by then are terminated.
+        """
+        self._running = False
+        self.source.stop()
+
+        deadline = time.monotonic() + timeout
+
+        def remaining():
+            return max(0, deadline - time.monotonic())
+
+        for shard in self.shards:
+            try:
+                # If the queue is full this waits for the worker to make space
+                shard.queue.put(None, timeout=remaining())
+            except queue.Full:
+                logger.error("Shard %d queue still full after %ss - terminating it", shard.index, timeout)
+                shard.process.terminate()
+
+        for shard in self.shards:
+            shard.process.join(remaining())
+            if shard.process.is_alive():
+                logger.error("Shard %d didn't stop after %ss - terminating it", shard.index, timeout)
+                shard.process.terminate()
+                shard.process.join()
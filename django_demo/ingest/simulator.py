@@ -0,0 +1,218 @@
+"""Simulated fleet of fridges, for load testing ingestion locally
+
+Each virtual fridge publishes the same sensors as the seeded "Fridge
+simulator" device (see django_demo.seed) as a periodic event, with a
+timestamp of when it was published so the time until it is written can be
+measured. See the simulate_fleet management command.
+"""
+import heapq
+import json
+import random
+import threading
+import time
+
+from ..util.timestamps import to_unix
+from .sources import parse_topic
+
+# name: (starting value, random walk step, lower bound, upper bound)
+FRIDGE_ANALOGUE_SENSORS = {
+    "property_ambient_temp": (20.0, 0.2, 10.0, 35.0),
+    "process_box_temp": (5.0, 0.3, -2.0, 12.0),
+    "process_hot_coolant_temp": (45.0, 0.5, 30.0, 60.0),
+    "process_cold_coolant_temp": (-5.0, 0.5, -15.0, 5.0),
+    "process_current_in": (2.0, 0.1, 0.0, 5.0),
+    "property_set_point": (4.0, 0.0, 4.0, 4.0),
+    "process_thermostat": (4.0, 0.1, 2.0, 6.0),
+}
+
+# name: chance of being 1 in any message
+FRIDGE_FLAG_SENSORS = {
+    "property_door_opened": 0.05,
+    "property_hot_pipe_leak": 0.001,
+    "property_cold_pipe_leak": 0.001,
+}
+
+FRIDGE_SENSORS = sorted(list(FRIDGE_ANALOGUE_SENSORS) + list(FRIDGE_FLAG_SENSORS))
+
+
+def device_topic(device_id, event="periodic", device_type="sim-fridge"):
+    return "iot-2/type/{}/id/{}/evt/{}/fmt/json".format(device_type, device_id, event)
+
+
+def percentile(values, p):
+    """p (0-1) percentile of an already sorted list"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class VirtualFridge:
+    """Generates plausible periodic payloads for one fridge"""
+
+    def __init__(self, device_id, rng):
+        self.device_id = device_id
+        self.topic = device_topic(device_id)
+        self.rng = rng
+        self.values = {name: start for name, (start, _, _, _) in FRIDGE_ANALOGUE_SENSORS.items()}
+
+    def payload(self):
+        for name, (_, step, low, high) in FRIDGE_ANALOGUE_SENSORS.items():
+            value = self.values[name] + self.rng.uniform(-step, step)
+            self.values[name] = min(high, max(low, value))
+
+        data = {name: round(value, 2) for name, value in self.values.items()}
+        for name, chance in FRIDGE_FLAG_SENSORS.items():
+            data[name] = int(self.rng.random() < chance)
+
+        return json.dumps({
+            "timestamp": time.time(),
+            "data": data,
+        }).encode("utf8")
+
+
+class FleetSimulator:
+    """Publish periodic events for many fridges at a fixed rate each
+
+    Start times are spread over the first interval so the fleet publishes at
+    a steady overall rate instead of all at once.
+
+    Args:
+        publish (callable): called with (topic, payload)
+        device_ids (list(int)): devices to simulate
+        interval (float): seconds between messages from each device
+        seed (int, optional): random seed, for repeatable values
+    """
+
+    def __init__(self, publish, device_ids, interval, seed=None):
+        self.publish = publish
+        self.interval = interval
+        self.rng = random.Random(seed)
+        self.fridges = [VirtualFridge(device_id, self.rng) for device_id in device_ids]
+
+        self.published = 0
+        # Seconds publishing fell behind schedule, at most
+        self.max_behind = 0.0
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, duration):
+        """Publish until duration seconds have passed or stop() is called"""
+        start = time.monotonic()
+        end = start + duration
+
+        schedule = [
+            (start + self.rng.uniform(0, self.interval), i)
+            for i in range(len(self.fridges))
+        ]
+        heapq.heapify(schedule)
+
+        while schedule and not self._stop.is_set():
+            due, i = schedule[0]
+            if due >= end:
+                break
+
+            now = time.monotonic()
+            if due > now:
+                self._stop.wait(due - now)
+                continue
+
+            self.max_behind = max(self.max_behind, now - due)
+
+            fridge = self.fridges[i]
+            self.publish(fridge.topic, fridge.payload())
+            self.published += 1
+
+            heapq.heapreplace(schedule, (due + self.interval, i))
+
+
+class LatencyRecorder:
+    """Wrap a function which writes Readings to record how long they took
+
+    Latency is the time from the reading's timestamp (when the simulator
+    published it) until the write which stored it returned.
+
+    Args:
+        write (callable): writes a list of Readings
+    """
+
+    def __init__(self, write):
+        self.write = write
+        self.latencies = []
+        self.written = 0
+        self.first_write = None
+        self.last_write = None
+        self._lock = threading.Lock()
+
+    def __call__(self, readings):
+        self.write(readings)
+
+        now = time.time()
+        latencies = [now - to_unix(r.timestamp) for r in readings]
+
+        with self._lock:
+            self.latencies.extend(latencies)
+            self.written += len(readings)
+            if self.first_write is None:
+                self.first_write = now
+            self.last_write = now
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+
+        return {
+            "written": self.written,
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p95": percentile(latencies, 0.95),
+            "latency_p99": percentile(latencies, 0.99),
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
+
+
+class HandlerDispatcher:
+    """Pass device events from a broker to the registered message handlers
+
+    This does what the listener does with each message it receives: the
+    payload is decoded into a message from the device and given to the
+    handler registered for the event type (with zconnect's message_handler -
+    for periodic events that is django_demo.handlers.buffered_periodic_handler).
+    Events with no handler, from unknown devices or with invalid payloads are
+    counted in ``dropped``.
+
+    Args:
+        devices (dict): device id to device, for every device which publishes
+        handlers (dict, optional): event type to handler. Defaults to the
+            handlers registered with zconnect.
+        message_cls (type, optional): message passed to the handlers.
+            Defaults to zconnect.messages.Message.
+    """
+
+    def __init__(self, devices, handlers=None, message_cls=None):
+        if handlers is None:
+            from zconnect.registry import get_message_handlers
+            handlers = get_message_handlers()
+        if message_cls is None:
+            from zconnect.messages import Message
+            message_cls = Message
+
+        self.devices = devices
+        self.handlers = handlers
+        self.message_cls = message_cls
+        self.dropped = 0
+
+    def __call__(self, topic, payload):
+        device_id, event_type = parse_topic(topic)
+
+        try:
+            device = self.devices.get(int(device_id))
+            body = json.loads(payload.decode("utf8") if isinstance(payload, bytes) else payload)
+        except (TypeError, ValueError, UnicodeError):
+            device = body = None
+
+        handler = self.handlers.get(event_type)
+        if device is None or body is None or handler is None:
+            self.dropped += 1
+            return
+
+        handler(self.message_cls(category=event_type, body=body, device=device), None)
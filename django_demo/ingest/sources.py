@@ -0,0 +1,227 @@
+"""Sources of raw device messages for the sharded listener
+
+A source calls ``on_message(topic, payload)`` for every message it receives,
+from whatever thread it receives it in. Sources have ``start()`` and
+``stop()`` methods.
+"""
+import logging
+import queue
+import socket
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# iot-2/type/<device type>/id/<device id>/evt/<event>/fmt/<format>
+DEVICE_ID_TOPIC_INDEX = 4
+EVENT_TOPIC_INDEX = 6
+
+# Broker for an IBM Watson IoT organisation
+IBM_BROKER_HOST = "{org}.messaging.internetofthings.ibmcloud.com"
+
+
+def parse_topic(topic):
+    """Get the device id and event name from a device event topic
+
+    Returns:
+        tuple(str, str): device id and event name, or (None, None) if this isn't
+            a device event topic
+    """
+    parts = topic.split("/")
+    if len(parts) < 8 or parts[0] != "iot-2" or parts[3] != "id":
+        return None, None
+
+    return parts[DEVICE_ID_TOPIC_INDEX], parts[EVENT_TOPIC_INDEX]
+
+
+def broker_settings(listener_settings, group, client_id_suffix=""):
+    """Work out where to connect to, and as what, from the listener settings
+
+    If ``broker-url`` is set (eg, a local vernemq) it is used along with
+    ``full_client_id``, and a ``$share/<group>/`` subscription shares messages
+    between listeners.
+
+    Otherwise this is an IBM Watson IoT organisation, as in the integration
+    and production settings, which only give the ``org``. The host and client
+    id are derived from it the same way the IBM interface does - an
+    application client id is ``a:<org>:<id>``, or ``A:<org>:<id>`` for a
+    "shared" listener. IBM doesn't support ``$share`` subscriptions; instead
+    every shared client connecting with the same id gets a share of the
+    messages, so the group is used as the id and no suffix is added.
+
+    Returns:
+        dict: host, port, client_id and whether to use a $share subscription
+    """
+    if listener_settings.get("broker-url"):
+        return {
+            "host": listener_settings["broker-url"],
+            "port": listener_settings.get("port", 8883),
+            "client_id": listener_settings.get("full_client_id", socket.gethostname()) + client_id_suffix,
+            "share": True,
+        }
+
+    org = listener_settings["org"]
+    shared = listener_settings.get("type") == "shared"
+    app_id = group if shared else "{}{}".format(listener_settings.get("id", socket.gethostname()), client_id_suffix)
+
+    return {
+        "host": IBM_BROKER_HOST.format(org=org),
+        "port": listener_settings.get("port", 8883),
+        "client_id": "{}:{}:{}".format("A" if shared else "a", org, app_id),
+        "share": False,
+    }
+
+
+class MQTTSource:
+    """Receive device events from the broker with a shared subscription
+
+    Connection details are taken from ZCONNECT_SETTINGS["LISTENER_SETTINGS"]
+    (see :func:`broker_settings`).
+
+    The message is acknowledged (for QoS 1) when ``on_message`` returns.
+
+    Args:
+        on_message (callable): called with (topic, payload)
+        topic (str): topic filter to subscribe to
+        group (str): shared subscription group. Every listener in the same
+            group gets a share of the messages instead of all of them.
+        client_id_suffix (str): appended to the configured client id, so
+            multiple sources don't kick each other off the broker
+    """
+
+    def __init__(self, on_message, topic, group, client_id_suffix=""):
+        import paho.mqtt.client as mqtt # pylint: disable=import-error
+
+        listener_settings = settings.ZCONNECT_SETTINGS["LISTENER_SETTINGS"]
+        broker = broker_settings(listener_settings, group, client_id_suffix)
+
+        self.on_message = on_message
+        self.subscription = "$share/{}/{}".format(group, topic) if group and broker["share"] else topic
+        self.host = broker["host"]
+        self.port = broker["port"]
+
+        self.client = mqtt.Client(client_id=broker["client_id"], clean_session=False)
+        self.client.username_pw_set(listener_settings.get("auth-key"), listener_settings.get("auth-token"))
+        if not listener_settings.get("disable-tls", False):
+            self.client.tls_set()
+
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+
+    def _on_connect(self, client, userdata, flags, rc):
+        logger.info("Connected to %s:%s (rc=%s), subscribing to %s", self.host, self.port, rc, self.subscription)
+        client.subscribe(self.subscription, qos=1)
+
+    def _on_message(self, client, userdata, msg):
+        self.on_message(msg.topic, msg.payload)
+
+    def start(self):
+        self.client.connect(self.host, self.port)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def topic_matches(topic_filter, topic):
+    """Whether an MQTT topic filter (with + and # wildcards) matches a topic"""
+    filter_parts = topic_filter.split("/")
+    topic_parts = topic.split("/")
+
+    for i, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts):
+            return False
+        if part not in ("+", topic_parts[i]):
+            return False
+
+    return len(filter_parts) == len(topic_parts)
+
+
+class LocalBroker:
+    """In-process stand-in for the MQTT broker, for load testing
+
+    Published messages are queued and delivered to subscribers from a single
+    delivery thread, in the order they were published, like messages from a
+    real broker arriving on the MQTT client's network thread.
+
+    Args:
+        max_queued (int): published messages waiting for delivery before
+            publish() blocks. 0 is unlimited.
+    """
+
+    def __init__(self, max_queued=0):
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._subscribers = []
+        self._thread = None
+
+        self.published = 0
+        self.delivered = 0
+
+    def subscribe(self, topic_filter, on_message):
+        self._subscribers.append((topic_filter, on_message))
+
+    def unsubscribe(self, on_message):
+        self._subscribers = [s for s in self._subscribers if s[1] is not on_message]
+
+    def publish(self, topic, payload):
+        self._queue.put((topic, payload))
+        self.published += 1
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="local-broker", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Deliver what has been published and stop"""
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            if message is None:
+                break
+
+            topic, payload = message
+            for topic_filter, on_message in self._subscribers:
+                if topic_matches(topic_filter, topic):
+                    try:
+                        on_message(topic, payload)
+                    except Exception: # pylint: disable=broad-except
+                        logger.exception("Error handling message on %s", topic)
+
+            self.delivered += 1
+
+
+class LocalBrokerSource:
+    """Receive device events from a LocalBroker
+
+    Has the same interface as MQTTSource, so it can be used by the sharded
+    listener or anything else which takes a source.
+
+    Args:
+        on_message (callable): called with (topic, payload)
+        topic (str): topic filter to subscribe to
+        broker (LocalBroker): broker to subscribe to
+    """
+
+    def __init__(self, on_message, topic, broker):
+        self.on_message = on_message
+        self.topic = topic
+        self.broker = broker
+
+    def start(self):
+        self.broker.subscribe(self.topic, self.on_message)
+        self.broker.start()
+
+    def stop(self):
+        self.broker.unsubscribe(self.on_message)
@@ -0,0 +1,285 @@
+"""Write a batch of readings with a few bulk statements
+
+For a batch of readings from any number of devices this does:
+
+- at most one query to look up device sensors which haven't been seen before,
+  and a few more to create any which are missing (see DeviceSensorCache)
+- one bulk insert of all the TimeSeriesData, and a few statements to update
+  the 15 minute and 6 hour rollups of the readings in the same transaction
+  (see django_demo.rollups). If inserting fails, each device's readings are
+  retried in their own transaction, so one bad device doesn't lose the
+  readings of every other device in the batch
+- one pipelined redis call to record last_seen for all the devices in the
+  batch. The devices themselves are updated periodically, see
+  django_demo.presence.
+- one pipelined redis call to update the latest/recent values of each
+  sensor, see django_demo.sensor_store
+
+and then evaluates event definitions against the readings (see
+django_demo.events).
+"""
+from collections import defaultdict
+import logging
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+
+from zconnect.zc_timeseries.models import DeviceSensor, SensorType, TimeSeriesData
+
+from .. import device_cache, events, presence, rollups, sensor_store
+from ..models import DemoDevice
+from .readings import Reading
+
+logger = logging.getLogger(__name__)
+
+# Rows per INSERT statement
+INSERT_BATCH_SIZE = 1000
+
+
+class PartialWriteError(Exception):
+    """Readings for some devices in a batch couldn't be written
+
+    The readings for every other device were written as normal.
+
+    Attributes:
+        device_ids (set(int)): devices whose readings weren't written
+    """
+
+    def __init__(self, device_ids):
+        super().__init__("Readings for devices {} couldn't be written".format(sorted(device_ids)))
+        self.device_ids = device_ids
+
+
+def sensor_resolution():
+    """Resolution given to device sensors created by the writer"""
+    return getattr(settings, "DEMO_INGEST", {}).get("sensor_resolution", 900)
+
+
+class DeviceSensorCache:
+    """Cache of (device id, sensor name) to DeviceSensor id
+
+    A device which sends a reading for a sensor its product has a SensorType
+    for, but which it doesn't have a DeviceSensor for yet, has one created.
+    Readings for sensors which aren't in the product at all are ignored.
+
+    Entries are removed when a DeviceSensor is saved or deleted, or its device
+    is deleted (see django_demo.handlers). Other processes only find out when
+    inserting readings for a deleted sensor fails, at which point the writer
+    clears the entries for the failing devices.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+    def invalidate(self, device_ids):
+        device_ids = set(device_ids)
+        with self._lock:
+            for key in [k for k in self._ids if k[0] in device_ids]:
+                del self._ids[key]
+
+    def _load(self, keys):
+        sensors = DeviceSensor.objects.filter(
+            device_id__in={device_id for device_id, _ in keys},
+            sensor_type__sensor_name__in={name for _, name in keys},
+        ).values_list("id", "device_id", "sensor_type__sensor_name")
+
+        return {(device_id, name): pk for pk, device_id, name in sensors if (device_id, name) in keys}
+
+    def _create(self, keys):
+        """Create DeviceSensors for these keys, where the device's product has
+        a matching SensorType
+
+        Returns:
+            bool: whether any were created
+        """
+        products = dict(
+            DemoDevice.objects.filter(pk__in={device_id for device_id, _ in keys}).values_list("id", "product_id")
+        )
+        sensor_types = {
+            (product_id, name): pk for pk, product_id, name in SensorType.objects.filter(
+                product_id__in=set(products.values()),
+                sensor_name__in={name for _, name in keys},
+            ).values_list("id", "product_id", "sensor_name")
+        }
+
+        new = [
+            DeviceSensor(
+                device_id=device_id,
+                sensor_type_id=sensor_types[(products[device_id], name)],
+                resolution=sensor_resolution(),
+            )
+            for device_id, name in keys
+            if (products.get(device_id), name) in sensor_types
+        ]
+        if not new:
+            return False
+
+        try:
+            with transaction.atomic():
+                DeviceSensor.objects.bulk_create(new)
+        except IntegrityError:
+            # Created by another writer at the same time
+            logger.info("Device sensors already created for %s", sorted(keys))
+        else:
+            logger.info("Created %d device sensors", len(new))
+
+        return True
+
+    def get_many(self, keys):
+        """Look up DeviceSensor ids
+
+        Args:
+            keys (set(tuple)): (device id, sensor name) pairs
+
+        Returns:
+            dict: (device id, sensor name) to DeviceSensor id, for the sensors
+                which exist
+        """
+        with self._lock:
+            found = {k: self._ids[k] for k in keys if k in self._ids}
+
+        missing = keys - set(found)
+        if missing:
+            loaded = self._load(missing)
+
+            not_created = missing - set(loaded)
+            if not_created and self._create(not_created):
+                loaded.update(self._load(not_created))
+
+            with self._lock:
+                self._ids.update(loaded)
+
+            found.update(loaded)
+
+        return found
+
+
+sensor_cache = DeviceSensorCache()
+
+
+def _roll_up(rows):
+    """Add readings to the rollups, in the transaction which inserted them
+
+    Readings and rollups have to be committed together. Otherwise another
+    writer recomputing a bucket for a late reading could count these readings
+    before they are merged into the same bucket here, counting them twice.
+
+    If updating the rollups fails only the savepoint for it is rolled back, so
+    the readings are still inserted.
+    """
+    try:
+        rollups.update([(row.sensor_id, row.ts, row.value) for row in rows])
+    except Exception: # pylint: disable=broad-except
+        # As for events - the readings are stored. The buckets are recorded
+        # and recomputed later by the repair_rollups task.
+        logger.exception("Error updating rollups for %d readings", len(rows))
+
+
+def _insert(rows):
+    """Insert readings and add them to the rollups, one device at a time if
+    inserting them all fails
+
+    Args:
+        rows (dict): device id to list of TimeSeriesData
+
+    Returns:
+        set(int): devices whose readings couldn't be inserted
+    """
+    try:
+        with transaction.atomic():
+            all_rows = [row for device_rows in rows.values() for row in device_rows]
+            TimeSeriesData.objects.bulk_create(all_rows, batch_size=INSERT_BATCH_SIZE)
+            _roll_up(all_rows)
+        return set()
+    except DatabaseError:
+        logger.exception("Error inserting readings for %d devices, retrying each device", len(rows))
+
+    failed = set()
+    for device_id, device_rows in rows.items():
+        try:
+            with transaction.atomic():
+                TimeSeriesData.objects.bulk_create(device_rows, batch_size=INSERT_BATCH_SIZE)
+                _roll_up(device_rows)
+        except DatabaseError:
+            logger.exception("Error inserting %d readings for device %s", len(device_rows), device_id)
+            failed.add(device_id)
+
+    # eg, a sensor was deleted in another process
+    sensor_cache.invalidate(failed)
+
+    return failed
+
+
+def write_readings(readings):
+    """Write a batch of readings
+
+    Args:
+        readings (list(Reading)): readings from any number of devices
+
+    Raises:
+        PartialWriteError: if the readings for some devices couldn't be
+            inserted. Everything else has been done for the rest.
+    """
+    keys = {(r.device_id, name) for r in readings for name in r.values}
+    sensor_ids = sensor_cache.get_many(keys)
+
+    device_rows = defaultdict(list)
+    stored = []
+    last_seen = {}
+    unknown = set()
+
+    for reading in readings:
+        values = {}
+
+        for name, value in reading.values.items():
+            try:
+                sensor_id = sensor_ids[(reading.device_id, name)]
+            except KeyError:
+                unknown.add((reading.device_id, name))
+                continue
+
+            device_rows[reading.device_id].append(
+                TimeSeriesData(sensor_id=sensor_id, ts=reading.timestamp, value=value)
+            )
+            values[name] = value
+
+        stored.append(Reading(reading.device_id, reading.timestamp, values))
+
+        previous = last_seen.get(reading.device_id)
+        if previous is None or reading.timestamp > previous:
+            last_seen[reading.device_id] = reading.timestamp
+
+    if unknown:
+        logger.warning("Ignoring readings for unknown sensors: %s", sorted(unknown))
+
+    failed = _insert(device_rows)
+    if failed:
+        stored = [r for r in stored if r.device_id not in failed]
+        last_seen = {d: ts for d, ts in last_seen.items() if d not in failed}
+
+    rows = [row for device_id, r in device_rows.items() if device_id not in failed for row in r]
+
+    presence.record_heartbeats(last_seen)
+    sensor_store.record(stored)
+
+    # bulk_create doesn't send any signals. This bumps the devices' state
+    # versions as well.
+    device_ids = list(last_seen)
+    device_cache.invalidate(device_ids)
+
+    logger.debug("Wrote %d readings for %d devices", len(rows), len(device_ids))
+
+    try:
+        events.process_readings(stored)
+    except Exception: # pylint: disable=broad-except
+        # The readings are stored - don't fail (and retry) the whole batch
+        logger.exception("Error evaluating events for %d readings", len(stored))
+
+    if failed:
+        raise PartialWriteError(failed)
@@ -0,0 +1,104 @@
+"""Measure per-request middleware overhead for API and browser requests
+
+Compares the full middleware stack (everything in MIDDLEWARE and
+DEMO_BROWSER_MIDDLEWARE run for every request, as it was before
+BrowserOnlyMiddleware) with the current MIDDLEWARE, using a view which does
+nothing so that only the middleware is measured.
+
+    ./manage.py benchmark_middleware --requests 20000
+"""
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from django_demo.middleware import MiddlewareChain
+
+# What MIDDLEWARE was before the browser only middleware was split out
+FULL_MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'corsheaders.middleware.CorsMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'django.middleware.csrf.CsrfViewMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+]
+
+
+def noop_view(request):
+    return HttpResponse(b"{}", content_type="application/json")
+
+
+def build_handler(middleware_paths):
+    """Build a handler which calls the view hooks like BaseHandler does"""
+    chain = None
+
+    def get_response(request):
+        response = chain.process_view(request, noop_view, (), {})
+        return response or noop_view(request)
+
+    chain = MiddlewareChain(middleware_paths, get_response)
+    return chain
+
+
+def time_requests(handler, make_request, num_requests):
+    """Returns microseconds per request"""
+    requests = [make_request() for _ in range(num_requests)]
+
+    start = time.perf_counter()
+    for request in requests:
+        handler(request)
+    elapsed = time.perf_counter() - start
+
+    return elapsed / num_requests * 1e6
+
+
+class Command(BaseCommand):
+    help = "Benchmark middleware overhead before and after splitting out the browser middleware"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=10000,
+                            help="Number of requests to time for each case")
+
+    def handle(self, *args, **options):
+        num_requests = options["requests"]
+        factory = RequestFactory()
+        host = settings.ALLOWED_HOSTS[0] if settings.ALLOWED_HOSTS and settings.ALLOWED_HOSTS[0] != "*" \
+            else "testserver"
+
+        cases = {
+            "api (bearer token)": lambda: factory.get(
+                "/api/v3/devices/",
+                HTTP_AUTHORIZATION="Bearer abc.def.ghi",
+                HTTP_HOST=host,
+                secure=True,
+            ),
+            "browser (/admin/)": lambda: factory.get(
+                "/admin/",
+                HTTP_HOST=host,
+                secure=True,
+            ),
+        }
+
+        handlers = {
+            "before": build_handler(FULL_MIDDLEWARE),
+            "after": build_handler(settings.MIDDLEWARE),
+        }
+
+        self.stdout.write("{:<22} {:>12} {:>12} {:>10}".format("request", "before (us)", "after (us)", "speedup"))
+
+        for name, make_request in cases.items():
+            # warm up
+            for handler in handlers.values():
+                time_requests(handler, make_request, min(100, num_requests))
+
+            before = time_requests(handlers["before"], make_request, num_requests)
+            after = time_requests(handlers["after"], make_request, num_requests)
+
+            self.stdout.write("{:<22} {:>12.1f} {:>12.1f} {:>9.2f}x".format(
+                name, before, after, before / after,
+            ))
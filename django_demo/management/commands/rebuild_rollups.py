@@ -0,0 +1,32 @@
+"""Rebuild sensor rollups from the raw readings
+
+Rollups are kept up to date as readings are ingested, but readings stored
+before rollups were added (or if updating them failed) need filling in.
+
+    ./manage.py rebuild_rollups
+    ./manage.py rebuild_rollups --sensor 12 --sensor 13 --days 7
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from django_demo import rollups
+from django_demo.util.timestamps import from_unix
+
+
+class Command(BaseCommand):
+    help = "Rebuild sensor rollups from the raw readings"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sensor", type=int, action="append", dest="sensors",
+                            help="DeviceSensor id to rebuild (default all)")
+        parser.add_argument("--days", type=float,
+                            help="Only rebuild this many days back (default everything)")
+
+    def handle(self, *args, **options):
+        start = None
+        if options["days"] is not None:
+            start = from_unix(time.time() - options["days"] * 24 * 60 * 60)
+
+        written = rollups.rebuild(options["sensors"], start)
+        self.stdout.write("Wrote {} rollups".format(written))
@@ -0,0 +1,56 @@
+"""Run the sharded periodic data listener
+
+See django_demo.ingest.sharding. Settings are taken from
+DEMO_SHARDED_LISTENER, and can be overridden on the command line:
+
+    ./manage.py run_sharded_listener --shards 8
+"""
+import logging
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from django_demo.ingest.sharding import ShardedListener
+from django_demo.ingest.sources import MQTTSource
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Run the sharded, multi-process periodic data listener"
+
+    def add_arguments(self, parser):
+        options = getattr(settings, "DEMO_SHARDED_LISTENER", {})
+
+        parser.add_argument("--shards", type=int, default=options.get("shards", 4),
+                            help="Number of worker processes")
+        parser.add_argument("--queue-size", type=int, default=options.get("queue_size", 10000),
+                            help="Maximum messages waiting per shard")
+        parser.add_argument("--put-timeout", type=float, default=options.get("put_timeout"),
+                            help="Seconds to wait for space in a shard's queue before dropping a message "
+                                 "(default: wait forever)")
+        parser.add_argument("--report-interval", type=float, default=options.get("report_interval", 30),
+                            help="Seconds between logging shard lag")
+        parser.add_argument("--topic", default=options.get("topic", "iot-2/type/+/id/+/evt/periodic/fmt/json"),
+                            help="Topic filter to subscribe to")
+        parser.add_argument("--group", default=options.get("group", "demo-ingest"),
+                            help="Shared subscription group")
+
+    def handle(self, *args, **options):
+        listener = ShardedListener(
+            options["shards"],
+            lambda on_message: MQTTSource(on_message, options["topic"], options["group"], ":dispatcher"),
+            queue_size=options["queue_size"],
+            put_timeout=options["put_timeout"],
+        )
+
+        def shutdown(signum, frame):
+            logger.info("Stopping sharded listener")
+            listener.stop()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        listener.start()
+        listener.supervise(report_interval=options["report_interval"])
@@ -0,0 +1,154 @@
+"""Simulate a fleet of fridges to measure ingestion throughput and latency
+
+Creates (or reuses) N devices of the seeded fridge product, each with the
+fridge sensors, then publishes periodic events for all of them into an
+in-process broker stand-in. Each event is decoded and given to the registered
+message handler, as the listener does, which puts it on the same ingest
+pipeline that the listener uses. The time from each message being published
+until it was committed is recorded.
+
+The fridge product is created by django_demo/seed.py:
+
+    DJANGO_SETTINGS_MODULE=django_demo.settings.development python django_demo/seed.py
+    ./manage.py simulate_fleet --devices 1000 --interval 1 --duration 60
+
+Devices created are named "Fleet simulator <n>" and are kept between runs.
+"""
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+from zconnect.models import Product
+from zconnect.zc_timeseries.models import DeviceSensor, SensorType
+
+from django_demo.ingest import IngestPipeline, use_ingest_pipeline, write_readings
+from django_demo.ingest.pipeline import OVERFLOW_POLICIES
+from django_demo.ingest.simulator import (
+    FRIDGE_SENSORS, FleetSimulator, HandlerDispatcher, LatencyRecorder)
+from django_demo.ingest.sources import LocalBroker, LocalBrokerSource
+from django_demo.models import DemoDevice
+
+DEVICE_NAME_PREFIX = "Fleet simulator "
+
+
+def get_fleet(product, count):
+    """Get ids of count simulated devices, creating any which don't exist"""
+    existing = list(
+        DemoDevice.objects.filter(product=product, name__startswith=DEVICE_NAME_PREFIX)
+        .order_by("id")
+        .values_list("id", flat=True)[:count]
+    )
+    if len(existing) >= count:
+        return existing
+
+    sensor_types = list(SensorType.objects.filter(product=product, sensor_name__in=FRIDGE_SENSORS))
+
+    devices = [
+        DemoDevice(product=product, name="{}{}".format(DEVICE_NAME_PREFIX, i), online=False)
+        for i in range(len(existing), count)
+    ]
+
+    with transaction.atomic():
+        if connection.features.can_return_ids_from_bulk_insert:
+            DemoDevice.objects.bulk_create(devices)
+        else:
+            for device in devices:
+                device.save(force_insert=True)
+
+        DeviceSensor.objects.bulk_create([
+            DeviceSensor(device=device, sensor_type=sensor_type, resolution=900)
+            for device in devices
+            for sensor_type in sensor_types
+        ])
+
+    return existing + [device.id for device in devices]
+
+
+class Command(BaseCommand):
+    help = "Simulate a fleet of fridges publishing periodic data and measure ingestion"
+
+    def add_arguments(self, parser):
+        options = getattr(settings, "DEMO_INGEST", {})
+
+        parser.add_argument("--devices", type=int, default=100,
+                            help="Number of fridges to simulate")
+        parser.add_argument("--interval", type=float, default=1.0,
+                            help="Seconds between messages from each fridge")
+        parser.add_argument("--duration", type=float, default=30.0,
+                            help="Seconds to publish for")
+        parser.add_argument("--product", default="sim-fridge",
+                            help="iot_name of the product to create devices for")
+        parser.add_argument("--seed", type=int, default=None,
+                            help="Random seed for sensor values")
+        parser.add_argument("--writers", type=int, default=options.get("writers", 2),
+                            help="Number of ingest writers")
+        parser.add_argument("--queue-size", type=int, default=options.get("queue_size", 10000),
+                            help="Ingest queue size")
+        parser.add_argument("--overflow", choices=OVERFLOW_POLICIES, default=options.get("overflow", "block"),
+                            help="What to do when the ingest queue is full")
+
+    def handle(self, *args, **options):
+        try:
+            product = Product.objects.get(iot_name=options["product"])
+        except Product.DoesNotExist:
+            raise CommandError("No product '{}' - seed the database first".format(options["product"]))
+
+        device_ids = get_fleet(product, options["devices"])
+        devices = DemoDevice.objects.only("id", "product_id").in_bulk(device_ids)
+
+        ingest_options = getattr(settings, "DEMO_INGEST", {})
+        recorder = LatencyRecorder(write_readings)
+        pipeline = IngestPipeline(
+            recorder,
+            writers=options["writers"],
+            queue_size=options["queue_size"],
+            overflow=options["overflow"],
+            batch_size=ingest_options.get("batch_size", 500),
+            max_delay=ingest_options.get("max_delay", 0.5),
+        )
+        # The message handlers put readings on this pipeline
+        use_ingest_pipeline(pipeline)
+
+        dispatcher = HandlerDispatcher(devices)
+        broker = LocalBroker()
+        source = LocalBrokerSource(dispatcher, "iot-2/type/+/id/+/evt/periodic/fmt/json", broker)
+        simulator = FleetSimulator(broker.publish, device_ids, options["interval"], seed=options["seed"])
+
+        self.stdout.write("Simulating {} devices, one message every {}s each ({:.0f} messages/s) for {}s".format(
+            len(device_ids), options["interval"], len(device_ids) / options["interval"], options["duration"],
+        ))
+
+        pipeline.start()
+        source.start()
+
+        # The broker delivers one message at a time, so the handler mustn't
+        # wait for each write - latency is measured by the recorder instead
+        with override_settings(DEMO_INGEST=dict(ingest_options, ack_before_write=True)):
+            start = time.time()
+            simulator.run(options["duration"])
+            published = time.time()
+
+            # Wait for everything to be delivered and written
+            broker.stop()
+            pipeline.stop()
+            source.stop()
+            finished = time.time()
+
+        summary = recorder.summary()
+        stats = pipeline.stats()
+
+        self.stdout.write("published:         {}".format(simulator.published))
+        self.stdout.write("written:           {}".format(summary["written"]))
+        self.stdout.write("dropped:           {}".format(dispatcher.dropped))
+        self.stdout.write("shed / spilled:    {} / {}".format(stats["shed"], stats["spilled"]))
+        self.stdout.write("failed:            {}".format(stats["failed"]))
+        self.stdout.write("publish lag (max): {:.3f}s".format(simulator.max_behind))
+        self.stdout.write("drain time:        {:.2f}s".format(finished - published))
+        self.stdout.write("throughput:        {:.1f} readings/s".format(summary["written"] / (finished - start)))
+        self.stdout.write("latency p50:       {:.1f}ms".format(summary["latency_p50"] * 1000))
+        self.stdout.write("latency p95:       {:.1f}ms".format(summary["latency_p95"] * 1000))
+        self.stdout.write("latency p99:       {:.1f}ms".format(summary["latency_p99"] * 1000))
+        self.stdout.write("latency max:       {:.1f}ms".format(summary["latency_max"] * 1000))
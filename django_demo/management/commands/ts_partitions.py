@@ -0,0 +1,69 @@
+"""Manage time partitions of the readings table (PostgreSQL only)
+
+    ./manage.py ts_partitions list
+    ./manage.py ts_partitions convert
+    ./manage.py ts_partitions create --premake 8
+    ./manage.py ts_partitions detach zc_timeseries_timeseriesdata_p20180101
+    ./manage.py ts_partitions drop zc_timeseries_timeseriesdata_p20180101
+    ./manage.py ts_partitions expire
+
+See django_demo.partitions
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from zconnect.models import Product
+
+from django_demo import partitions
+
+
+class Command(BaseCommand):
+    help = "Manage time partitions of the readings table"
+
+    def add_arguments(self, parser):
+        parser.add_argument("operation", choices=["list", "convert", "create", "detach", "drop", "expire"])
+        parser.add_argument("name", nargs="?",
+                            help="Partition to detach or drop")
+        parser.add_argument("--premake", type=int,
+                            help="Partitions to create ahead of the current one")
+
+    def handle(self, *args, **options):
+        if not partitions.enabled():
+            raise CommandError("Partitioning needs DEMO_TS_PARTITIONS['enabled'] and a PostgreSQL database")
+
+        operation = options["operation"]
+        now = time.time()
+
+        if operation == "convert":
+            if partitions.is_partitioned():
+                raise CommandError("Readings are already partitioned")
+            partitions.convert_table(now)
+            self.stdout.write("Converted readings table")
+            return
+
+        if not partitions.is_partitioned():
+            raise CommandError("Readings aren't partitioned yet - run 'ts_partitions convert' first")
+
+        if operation == "list":
+            for name, start, end in partitions.list_partitions():
+                self.stdout.write("{} {:%Y-%m-%d} - {:%Y-%m-%d}".format(name, start, end))
+        elif operation == "create":
+            created = partitions.ensure_partitions(now, options["premake"])
+            self.stdout.write("Created {} partitions".format(len(created)))
+        elif operation in ("detach", "drop"):
+            if not options["name"]:
+                raise CommandError("A partition name is needed to {}".format(operation))
+            if operation == "detach":
+                partitions.detach_partition(options["name"])
+                self.stdout.write("Detached {}".format(options["name"]))
+            else:
+                try:
+                    rows = partitions.drop_partition(options["name"])
+                except ValueError as e:
+                    raise CommandError(str(e))
+                self.stdout.write("Dropped {}, about {} readings".format(options["name"], rows))
+        elif operation == "expire":
+            retentions = list(Product.objects.values_list("periodic_data_retention_short", flat=True))
+            dropped = partitions.drop_expired(now, retentions)
+            self.stdout.write("Dropped {} partitions, about {} readings".format(len(dropped), sum(dropped.values())))
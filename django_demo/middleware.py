@@ -0,0 +1,119 @@
+"""Run the 'browser' middleware only for requests which need it
+
+Token authenticated API requests don't use sessions, CSRF protection, the
+messages framework or X-Frame-Options, but by default every request goes
+through all of them. BrowserOnlyMiddleware wraps the middleware listed in
+``settings.DEMO_BROWSER_MIDDLEWARE`` and skips it for requests to one of
+``settings.DEMO_LEAN_PATH_PREFIXES`` which have a Bearer token. Everything else
+(admin, django.contrib.auth.urls, session authenticated API requests) goes
+through the full stack as before.
+
+It should be the last entry in ``settings.MIDDLEWARE`` - the wrapped
+middleware runs in the same place as if it was listed there directly.
+"""
+import logging
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.exception import convert_exception_to_response
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class MiddlewareChain:
+    """A chain of middleware, loaded in the same way as BaseHandler does
+
+    Calling the chain runs the request through all the middleware. The view
+    hooks (process_view etc.) are collected so that they can be called by
+    whatever calls the view.
+    """
+
+    def __init__(self, middleware_paths, get_response):
+        self.view_middleware = []
+        self.template_response_middleware = []
+        self.exception_middleware = []
+
+        handler = get_response
+
+        for middleware_path in reversed(middleware_paths):
+            middleware = import_string(middleware_path)
+            try:
+                instance = middleware(handler)
+            except MiddlewareNotUsed:
+                continue
+
+            if hasattr(instance, "process_view"):
+                self.view_middleware.insert(0, instance.process_view)
+            if hasattr(instance, "process_template_response"):
+                self.template_response_middleware.append(instance.process_template_response)
+            if hasattr(instance, "process_exception"):
+                self.exception_middleware.append(instance.process_exception)
+
+            handler = convert_exception_to_response(instance)
+
+        self.handler = handler
+
+    def __call__(self, request):
+        return self.handler(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        for hook in self.view_middleware:
+            response = hook(request, view_func, view_args, view_kwargs)
+            if response is not None:
+                return response
+        return None
+
+    def process_template_response(self, request, response):
+        for hook in self.template_response_middleware:
+            response = hook(request, response)
+        return response
+
+    def process_exception(self, request, exception):
+        for hook in self.exception_middleware:
+            response = hook(request, exception)
+            if response is not None:
+                return response
+        return None
+
+
+def is_lean_request(request):
+    """Whether this is a token authenticated API request"""
+    prefixes = getattr(settings, "DEMO_LEAN_PATH_PREFIXES", ())
+    if not request.path_info.startswith(tuple(prefixes)):
+        return False
+
+    return request.META.get("HTTP_AUTHORIZATION", "").startswith("Bearer ")
+
+
+class BrowserOnlyMiddleware:
+    """Only run DEMO_BROWSER_MIDDLEWARE for requests which aren't lean"""
+
+    # Set on the request if the browser middleware was skipped
+    lean_attr = "_demo_lean_request"
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.browser_chain = MiddlewareChain(settings.DEMO_BROWSER_MIDDLEWARE, get_response)
+
+    def __call__(self, request):
+        if is_lean_request(request):
+            setattr(request, self.lean_attr, True)
+            return self.get_response(request)
+
+        return self.browser_chain(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(request, self.lean_attr, False):
+            return None
+        return self.browser_chain.process_view(request, view_func, view_args, view_kwargs)
+
+    def process_template_response(self, request, response):
+        if getattr(request, self.lean_attr, False):
+            return response
+        return self.browser_chain.process_template_response(request, response)
+
+    def process_exception(self, request, exception):
+        if getattr(request, self.lean_attr, False):
+            return None
+        return self.browser_chain.process_exception(request, exception)
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_demo', '0005_remove_orgs_and_mapping'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='demodevice',
+            options={'default_permissions': ['view', 'change', 'add', 'delete'], 'ordering': ['product', 'id']},
+        ),
+        migrations.AddIndex(
+            model_name='demodevice',
+            index=models.Index(fields=['product', 'id'], name='demodevice_product_id_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zc_timeseries', '0001_initial'),
+        ('django_demo', '0006_device_keyset_ordering'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SensorRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.IntegerField()),
+                ('bucket', models.DateTimeField()),
+                ('count', models.IntegerField()),
+                ('sum', models.FloatField()),
+                ('min', models.FloatField()),
+                ('max', models.FloatField()),
+                ('last', models.FloatField()),
+                ('last_ts', models.DateTimeField()),
+                ('sensor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='zc_timeseries.DeviceSensor')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='sensorrollup',
+            unique_together={('sensor', 'resolution', 'bucket')},
+        ),
+    ]
@@ -0,0 +1,170 @@
+"""Keyset (cursor) pagination
+
+``zconnect.pagination.StandardPagination`` uses LIMIT/OFFSET, so the database
+has to walk past every row before the requested page and deep pages get slower
+as the table grows. Keyset pagination instead remembers the sort key of the
+last row on a page and asks for rows strictly after it, which can be answered
+from an index in the same time for every page.
+
+This is opt-in per request - pass ``?pagination=cursor`` (or a ``cursor``
+returned by a previous page) to a view using :class:`KeysetPaginationMixin`.
+"""
+import base64
+import binascii
+from collections import OrderedDict
+import json
+import logging
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+logger = logging.getLogger(__name__)
+
+
+class KeysetPagination(BasePagination):
+    """Paginate on a unique, indexed, composite key
+
+    The view should set ``keyset_ordering`` to a tuple of field attnames which
+    is unique across the queryset (ending with the primary key is the easiest
+    way to guarantee this), and which has a matching index.
+
+    Only a ``next`` link is returned - there is no count and no way to jump to
+    an arbitrary page, as both of those require an OFFSET scan.
+    """
+
+    cursor_query_param = "cursor"
+    mode_query_param = "pagination"
+    mode_query_value = "cursor"
+
+    page_size = settings.REST_FRAMEWORK["PAGE_SIZE"]
+    page_size_query_param = "page_size"
+    # Large enough for bulk sync clients to pull the fleet in a few requests
+    max_page_size = 1000
+
+    ordering = ("id",)
+
+    def __init__(self):
+        self.base_url = None
+        self.next_position = None
+
+    @classmethod
+    def requested(cls, request):
+        """Whether keyset pagination was asked for in this request"""
+        if request is None:
+            return False
+
+        params = request.query_params
+        return (cls.cursor_query_param in params) or \
+            (params.get(cls.mode_query_param) == cls.mode_query_value)
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size,
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def encode_cursor(self, position):
+        raw = json.dumps(position, separators=(",", ":")).encode("utf8")
+        return base64.urlsafe_b64encode(raw).decode("ascii")
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            position = json.loads(base64.urlsafe_b64decode(encoded.encode("ascii")).decode("utf8"))
+        except (TypeError, ValueError, UnicodeError, binascii.Error) as e:
+            raise NotFound("Invalid cursor") from e
+
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound("Invalid cursor")
+
+        return position
+
+    def after(self, position):
+        """Filter for rows which sort strictly after the given position
+
+        For ordering (a, b, c) this is:
+
+            a >= A AND (a > A OR (a = A AND b > B) OR (a = A AND b = B AND c > C))
+
+        The leading ``a >= A`` is redundant, but lets the planner use it as
+        the start of an index range scan.
+        """
+        expanded = Q()
+        for i, field in enumerate(self.ordering):
+            term = Q(**{"{}__gt".format(field): position[i]})
+            for prev_field, prev_value in zip(self.ordering[:i], position[:i]):
+                term &= Q(**{prev_field: prev_value})
+            expanded |= term
+
+        return Q(**{"{}__gte".format(self.ordering[0]): position[0]}) & expanded
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.ordering = getattr(view, "keyset_ordering", self.ordering)
+        self.base_url = request.build_absolute_uri()
+
+        page_size = self.get_page_size(request)
+        position = self.decode_cursor(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        if position is not None:
+            queryset = queryset.filter(self.after(position))
+
+        # Fetch one extra row to find out if there is a next page without
+        # doing a count
+        results = list(queryset[:page_size + 1])
+
+        if len(results) > page_size:
+            results = results[:page_size]
+            last = results[-1]
+            self.next_position = [getattr(last, field) for field in self.ordering]
+        else:
+            self.next_position = None
+
+        return results
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+
+        url = replace_query_param(self.base_url, self.mode_query_param, self.mode_query_value)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ("next", self.get_next_link()),
+            ("previous", None),
+            ("results", data),
+        ]))
+
+
+class KeysetPaginationMixin:
+    """Use KeysetPagination on a view when the request asks for it
+
+    Otherwise the view's normal ``pagination_class`` is used.
+    """
+
+    keyset_pagination_class = KeysetPagination
+    keyset_ordering = ("id",)
+
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            if self.keyset_pagination_class.requested(self.request):
+                self._paginator = self.keyset_pagination_class()
+            elif self.pagination_class is None:
+                self._paginator = None
+            else:
+                self._paginator = self.pagination_class()
+
+        return self._paginator
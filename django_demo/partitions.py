@@ -0,0 +1,382 @@
+"""Optional PostgreSQL range partitioning of readings by time
+
+With DEMO_TS_PARTITIONS["enabled"] set (and a PostgreSQL 11+ database), the
+readings table is converted into a table partitioned by ``ts``, with one
+partition per ``interval_days`` (a week by default). Indexes and vacuuming
+then work per partition rather than on one ever-growing table.
+
+- ``convert_table`` copies the existing table into a partitioned one, once.
+  Run it with ``./manage.py ts_partitions convert`` during a maintenance
+  window, as it locks the table while copying.
+- ``ensure_partitions`` creates partitions for the current interval and
+  ``premake`` more ahead of it. It is run daily by the maintain_partitions
+  task. Readings outside every partition go into a default partition, so
+  inserts never fail if it falls behind. Any readings in the default
+  partition which belong in a new partition are moved into it when it is
+  created.
+- ``drop_expired`` detaches and drops partitions which are entirely older
+  than every product's retention period (see django_demo.retention).
+
+Partition bounds are read from the catalog rather than worked out from the
+partition names, so changing ``interval_days`` doesn't affect existing
+partitions.
+
+Queries don't need to change - PostgreSQL prunes partitions using the ``ts``
+conditions that every readings query has.
+"""
+from collections import OrderedDict
+import datetime
+import logging
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from zconnect.zc_timeseries.models import TimeSeriesData
+
+from .util.timestamps import EPOCH, from_unix, to_unix
+
+logger = logging.getLogger(__name__)
+
+PARTITION_DATE_FORMAT = "%Y%m%d"
+
+
+def get_options():
+    options = {
+        "enabled": False,
+        "interval_days": 7,
+        "premake": 4,
+    }
+    options.update(getattr(settings, "DEMO_TS_PARTITIONS", {}))
+    return options
+
+
+def table_name():
+    return TimeSeriesData._meta.db_table
+
+
+def default_partition_name():
+    return "{}_default".format(table_name())
+
+
+def partition_name(start):
+    return "{}_p{}".format(table_name(), start.strftime(PARTITION_DATE_FORMAT))
+
+
+def is_partition_name(name):
+    """Whether a table name has the form given by partition_name"""
+    return re.match(r"^{}_p\d{{8}}$".format(re.escape(table_name())), name) is not None
+
+
+def enabled():
+    """Whether readings should be partitioned"""
+    return get_options()["enabled"] and connection.vendor == "postgresql"
+
+
+def is_partitioned():
+    """Whether the readings table has been converted"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+            "WHERE c.relname = %s AND pg_table_is_visible(c.oid)",
+            [table_name()],
+        )
+        return cursor.fetchone() is not None
+
+
+def interval_start(when, interval_days):
+    """Start of the partition a datetime is in
+
+    Partitions start on Mondays at midnight UTC (or every interval_days days
+    from 1970-01-05, the first Monday after the epoch)
+    """
+    first_monday = 4 * 24 * 60 * 60
+    interval = interval_days * 24 * 60 * 60
+    unix = to_unix(when)
+    return _utc(first_monday + ((unix - first_monday) // interval) * interval)
+
+
+def _utc(unix):
+    return EPOCH + datetime.timedelta(seconds=unix)
+
+
+def _literal(ts):
+    return "{}+00".format(ts.strftime("%Y-%m-%d %H:%M:%S"))
+
+
+# As output by pg_get_expr for a range partition of a timestamptz column, eg
+# FOR VALUES FROM ('2018-03-05 00:00:00+00') TO ('2018-03-12 00:00:00+00')
+_BOUND_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+_TIMESTAMP_RE = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)(\.\d+)?(?:([+-])(\d\d)(?::?(\d\d))?)?$")
+
+
+def _parse_timestamp(value):
+    """Parse a timestamp literal from a partition bound as naive UTC"""
+    match = _TIMESTAMP_RE.match(value)
+    if not match:
+        raise ValueError("Unexpected partition bound {}".format(value))
+
+    seconds, fraction, sign, hours, minutes = match.groups()
+    parsed = datetime.datetime.strptime(seconds, "%Y-%m-%d %H:%M:%S")
+    if fraction:
+        parsed += datetime.timedelta(seconds=float(fraction))
+    if sign:
+        offset = datetime.timedelta(hours=int(hours), minutes=int(minutes or 0))
+        parsed = parsed - offset if sign == "+" else parsed + offset
+
+    return parsed
+
+
+def _parse_bound(bound):
+    """Start and end of a partition from its bound expression
+
+    Returns:
+        tuple(datetime, datetime): start and end as naive UTC, or None for the
+            default partition (or anything which isn't a plain time range)
+    """
+    match = _BOUND_RE.search(bound or "")
+    if not match:
+        return None
+
+    return _parse_timestamp(match.group(1)), _parse_timestamp(match.group(2))
+
+
+def list_partitions():
+    """Time partitions of the readings table
+
+    Returns:
+        list(tuple(str, datetime, datetime)): name, start and end (as naive
+            UTC), oldest first. The default partition isn't included.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) FROM pg_inherits i "
+            "JOIN pg_class parent ON parent.oid = i.inhparent "
+            "JOIN pg_class child ON child.oid = i.inhrelid "
+            "WHERE parent.relname = %s AND pg_table_is_visible(parent.oid)",
+            [table_name()],
+        )
+        rows = cursor.fetchall()
+
+    partitions = []
+    for name, bound in rows:
+        bounds = _parse_bound(bound)
+        if bounds is not None:
+            partitions.append((name,) + bounds)
+
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def create_partition(start):
+    """Create the partition starting at a time, if it doesn't exist
+
+    Readings in the default partition which belong in the new partition are
+    moved into it in the same transaction - PostgreSQL won't create a
+    partition for a range which the default partition has rows in.
+
+    Returns:
+        bool: whether it was created
+    """
+    name = partition_name(start)
+    end = start + datetime.timedelta(days=get_options()["interval_days"])
+
+    for existing, existing_start, existing_end in list_partitions():
+        if existing == name:
+            return False
+        if existing_start < end and start < existing_end:
+            # eg, interval_days was changed
+            logger.warning(
+                "Not creating readings partition %s, it would overlap %s (%s - %s)",
+                name, existing, existing_start, existing_end,
+            )
+            return False
+
+    quote = connection.ops.quote_name
+    default = default_partition_name()
+    moved_table = "{}_moving".format(name)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", [default])
+        has_default = cursor.fetchone()[0] is not None
+
+        moved = 0
+        if has_default:
+            # Stop new readings going into the default partition until the
+            # partition exists
+            cursor.execute("LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE".format(quote(default)))
+            cursor.execute("CREATE TEMPORARY TABLE {} (LIKE {})".format(quote(moved_table), quote(table_name())))
+            cursor.execute(
+                "WITH moved AS (DELETE FROM {} WHERE ts >= %s AND ts < %s RETURNING *) "
+                "INSERT INTO {} SELECT * FROM moved".format(quote(default), quote(moved_table)),
+                [_literal(start), _literal(end)],
+            )
+            moved = cursor.rowcount
+
+        cursor.execute("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ('{}') TO ('{}')".format(
+            quote(name), quote(table_name()), _literal(start), _literal(end),
+        ))
+
+        if has_default:
+            cursor.execute("INSERT INTO {} SELECT * FROM {}".format(quote(table_name()), quote(moved_table)))
+            cursor.execute("DROP TABLE {}".format(quote(moved_table)))
+
+    logger.info("Created readings partition %s, moving %d readings from the default partition", name, moved)
+    return True
+
+
+def ensure_partitions(now, premake=None):
+    """Create partitions from the one ``now`` is in to ``premake`` ahead
+
+    Returns:
+        list(str): partitions created
+    """
+    options = get_options()
+    premake = options["premake"] if premake is None else premake
+    interval = datetime.timedelta(days=options["interval_days"])
+
+    start = interval_start(from_unix(now), options["interval_days"])
+    created = []
+    for i in range(premake + 1):
+        if create_partition(start + i * interval):
+            created.append(partition_name(start + i * interval))
+
+    return created
+
+
+def convert_table(now):
+    """Convert the readings table into a partitioned table
+
+    The existing table is renamed, a partitioned table with the same columns
+    is created, partitions are made for all the existing readings and they
+    are copied across. Run once, while nothing is writing readings.
+    """
+    options = get_options()
+    quote = connection.ops.quote_name
+    table = table_name()
+    old = "{}_unpartitioned".format(table)
+    sensor_column = TimeSeriesData._meta.get_field("sensor").column
+    sensor_table = TimeSeriesData._meta.get_field("sensor").related_model._meta.db_table
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE".format(quote(table)))
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+        sequence = cursor.fetchone()[0]
+        cursor.execute("SELECT min(ts) FROM {}".format(quote(table)))
+        oldest = cursor.fetchone()[0]
+
+        cursor.execute("ALTER TABLE {} RENAME TO {}".format(quote(table), quote(old)))
+        cursor.execute(
+            "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+            "PARTITION BY RANGE (ts)".format(quote(table), quote(old))
+        )
+        # The partition key has to be part of the primary key. ids still come
+        # from the same sequence, so they stay unique.
+        cursor.execute("ALTER TABLE {} ADD PRIMARY KEY (id, ts)".format(quote(table)))
+        cursor.execute("ALTER TABLE {} ADD FOREIGN KEY ({}) REFERENCES {} (id) DEFERRABLE INITIALLY DEFERRED".format(
+            quote(table), quote(sensor_column), quote(sensor_table),
+        ))
+        cursor.execute("CREATE INDEX ON {} ({}, ts)".format(quote(table), quote(sensor_column)))
+        cursor.execute("CREATE INDEX ON {} (ts)".format(quote(table)))
+        cursor.execute("CREATE TABLE {} PARTITION OF {} DEFAULT".format(
+            quote(default_partition_name()), quote(table),
+        ))
+
+        start = interval_start(from_unix(now), options["interval_days"])
+        if oldest is not None:
+            start = min(start, interval_start(oldest, options["interval_days"]))
+        interval = datetime.timedelta(days=options["interval_days"])
+        last = interval_start(from_unix(now), options["interval_days"]) + options["premake"] * interval
+        while start <= last:
+            create_partition(start)
+            start += interval
+
+        cursor.execute("INSERT INTO {} SELECT * FROM {}".format(quote(table), quote(old)))
+        if sequence:
+            cursor.execute("ALTER SEQUENCE {} OWNED BY {}.id".format(sequence, quote(table)))
+        cursor.execute("DROP TABLE {}".format(quote(old)))
+
+    logger.info("Converted %s to a partitioned table", table)
+
+
+def detach_partition(name):
+    """Detach a partition, leaving its readings in a separate table"""
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute("ALTER TABLE {} DETACH PARTITION {}".format(quote(table_name()), quote(name)))
+    logger.info("Detached readings partition %s", name)
+
+
+def estimated_rows(name):
+    """Number of rows in a table, as estimated by the last ANALYZE
+
+    Counting the rows in a partition which is about to be dropped would mean
+    reading all of it, which is what dropping it instead of deleting the
+    rows avoids.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)", [name])
+        row = cursor.fetchone()
+
+    # -1 if it has never been analyzed (PostgreSQL 14+)
+    return max(0, int(row[0])) if row else 0
+
+
+def _drop_table(name, attached):
+    if attached:
+        detach_partition(name)
+
+    rows = estimated_rows(name)
+
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS {}".format(connection.ops.quote_name(name)))
+    logger.info("Dropped readings partition %s (about %d readings)", name, rows)
+
+    return rows
+
+
+def drop_partition(name):
+    """Drop a partition (detaching it first if needed)
+
+    Only time partitions of the readings table can be dropped - either one
+    which is currently attached, or a detached table with a partition name
+    (see partition_name).
+
+    Returns:
+        int: estimated number of readings it had
+
+    Raises:
+        ValueError: if name isn't a readings partition
+    """
+    attached = name in {p[0] for p in list_partitions()}
+    if not attached and not is_partition_name(name):
+        raise ValueError("{} is not a readings partition".format(name))
+
+    return _drop_table(name, attached)
+
+
+def drop_expired(now, retentions):
+    """Drop partitions older than every product's retention period
+
+    Partitions hold readings for every product, so they can only be dropped
+    once they have expired for the product which keeps readings longest.
+    Readings for products with shorter retention are still deleted in batches.
+
+    Args:
+        now (float): unix time
+        retentions (list(int)): retention period of every product, in
+            seconds. 0 means keep forever.
+
+    Returns:
+        OrderedDict: name of each partition dropped, oldest first, to the
+            estimated number of readings it had (see estimated_rows)
+    """
+    dropped = OrderedDict()
+    if not retentions or not all(retentions):
+        return dropped
+
+    cutoff = _utc(now - max(retentions))
+    for name, _, end in list_partitions():
+        if end <= cutoff:
+            dropped[name] = _drop_table(name, attached=True)
+
+    return dropped
@@ -0,0 +1,309 @@
+"""Device last_seen/online tracking in redis
+
+Heartbeats (any reading from a device) are recorded in a redis sorted set of
+device id to the unix time it was last seen, instead of updating the device
+row for every batch of readings. The API reads last_seen and online from the
+sorted set, so it is always up to date, and the database is only brought up
+to date periodically by ``flush`` (see django_demo.tasks):
+
+- devices seen since the last flush are kept in a 'dirty' set, and their
+  last_seen/online are written with one UPDATE
+- devices which have gone offline since the last sweep are found with a
+  range query on the sorted set - those whose last heartbeat is between the
+  previous and current cutoff times - rather than by scanning all devices.
+
+A device is online if it was seen in the last
+REDIS["online_status_threshold_mins"] minutes.
+
+last_seen only ever moves forward - a batch of late readings (eg, from a
+device catching up after being offline) doesn't overwrite a newer heartbeat.
+
+If redis can't be reached, heartbeats are written straight to the database
+and reads use last_seen/online from the database, which are then as up to
+date as they can be.
+"""
+import logging
+import math
+import time
+
+from django.conf import settings
+from django.db.models import BooleanField, Case, DateTimeField, Value, When
+from redis.exceptions import RedisError
+from rest_framework import serializers
+
+from . import device_cache
+from .models import DemoDevice
+from .util import redis_util
+from .util.timestamps import from_unix, to_unix
+
+logger = logging.getLogger(__name__)
+
+LAST_SEEN_KEY = "demo_device_last_seen"
+DIRTY_KEY = "demo_device_presence_dirty"
+# Cutoff time used by the last sweep
+SWEPT_KEY = "demo_device_presence_swept"
+
+# KEYS[1]: sorted set, ARGV: member, score pairs
+# Sets the score of each member unless it already has a higher one
+MAX_ZADD_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    local current = redis.call("ZSCORE", KEYS[1], ARGV[i])
+    if not current or tonumber(current) < tonumber(ARGV[i + 1]) then
+        redis.call("ZADD", KEYS[1], ARGV[i + 1], ARGV[i])
+    end
+end
+return 1
+"""
+
+# Whether the redis client can run Lua scripts
+_use_lua = True
+
+
+def threshold_seconds():
+    return settings.REDIS.get("online_status_threshold_mins", 10) * 60
+
+
+def record_heartbeats(last_seen):
+    """Record when devices were last seen
+
+    Args:
+        last_seen (dict): device id to datetime
+    """
+    if not last_seen:
+        return
+
+    scores = {str(pk): to_unix(ts) for pk, ts in last_seen.items()}
+
+    try:
+        _max_zadd(redis_util.get_redis(), scores)
+    except RedisError:
+        logger.exception("Unable to record heartbeats in redis - writing them to the database")
+        _write_direct(last_seen)
+
+
+def _max_zadd(client, scores):
+    """Raise the last_seen of devices and mark them as dirty, with one round
+    trip"""
+    global _use_lua # pylint: disable=global-statement
+
+    if _use_lua:
+        try:
+            pipe = client.pipeline(transaction=False)
+            client.register_script(MAX_ZADD_SCRIPT)(
+                keys=[LAST_SEEN_KEY],
+                args=[v for member, score in scores.items() for v in (member, score)],
+                client=pipe,
+            )
+            pipe.sadd(DIRTY_KEY, *scores)
+            pipe.execute()
+            return
+        except (ImportError, NotImplementedError, AttributeError, TypeError) as e:
+            logger.warning("Redis client can't run Lua scripts (%s) - recording heartbeats in python", e)
+            _use_lua = False
+
+    # Same as MAX_ZADD_SCRIPT, without atomicity
+    pipe = client.pipeline(transaction=False)
+    for member in scores:
+        pipe.zscore(LAST_SEEN_KEY, member)
+    current = dict(zip(scores, pipe.execute()))
+
+    newer = {m: s for m, s in scores.items() if current[m] is None or current[m] < s}
+    pipe = client.pipeline(transaction=False)
+    if newer:
+        pipe.zadd(LAST_SEEN_KEY, **newer)
+    pipe.sadd(DIRTY_KEY, *scores)
+    pipe.execute()
+
+
+def _write_direct(last_seen):
+    """Write last_seen/online to the database, without going through redis"""
+    online_after = time.time() - threshold_seconds()
+
+    # Don't move last_seen backwards here either
+    current = dict(DemoDevice.objects.filter(pk__in=list(last_seen)).values_list("pk", "last_seen"))
+    values = {
+        pk: (to_unix(ts), to_unix(ts) > online_after)
+        for pk, ts in last_seen.items()
+        if pk in current and (current[pk] is None or to_unix(current[pk]) < to_unix(ts))
+    }
+
+    if values:
+        _write(list(values), values)
+
+
+def get_many(device_ids, now=None):
+    """Current last_seen/online for some devices, with one redis round trip
+
+    Returns:
+        dict: device id to (last_seen datetime, online), for devices which have
+            been seen. Empty if redis can't be reached.
+    """
+    if not device_ids:
+        return {}
+
+    try:
+        pipe = redis_util.get_redis().pipeline(transaction=False)
+        for pk in device_ids:
+            pipe.zscore(LAST_SEEN_KEY, str(pk))
+        scores = pipe.execute()
+    except RedisError:
+        # The values in the database are used instead
+        logger.exception("Unable to read last_seen for %d devices from redis", len(device_ids))
+        return {}
+
+    online_after = (now or time.time()) - threshold_seconds()
+
+    return {
+        pk: (from_unix(score), score > online_after)
+        for pk, score in zip(device_ids, scores)
+        if score is not None
+    }
+
+
+def validator_states(states, device_ids, now=None):
+    """Add last_seen/online to device states, for conditional GETs
+
+    The API reads last_seen/online from redis (see overlay), so they change
+    without a device's state version changing - a device goes offline just by
+    not sending anything. This adds them to each device's version, and moves
+    changed_at to when they last changed if that is later.
+
+    Args:
+        states (dict): device id to (version, changed_at), from
+            conditional.get_device_states
+        device_ids (list(int)): devices
+
+    Returns:
+        dict: device id to (version, changed_at)
+    """
+    combined = dict(states)
+
+    for pk, (last_seen, online) in get_many(device_ids, now).items():
+        version, changed_at = states.get(pk, (0, 0))
+        seen_at = to_unix(last_seen)
+        # It went offline threshold_seconds after it was last seen
+        presence_changed_at = seen_at if online else seen_at + threshold_seconds()
+        combined[pk] = (
+            "{}:{}:{:d}".format(version, seen_at, online),
+            max(changed_at, int(math.ceil(presence_changed_at))),
+        )
+
+    return combined
+
+
+def overlay(rows, ids=None):
+    """Replace last_seen/online in serialized devices with the values in redis
+
+    Rows which don't have those fields (sparse fieldsets), or devices which
+    haven't been seen since redis was last emptied, are left alone - as are
+    all of them if redis can't be reached.
+
+    Args:
+        rows (list(dict)): serialized devices
+        ids (list(int), optional): id of the device for each row. Needed if
+            the rows might not include "id" (eg, ``?fields=name,online``).
+
+    Returns:
+        list(dict): the same rows
+    """
+    if ids is None:
+        ids = [row["id"] for row in rows]
+
+    wanted = [i for i, row in zip(ids, rows) if "last_seen" in row or "online" in row]
+    current = get_many(wanted)
+
+    if current:
+        last_seen_field = serializers.DateTimeField()
+
+        for device_id, row in zip(ids, rows):
+            if device_id not in current:
+                continue
+
+            last_seen, online = current[device_id]
+            if "last_seen" in row:
+                row["last_seen"] = last_seen_field.to_representation(last_seen)
+            if "online" in row:
+                row["online"] = online
+
+    return rows
+
+
+def _take_dirty():
+    pipe = redis_util.get_redis().pipeline()
+    pipe.smembers(DIRTY_KEY)
+    pipe.delete(DIRTY_KEY)
+    members, _ = pipe.execute()
+    return sorted(int(m) for m in members)
+
+
+def _write(device_ids, values):
+    """Write last_seen/online for devices and invalidate anything cached"""
+    whens_seen = [When(pk=pk, then=Value(from_unix(score))) for pk, (score, _) in values.items()]
+    whens_online = [When(pk=pk, then=Value(online)) for pk, (_, online) in values.items()]
+
+    DemoDevice.objects.filter(pk__in=device_ids).update(
+        last_seen=Case(*whens_seen, output_field=DateTimeField()),
+        online=Case(*whens_online, output_field=BooleanField()),
+    )
+
+    device_cache.invalidate(device_ids)
+
+
+def flush(now=None):
+    """Write last_seen/online to the database for devices seen since the last
+    flush
+
+    Returns:
+        int: number of devices updated
+    """
+    device_ids = _take_dirty()
+    if not device_ids:
+        return 0
+
+    pipe = redis_util.get_redis().pipeline(transaction=False)
+    for pk in device_ids:
+        pipe.zscore(LAST_SEEN_KEY, str(pk))
+    scores = pipe.execute()
+
+    online_after = (now or time.time()) - threshold_seconds()
+    values = {
+        pk: (score, score > online_after)
+        for pk, score in zip(device_ids, scores)
+        if score is not None
+    }
+
+    if values:
+        _write(list(values), values)
+
+    logger.debug("Flushed presence for %d devices", len(values))
+    return len(values)
+
+
+def sweep_offline(now=None):
+    """Mark devices which have stopped sending data as offline
+
+    Returns:
+        list(int): ids of devices which went offline
+    """
+    r = redis_util.get_redis()
+
+    cutoff = (now or time.time()) - threshold_seconds()
+    previous = r.getset(SWEPT_KEY, cutoff)
+
+    # Everything last seen before the previous cutoff was dealt with by the
+    # previous sweep
+    low = "({}".format(float(previous)) if previous is not None else "-inf"
+    went_offline = sorted(int(m) for m in r.zrangebyscore(LAST_SEEN_KEY, low, cutoff))
+
+    if went_offline:
+        DemoDevice.objects.filter(pk__in=went_offline, online=True).update(online=False)
+        device_cache.invalidate(went_offline)
+
+    logger.debug("%d devices went offline", len(went_offline))
+    return went_offline
+
+
+def forget(device_ids):
+    """Remove devices from the sorted set, eg when they are deleted"""
+    if device_ids:
+        redis_util.get_redis().zrem(LAST_SEEN_KEY, *[str(pk) for pk in device_ids])
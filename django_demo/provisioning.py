@@ -0,0 +1,283 @@
+"""Bulk device provisioning
+
+Provisions many devices in one request, using a handful of set based
+statements inside a single transaction instead of a full
+CreateDemoDeviceSerializer round trip per device:
+
+- one query to check all the referenced products exist
+- one query to check all the referenced orgs exist (and that the user can
+  assign devices to them)
+- two queries to load the devices being updated and find which of them the
+  user can change
+- a bulk insert for new devices
+- one UPDATE per changed column for updated devices
+- one DELETE and one bulk insert for the org through table
+- one bulk insert for object permissions on the new devices
+
+Items are validated individually and any errors are returned per item - valid
+items are still written. Devices are only updated if the user can change
+them (having ``change_demodevice`` for all devices or on the device itself -
+seeing a device isn't enough) and only created if the user has
+``add_demodevice``. Otherwise the item fails with a 403.
+
+A device's product can't be changed once it is created, as with the device
+serializer.
+"""
+import logging
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import Case, Value, When
+from django.utils import timezone
+from guardian.models import UserObjectPermission
+from organizations.models import Organization
+from rest_framework import serializers
+
+from zconnect.models import Product
+
+from . import device_cache, events
+from .models import DemoDevice
+
+logger = logging.getLogger(__name__)
+
+# Columns which can be set when creating devices through the bulk endpoint
+BULK_FIELDS = ("name", "product", "sim_number", "fw_version")
+# Columns which can be changed on existing devices. product is read only on
+# DemoDeviceSerializer, so it is here as well.
+BULK_UPDATE_FIELDS = ("name", "sim_number", "fw_version")
+
+# Object permissions given to the user who creates a device
+CREATOR_PERMISSIONS = ("view", "change", "delete")
+
+
+class BulkDeviceItemSerializer(serializers.Serializer):
+    """One device in a bulk request
+
+    Related objects are only validated as ids here - whether they exist is
+    checked for the whole batch at once in :func:`bulk_provision`
+    """
+
+    id = serializers.IntegerField(required=False)
+    name = serializers.CharField(max_length=50, required=False)
+    product = serializers.IntegerField(required=False)
+    sim_number = serializers.CharField(max_length=25, required=False, allow_blank=True)
+    fw_version = serializers.CharField(max_length=50, required=False, allow_blank=True)
+    orgs = serializers.ListField(child=serializers.IntegerField(), required=False)
+
+    def validate(self, attrs):
+        if "id" not in attrs:
+            missing = [f for f in ("name", "product") if f not in attrs]
+            if missing:
+                raise serializers.ValidationError({
+                    f: ["This field is required."] for f in missing
+                })
+        elif "product" in attrs:
+            raise serializers.ValidationError({
+                "product": ["The product of an existing device can't be changed."],
+            })
+
+        return attrs
+
+
+def _assignable_org_ids(user, org_ids):
+    orgs = Organization.objects.filter(pk__in=org_ids)
+    if not user.is_superuser:
+        orgs = orgs.filter(users=user)
+    return set(orgs.values_list("pk", flat=True))
+
+
+def _validate_items(items, user, access, visible_devices):
+    """Validate all items
+
+    Returns:
+        tuple(dict, dict): index to validated data, index to (status code,
+            errors)
+    """
+    valid = {}
+    errors = {}
+
+    for index, item in enumerate(items):
+        serializer = BulkDeviceItemSerializer(data=item)
+        if serializer.is_valid():
+            valid[index] = serializer.validated_data
+        else:
+            errors[index] = (400, serializer.errors)
+
+    can_add = access.can_add()
+    update_ids = {v["id"] for v in valid.values() if "id" in v}
+    known_devices = set(visible_devices.filter(pk__in=update_ids).values_list("pk", flat=True))
+    changeable = set(
+        access.filter_changeable(visible_devices).filter(pk__in=known_devices).values_list("pk", flat=True)
+    )
+
+    for index, data in list(valid.items()):
+        if "id" not in data and not can_add:
+            errors[index] = (403, {"non_field_errors": ["You do not have permission to add devices."]})
+        elif "id" in data and data["id"] in known_devices and data["id"] not in changeable:
+            errors[index] = (403, {"id": ["You do not have permission to change this device."]})
+        else:
+            continue
+        del valid[index]
+
+    product_ids = {v["product"] for v in valid.values() if "product" in v}
+    org_ids = {o for v in valid.values() for o in v.get("orgs", [])}
+
+    known_products = set(Product.objects.filter(pk__in=product_ids).values_list("pk", flat=True))
+    known_orgs = _assignable_org_ids(user, org_ids)
+
+    for index, data in list(valid.items()):
+        if "id" in data and data["id"] not in known_devices:
+            errors[index] = (404, {"id": ["Not found."]})
+            del valid[index]
+            continue
+
+        item_errors = {}
+
+        if "product" in data and data["product"] not in known_products:
+            item_errors["product"] = ["Invalid pk \"{}\" - object does not exist.".format(data["product"])]
+
+        bad_orgs = [o for o in data.get("orgs", []) if o not in known_orgs]
+        if bad_orgs:
+            item_errors["orgs"] = ["Invalid pk \"{}\" - object does not exist.".format(o) for o in bad_orgs]
+
+        if item_errors:
+            errors[index] = (400, item_errors)
+            del valid[index]
+
+    return valid, errors
+
+
+def _create_devices(to_create):
+    """Insert new devices, returning them with their pks set"""
+    devices = [
+        DemoDevice(
+            product_id=data["product"],
+            **{f: data[f] for f in BULK_FIELDS if f in data and f != "product"}
+        )
+        for data in to_create
+    ]
+
+    if connection.features.can_return_ids_from_bulk_insert:
+        return DemoDevice.objects.bulk_create(devices)
+
+    # eg sqlite - no way to get the ids back from a bulk insert
+    for device in devices:
+        device.save(force_insert=True)
+    return devices
+
+
+def _update_devices(to_update):
+    """Update existing devices with one UPDATE per changed column"""
+    for field in BULK_UPDATE_FIELDS:
+        changes = {data["id"]: data[field] for data in to_update if field in data}
+        if not changes:
+            continue
+
+        DemoDevice.objects.filter(pk__in=list(changes)).update(**{
+            field: Case(
+                *[When(pk=pk, then=Value(value)) for pk, value in changes.items()],
+                output_field=DemoDevice._meta.get_field(field)
+            ),
+        })
+
+    DemoDevice.objects.filter(pk__in=[data["id"] for data in to_update]).update(
+        updated_at=timezone.now(),
+    )
+
+
+def _set_orgs(device_orgs):
+    """Replace the orgs for devices
+
+    Args:
+        device_orgs (dict): device id to list of org ids
+    """
+    if not device_orgs:
+        return
+
+    orgs_field = DemoDevice._meta.get_field("orgs")
+    through = orgs_field.remote_field.through
+    device_column = "{}_id".format(orgs_field.m2m_field_name())
+    org_column = "{}_id".format(orgs_field.m2m_reverse_field_name())
+
+    through.objects.filter(**{"{}__in".format(device_column): list(device_orgs)}).delete()
+    through.objects.bulk_create([
+        through(**{device_column: device_id, org_column: org_id})
+        for device_id, org_ids in device_orgs.items()
+        for org_id in set(org_ids)
+    ])
+
+
+def _grant_creator_permissions(user, devices):
+    content_type = ContentType.objects.get_for_model(DemoDevice)
+    permissions = content_type.permission_set.filter(
+        codename__in=["{}_{}".format(p, DemoDevice._meta.model_name) for p in CREATOR_PERMISSIONS],
+    )
+
+    UserObjectPermission.objects.bulk_create([
+        UserObjectPermission(
+            user=user,
+            permission=permission,
+            content_type=content_type,
+            object_pk=str(device.pk),
+        )
+        for device in devices
+        for permission in permissions
+    ])
+
+
+def bulk_provision(items, user, access, visible_devices):
+    """Create or update many devices at once
+
+    Items with an ``id`` update that device, anything else creates a new one.
+    If ``orgs`` is given it replaces the device's orgs.
+
+    Args:
+        items (list(dict)): devices, as described by BulkDeviceItemSerializer
+        user (User): user doing the provisioning. Needs to be a member of any
+            orgs the devices are put in, and is given object permissions on
+            any new devices.
+        access (DeviceAccess): what the user can see, change and add
+        visible_devices (QuerySet): devices which the user can see. Devices
+            which aren't in here are 'not found', and ones which are but that
+            the user can't change are 'forbidden'.
+
+    Returns:
+        list(dict): one result per item, in the same order as items. Each
+            result has 'status' of 'created', 'updated', or 'error', and
+            either the 'id' of the device or the 'errors' and 'status_code'
+            (400, 403 or 404) for that item.
+    """
+    valid, errors = _validate_items(items, user, access, visible_devices)
+
+    to_create = [(i, d) for i, d in sorted(valid.items()) if "id" not in d]
+    to_update = [(i, d) for i, d in sorted(valid.items()) if "id" in d]
+
+    results = {
+        i: {"status": "error", "status_code": code, "errors": e}
+        for i, (code, e) in errors.items()
+    }
+
+    with transaction.atomic():
+        created = _create_devices([d for _, d in to_create])
+        _update_devices([d for _, d in to_update])
+
+        device_orgs = {}
+        for (index, data), device in zip(to_create, created):
+            results[index] = {"status": "created", "id": device.pk}
+            device_orgs[device.pk] = data.get("orgs", [])
+        for index, data in to_update:
+            results[index] = {"status": "updated", "id": data["id"]}
+            if "orgs" in data:
+                device_orgs[data["id"]] = data["orgs"]
+
+        _set_orgs(device_orgs)
+        _grant_creator_permissions(user, created)
+
+    # None of the above sends signals
+    updated_ids = [d["id"] for _, d in to_update]
+    device_cache.invalidate(updated_ids)
+    events.device_products.invalidate(updated_ids)
+
+    logger.info("Bulk provisioned %d new, %d updated, %d errors", len(created), len(updated_ids), len(errors))
+
+    return [results[i] for i in range(len(items))]
@@ -0,0 +1,209 @@
+"""Delete readings older than their product's retention period
+
+Each product keeps readings for ``periodic_data_retention_short`` seconds.
+Deleting everything older than that with one DELETE would hold locks on (and
+bloat) the readings table for as long as it takes, so instead readings are
+deleted in batches:
+
+- the ids of up to ``batch_size`` expired readings are selected for a few
+  sensors at a time, so the lookup uses the sensor and ts indexes instead
+  of scanning the table
+- those rows are deleted by primary key
+- the task sleeps for ``pause`` seconds between batches, to leave room for
+  ingest
+- after ``max_seconds`` it stops, and the next run carries on from the
+  product and sensors it stopped at (kept in redis), going round to the ones
+  before them afterwards. Without this a backlog in the first products would
+  use up every run and later products would never be expired.
+
+When readings are partitioned by time (see django_demo.partitions) the
+expire_old_readings task first drops partitions which have expired for every
+product, so batches only have to delete what is left.
+
+Rollups (see django_demo.rollups) are not deleted, so older data can still
+be charted at 15 minute and 6 hour resolution.
+"""
+import logging
+import time
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from zconnect.models import Product
+from zconnect.zc_timeseries.models import DeviceSensor, TimeSeriesData
+
+from .util import redis_util
+from .util.timestamps import from_unix
+
+logger = logging.getLogger(__name__)
+
+# Sensors whose readings are looked up together
+SENSOR_BATCH_SIZE = 100
+
+# Hash of the product and sensor id the last run stopped at
+CURSOR_KEY = "demo_retention_cursor"
+
+
+def get_options():
+    options = {
+        "batch_size": 5000,
+        "pause": 0.1,
+        "max_seconds": 240,
+    }
+    options.update(getattr(settings, "DEMO_RETENTION", {}))
+    return options
+
+
+class Budget:
+    """Time left for one run
+
+    Args:
+        max_seconds (float): how long the run can take
+    """
+
+    def __init__(self, max_seconds):
+        self.started = time.monotonic()
+        self.max_seconds = max_seconds
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def exhausted(self):
+        return self.elapsed >= self.max_seconds
+
+
+def load_cursor():
+    """Product and sensor id the last run stopped at
+
+    Returns:
+        tuple(int, int): product and sensor id, or (None, None) to start
+            from the beginning
+    """
+    try:
+        product_id, sensor_id = redis_util.get_redis().hmget(CURSOR_KEY, "product", "sensor")
+    except RedisError:
+        logger.exception("Unable to load retention cursor, starting from the first product")
+        return None, None
+
+    if product_id is None:
+        return None, None
+
+    return int(product_id), int(sensor_id or 0)
+
+
+def save_cursor(product_id, sensor_id=0):
+    """Record where to start the next run, or clear it if product_id is None"""
+    try:
+        if product_id is None:
+            redis_util.get_redis().delete(CURSOR_KEY)
+        else:
+            redis_util.get_redis().hmset(CURSOR_KEY, {"product": product_id, "sensor": sensor_id})
+    except RedisError:
+        logger.exception("Unable to save retention cursor")
+
+
+def _rotate(ids, start):
+    """Sorted ids starting from the first which is at least start, followed by
+    the ones before it"""
+    if start is None:
+        return ids
+
+    index = next((i for i, pk in enumerate(ids) if pk >= start), len(ids))
+    return ids[index:] + ids[:index]
+
+
+def expire_product(product, now, budget, batch_size=5000, pause=0.1, start_sensor=None):
+    """Delete expired readings for one product
+
+    Args:
+        product (Product): product, with periodic_data_retention_short set
+        now (float): unix time
+        budget (Budget): stops when this is exhausted
+        start_sensor (int, optional): sensor id to start from, going round
+            to the sensors before it at the end
+
+    Returns:
+        tuple(int, int): readings deleted, and the sensor id to carry on from
+            if it ran out of time before deleting all the expired readings
+            (otherwise None)
+    """
+    cutoff = from_unix(now - product.periodic_data_retention_short)
+    sensor_ids = _rotate(
+        list(DeviceSensor.objects.filter(device__product=product).order_by("pk").values_list("pk", flat=True)),
+        start_sensor,
+    )
+
+    deleted = 0
+    for i in range(0, len(sensor_ids), SENSOR_BATCH_SIZE):
+        expired = TimeSeriesData.objects.filter(
+            sensor_id__in=sensor_ids[i:i + SENSOR_BATCH_SIZE],
+            ts__lt=cutoff,
+        )
+
+        while True:
+            if budget.exhausted:
+                return deleted, sensor_ids[i]
+
+            ids = list(expired.values_list("pk", flat=True)[:batch_size])
+            if not ids:
+                break
+
+            count, _ = TimeSeriesData.objects.filter(pk__in=ids).delete()
+            deleted += count
+
+            if len(ids) < batch_size:
+                break
+
+            time.sleep(pause)
+
+    return deleted, None
+
+
+def expire_readings(now=None, **options):
+    """Delete expired readings for every product with a retention period
+
+    Starts from where the last run stopped (see load_cursor).
+
+    Keyword arguments override DEMO_RETENTION.
+
+    Returns:
+        dict: for each product id, {"deleted", "seconds", "complete"}
+    """
+    options = dict(get_options(), **options)
+    now = time.time() if now is None else now
+    budget = Budget(options["max_seconds"])
+
+    start_product, start_sensor = load_cursor()
+
+    report = {}
+    products = Product.objects.filter(periodic_data_retention_short__gt=0).in_bulk()
+    product_ids = _rotate(sorted(products), start_product)
+
+    for product_id in product_ids:
+        if budget.exhausted:
+            save_cursor(product_id)
+            break
+
+        started = budget.elapsed
+        deleted, resume_sensor = expire_product(
+            products[product_id], now, budget,
+            batch_size=options["batch_size"],
+            pause=options["pause"],
+            start_sensor=start_sensor if product_id == start_product else None,
+        )
+
+        report[product_id] = {
+            "deleted": deleted,
+            "seconds": round(budget.elapsed - started, 3),
+            "complete": resume_sensor is None,
+        }
+
+        if resume_sensor is not None:
+            save_cursor(product_id, resume_sensor)
+            break
+    else:
+        save_cursor(None)
+
+    return report
@@ -0,0 +1,408 @@
+"""Rollups of readings for each device sensor
+
+For each DeviceSensor the count, sum, min, max and latest value of its
+readings are kept in SensorRollup rows for every resolution in
+DEMO_ROLLUPS["resolutions"] (by default 15 minutes and 6 hours, the fridge's
+periodic_data_interval_short and periodic_data_interval_long). Buckets are
+aligned to multiples of the resolution since the epoch, like the aggregation
+engines.
+
+The ingest writer passes each batch of readings to ``update`` in the same
+transaction that inserts them, so a bucket recomputed by another writer (see
+below) either already has them merged in or doesn't see them at all. Readings in a batch are combined per bucket in python, then merged into
+the existing rollups with one query to lock them, one UPDATE per column and
+one bulk INSERT for new buckets.
+
+A reading earlier than the latest one already in its bucket has arrived late.
+Its bucket is recomputed from the raw readings, so rollups always end up the
+same as if they had been built from scratch. Only the buckets late readings
+fall in are recomputed.
+
+Rows are locked in (sensor, resolution, bucket) order, so writers updating
+overlapping buckets wait for each other rather than deadlocking. If updating
+still fails (after retrying conflicts and deadlocks), the buckets are
+recorded in redis and recomputed from the raw readings by the repair_rollups
+task, so rollups don't stay wrong until someone runs rebuild_rollups.
+"""
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, transaction
+from django.db.models import Case, DateTimeField, FloatField, IntegerField, Q, Value, When
+from redis.exceptions import RedisError
+
+from zconnect.zc_timeseries.models import DeviceSensor, TimeSeriesData
+
+from .models import SensorRollup
+from .util import redis_util
+from .util.timestamps import from_unix, to_unix
+
+logger = logging.getLogger(__name__)
+
+# Buckets recomputed with one query
+RECOMPUTE_BATCH_SIZE = 100
+
+# Buckets locked with one query
+LOCK_BATCH_SIZE = 500
+
+# Sensors rebuilt at a time by rebuild(). Memory used is proportional to this
+# times the number of buckets being rebuilt for each sensor.
+REBUILD_SENSOR_BATCH_SIZE = 10
+
+# Redis set of "<sensor id>:<resolution>:<bucket>" which failed to update
+FAILED_KEY = "demo_rollups_failed"
+
+UPDATE_FIELDS = {
+    "count": IntegerField(),
+    "sum": FloatField(),
+    "min": FloatField(),
+    "max": FloatField(),
+    "last": FloatField(),
+    "last_ts": DateTimeField(),
+}
+
+
+def get_resolutions():
+    """Resolutions rollups are kept for, in seconds"""
+    return tuple(getattr(settings, "DEMO_ROLLUPS", {}).get("resolutions", (900, 21600)))
+
+
+def bucket_start(unix, resolution):
+    return (unix // resolution) * resolution
+
+
+class Partial:
+    """Count, sum, min, max and latest value of some readings in a bucket"""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.last_ts = None
+        self.first_ts = None
+
+    def add(self, ts, value):
+        """Add a reading. Readings at the same time should be added in the
+        order they were stored - the later one is kept as the latest.
+        """
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if self.last_ts is None or ts >= self.last_ts:
+            self.last, self.last_ts = value, ts
+        if self.first_ts is None or ts < self.first_ts:
+            self.first_ts = ts
+
+    def merge_into(self, rollup):
+        """Add these readings to a SensorRollup"""
+        rollup.count += self.count
+        rollup.sum += self.sum
+        rollup.min = min(rollup.min, self.min)
+        rollup.max = max(rollup.max, self.max)
+        if self.last_ts >= to_unix(rollup.last_ts):
+            rollup.last, rollup.last_ts = self.last, from_unix(self.last_ts)
+
+    def replace(self, rollup):
+        """Make a SensorRollup hold just these readings"""
+        rollup.count = self.count
+        rollup.sum = self.sum
+        rollup.min = self.min
+        rollup.max = self.max
+        rollup.last = self.last
+        rollup.last_ts = from_unix(self.last_ts)
+
+
+def partials(points, resolutions):
+    """Combine readings per bucket
+
+    Args:
+        points (iterable(tuple)): (sensor id, datetime, value), in the order
+            they were stored
+        resolutions (iterable(int)): bucket sizes
+
+    Returns:
+        dict: (sensor id, resolution, bucket start as unix time) to Partial
+    """
+    combined = {}
+    for sensor_id, ts, value in points:
+        unix = to_unix(ts)
+        for resolution in resolutions:
+            key = (sensor_id, resolution, bucket_start(unix, resolution))
+            combined.setdefault(key, Partial()).add(unix, value)
+    return combined
+
+
+def update(points, retries=3):
+    """Add newly stored readings to the rollups
+
+    If the rollups can't be updated the buckets are recorded to be repaired
+    later (see ``repair``) before raising.
+
+    Args:
+        points (list(tuple)): (sensor id, datetime, value) for each reading
+            which has been stored
+        retries (int): attempts before giving up on conflicts and deadlocks
+
+    Returns:
+        int: number of buckets which had to be recomputed because of late
+            readings
+    """
+    combined = partials(points, get_resolutions())
+    if not combined:
+        return 0
+
+    error = None
+    for attempt in range(retries):
+        try:
+            with transaction.atomic():
+                return _apply(combined)
+        except IntegrityError as e:
+            # Another writer created one of the new buckets first - the
+            # transaction was rolled back, so merge into it instead
+            logger.debug("Conflict creating rollups (attempt %d)", attempt + 1)
+            error = e
+        except OperationalError as e:
+            # Most likely a deadlock or lock timeout
+            logger.warning("Error updating rollups (attempt %d): %s", attempt + 1, e)
+            error = e
+        except Exception:
+            mark_failed(combined)
+            raise
+
+    mark_failed(combined)
+    raise error
+
+
+def _pack_key(key):
+    return "{}:{}:{}".format(*key)
+
+
+def _unpack_key(raw):
+    sensor_id, resolution, bucket = (raw.decode("utf8") if isinstance(raw, bytes) else raw).split(":")
+    return int(sensor_id), int(resolution), float(bucket)
+
+
+def mark_failed(keys):
+    """Record buckets which couldn't be updated, to be repaired later
+
+    Args:
+        keys (iterable(tuple)): (sensor id, resolution, bucket start as unix
+            time)
+    """
+    members = [_pack_key(key) for key in keys]
+    if not members:
+        return
+
+    try:
+        redis_util.get_redis().sadd(FAILED_KEY, *members)
+    except RedisError:
+        logger.exception("Unable to record %d failed rollups - run rebuild_rollups to fix them", len(members))
+
+
+def repair(limit=1000):
+    """Recompute buckets which failed to update from the raw readings
+
+    Args:
+        limit (int): most buckets to recompute
+
+    Returns:
+        int: number of buckets recomputed
+    """
+    r = redis_util.get_redis()
+    members = r.srandmember(FAILED_KEY, limit)
+    if not members:
+        return 0
+
+    # Removed first, so a bucket which fails again while this is running is
+    # recorded again rather than removed afterwards
+    r.srem(FAILED_KEY, *members)
+    keys = {_unpack_key(m) for m in members}
+
+    try:
+        with transaction.atomic():
+            _rebuild_buckets(keys)
+    except Exception:
+        mark_failed(keys)
+        raise
+
+    logger.info("Repaired %d rollups", len(keys))
+    return len(keys)
+
+
+def _rebuild_buckets(keys):
+    """Recompute some buckets from the raw readings, creating or deleting
+    rollups as needed"""
+    existing = _lock(keys)
+
+    rollups = []
+    for key in keys:
+        rollup = existing.get(key)
+        if rollup is None:
+            sensor_id, resolution, bucket = key
+            rollup = SensorRollup(sensor_id=sensor_id, resolution=resolution, bucket=from_unix(bucket))
+        rollups.append(rollup)
+
+    empty = {id(r) for r in _recompute(rollups)}
+
+    _save([r for r in rollups if r.pk is not None and id(r) not in empty])
+    SensorRollup.objects.bulk_create([r for r in rollups if r.pk is None and id(r) not in empty])
+    SensorRollup.objects.filter(pk__in=[r.pk for r in rollups if r.pk is not None and id(r) in empty]).delete()
+
+
+def _lock(keys):
+    """Lock and return the existing rollups for some buckets
+
+    Rows are locked in (sensor, resolution, bucket) order, so that writers
+    locking overlapping buckets can't deadlock each other.
+
+    Returns:
+        dict: (sensor id, resolution, bucket start as unix time) to
+            SensorRollup
+    """
+    keys = sorted(keys)
+    found = {}
+
+    for i in range(0, len(keys), LOCK_BATCH_SIZE):
+        exact = Q()
+        for sensor_id, resolution, bucket in keys[i:i + LOCK_BATCH_SIZE]:
+            exact |= Q(sensor_id=sensor_id, resolution=resolution, bucket=from_unix(bucket))
+
+        existing = SensorRollup.objects.select_for_update().filter(exact).order_by(
+            "sensor_id", "resolution", "bucket",
+        )
+        for rollup in existing:
+            found[(rollup.sensor_id, rollup.resolution, to_unix(rollup.bucket))] = rollup
+
+    return found
+
+
+def _apply(combined):
+    existing = _lock(set(combined))
+
+    created = []
+    changed = []
+    late = []
+
+    for key, partial in combined.items():
+        rollup = existing.get(key)
+        if rollup is None:
+            sensor_id, resolution, bucket = key
+            rollup = SensorRollup(sensor_id=sensor_id, resolution=resolution, bucket=from_unix(bucket))
+            partial.replace(rollup)
+            created.append(rollup)
+        elif partial.first_ts < to_unix(rollup.last_ts):
+            late.append(rollup)
+        else:
+            partial.merge_into(rollup)
+            changed.append(rollup)
+
+    if late:
+        logger.debug("Recomputing %d rollups for late readings", len(late))
+        _recompute(late)
+
+    _save(changed + late)
+    SensorRollup.objects.bulk_create(created)
+
+    return len(late)
+
+
+def _recompute(rollups):
+    """Recompute rollups from the raw readings in their buckets
+
+    Returns:
+        list(SensorRollup): rollups for buckets which have no readings, which
+            are left unchanged
+    """
+    empty = []
+
+    for i in range(0, len(rollups), RECOMPUTE_BATCH_SIZE):
+        batch = rollups[i:i + RECOMPUTE_BATCH_SIZE]
+        by_key = {(r.sensor_id, r.resolution, to_unix(r.bucket)): r for r in batch}
+
+        windows = Q()
+        for sensor_id, resolution, bucket in by_key:
+            windows |= Q(sensor_id=sensor_id, ts__gte=from_unix(bucket), ts__lt=from_unix(bucket + resolution))
+
+        points = TimeSeriesData.objects.filter(windows).order_by("ts", "pk").values_list(
+            "sensor_id", "ts", "value",
+        )
+        recomputed = partials(points, {resolution for _, resolution, _ in by_key})
+
+        for key, rollup in by_key.items():
+            if key in recomputed:
+                recomputed[key].replace(rollup)
+            else:
+                empty.append(rollup)
+
+    return empty
+
+
+def _save(rollups):
+    """Write changed rollups with one UPDATE per column"""
+    if not rollups:
+        return
+
+    SensorRollup.objects.filter(pk__in=[r.pk for r in rollups]).update(**{
+        field: Case(
+            *[When(pk=r.pk, then=Value(getattr(r, field))) for r in rollups],
+            output_field=output_field
+        )
+        for field, output_field in UPDATE_FIELDS.items()
+    })
+
+
+def rebuild(sensor_ids=None, start=None):
+    """Rebuild rollups from the raw readings
+
+    Used to fill in rollups for readings stored before rollups were kept.
+    Sensors are rebuilt REBUILD_SENSOR_BATCH_SIZE at a time, each batch in its
+    own transaction.
+
+    Args:
+        sensor_ids (list(int), optional): only rebuild these sensors
+        start (datetime, optional): only rebuild buckets from this time
+
+    Returns:
+        int: number of rollups written
+    """
+    if sensor_ids is None:
+        sensor_ids = DeviceSensor.objects.order_by("pk").values_list("pk", flat=True)
+    sensor_ids = list(sensor_ids)
+
+    resolutions = get_resolutions()
+    if start is not None:
+        # Start from the beginning of the bucket start is in for the largest
+        # resolution, so no bucket is only partly rebuilt
+        start = from_unix(bucket_start(to_unix(start), max(resolutions)))
+
+    written = 0
+    for i in range(0, len(sensor_ids), REBUILD_SENSOR_BATCH_SIZE):
+        written += _rebuild_sensors(sensor_ids[i:i + REBUILD_SENSOR_BATCH_SIZE], start, resolutions)
+
+    return written
+
+
+def _rebuild_sensors(sensor_ids, start, resolutions):
+    readings = TimeSeriesData.objects.filter(sensor_id__in=sensor_ids)
+    rollups = SensorRollup.objects.filter(sensor_id__in=sensor_ids)
+    if start is not None:
+        readings = readings.filter(ts__gte=start)
+        rollups = rollups.filter(bucket__gte=start)
+
+    points = readings.order_by("ts", "pk").values_list("sensor_id", "ts", "value")
+    combined = partials(points.iterator(), resolutions)
+
+    created = []
+    for (sensor_id, resolution, bucket), partial in combined.items():
+        rollup = SensorRollup(sensor_id=sensor_id, resolution=resolution, bucket=from_unix(bucket))
+        partial.replace(rollup)
+        created.append(rollup)
+
+    with transaction.atomic():
+        rollups.delete()
+        SensorRollup.objects.bulk_create(created, batch_size=1000)
+
+    return len(created)
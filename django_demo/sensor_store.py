@@ -0,0 +1,291 @@
+"""Latest and recent sensor readings for each device, kept in redis
+
+When readings are written by the ingest pipeline (see
+django_demo.ingest.writer) the newest value of each sensor is also stored in
+a redis hash per device, and the readings are pushed onto a short list per
+device of the most recent readings. A sensor's value is only replaced by a
+newer reading, so a batch which arrives late doesn't move it backwards.
+
+Serializing ``sensors_current`` for a page of devices then needs one
+pipelined HGETALL for the whole page instead of any database queries (see
+DemoDeviceListSerializer). Hashes which haven't been filled yet - for devices
+which haven't sent anything since redis was emptied, or whose sensors have
+changed - are loaded from the database in one query for all of them, and
+marked as loaded so that devices which have never sent anything don't hit
+the database every time.
+
+The recent readings list only holds readings written by the ingest pipeline.
+It expires if a device stops sending anything, and is emptied along with the
+latest values whenever they are invalidated.
+
+If redis can't be reached, sensors_current is loaded from the database.
+"""
+import json
+import logging
+
+from django.conf import settings
+from django.db.models import prefetch_related_objects
+from redis.exceptions import RedisError
+
+from .util import redis_util
+from .util.sensors import latest_readings_prefetch, sensors_current_from_prefetch
+from .util.timestamps import from_unix, to_unix
+
+logger = logging.getLogger(__name__)
+
+# Set on a hash once it holds every sensor for the device
+LOADED_FIELD = "__loaded__"
+
+# KEYS[1]: hash of sensor name to encoded reading, ARGV: sensor name, encoded
+# reading, unix time triples
+# Sets each sensor unless it already holds a newer reading
+MAX_HSET_SCRIPT = """
+for i = 1, #ARGV, 3 do
+    local current = redis.call("HGET", KEYS[1], ARGV[i])
+    if not current or cjson.decode(current)[1] < tonumber(ARGV[i + 2]) then
+        redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+return 1
+"""
+
+# Whether the redis client can run Lua scripts
+_use_lua = True
+
+
+def current_key(device_id):
+    return "demo_sensors_current:{}".format(device_id)
+
+
+def recent_key(device_id):
+    return "demo_sensors_recent:{}".format(device_id)
+
+
+def recent_length():
+    return getattr(settings, "DEMO_SENSOR_STORE", {}).get("recent_length", 20)
+
+
+def recent_ttl():
+    return getattr(settings, "DEMO_SENSOR_STORE", {}).get("recent_ttl", 7 * 24 * 60 * 60)
+
+
+def _encode(ts, value):
+    return json.dumps([to_unix(ts), value])
+
+
+def _decode(raw):
+    ts, value = json.loads(raw.decode("utf8") if isinstance(raw, bytes) else raw)
+    return {"value": value, "ts": from_unix(ts)}
+
+
+def _decode_ts(raw):
+    return json.loads(raw.decode("utf8") if isinstance(raw, bytes) else raw)[0]
+
+
+def _push_recent(pipe, by_device):
+    length = recent_length()
+    ttl = recent_ttl()
+
+    for device_id, items in by_device.items():
+        # Newest first
+        pipe.lpush(recent_key(device_id), *items)
+        pipe.ltrim(recent_key(device_id), 0, length - 1)
+        pipe.expire(recent_key(device_id), ttl)
+
+
+def _store(client, latest, by_device):
+    """Set newer latest values and push recent readings, with one round trip
+
+    Args:
+        latest (dict): device id to dict of sensor name to (unix time, encoded
+            reading)
+        by_device (dict): device id to encoded recent readings, oldest first
+    """
+    global _use_lua # pylint: disable=global-statement
+
+    latest = {device_id: values for device_id, values in latest.items() if values}
+
+    if _use_lua:
+        try:
+            script = client.register_script(MAX_HSET_SCRIPT)
+            pipe = client.pipeline(transaction=False)
+            for device_id, values in latest.items():
+                script(
+                    keys=[current_key(device_id)],
+                    args=[v for name, (ts, encoded) in values.items() for v in (name, encoded, ts)],
+                    client=pipe,
+                )
+            _push_recent(pipe, by_device)
+            pipe.execute()
+            return
+        except (ImportError, NotImplementedError, AttributeError, TypeError) as e:
+            logger.warning("Redis client can't run Lua scripts (%s) - storing latest readings in python", e)
+            _use_lua = False
+
+    # Same as MAX_HSET_SCRIPT, without atomicity
+    devices = list(latest)
+    pipe = client.pipeline(transaction=False)
+    for device_id in devices:
+        pipe.hmget(current_key(device_id), *latest[device_id])
+    existing = pipe.execute()
+
+    pipe = client.pipeline(transaction=False)
+    for device_id, current in zip(devices, existing):
+        newer = {
+            name: encoded
+            for (name, (ts, encoded)), raw in zip(latest[device_id].items(), current)
+            if raw is None or _decode_ts(raw) < ts
+        }
+        if newer:
+            pipe.hmset(current_key(device_id), newer)
+    _push_recent(pipe, by_device)
+    pipe.execute()
+
+
+def record(readings):
+    """Store readings which have just been written to the database
+
+    Args:
+        readings (list(Reading)): readings, only including sensors which
+            exist
+    """
+    latest = {}
+    by_device = {}
+
+    for reading in sorted(readings, key=lambda r: r.timestamp):
+        device_latest = latest.setdefault(reading.device_id, {})
+        for name, value in reading.values.items():
+            device_latest[name] = (to_unix(reading.timestamp), _encode(reading.timestamp, value))
+
+        by_device.setdefault(reading.device_id, []).append(
+            json.dumps([to_unix(reading.timestamp), reading.values])
+        )
+
+    if not latest:
+        return
+
+    try:
+        _store(redis_util.get_redis(), latest, by_device)
+    except RedisError:
+        # The readings are in the database - sensors_current is only out of
+        # date until the next reading for each sensor
+        logger.exception("Unable to store latest readings for %d devices in redis", len(latest))
+
+
+def _load(devices, store=True):
+    """Load latest readings from the database, and store them unless store is
+    False
+
+    Returns:
+        dict: device id to sensors_current
+    """
+    prefetch_related_objects(devices, latest_readings_prefetch())
+
+    loaded = {device.pk: sensors_current_from_prefetch(device) for device in devices}
+    if not store:
+        return loaded
+
+    try:
+        pipe = redis_util.get_redis().pipeline(transaction=False)
+
+        for device_id, current in loaded.items():
+            key = current_key(device_id)
+            for name, reading in current.items():
+                # Don't overwrite anything newer written by the listener since
+                # the query
+                pipe.hsetnx(key, name, _encode(reading["ts"], reading["value"]))
+            pipe.hset(key, LOADED_FIELD, 1)
+
+        pipe.execute()
+    except RedisError:
+        logger.exception("Unable to store latest readings for %d devices in redis", len(loaded))
+
+    return loaded
+
+
+def current_for_devices(devices):
+    """sensors_current for some devices, with one redis round trip
+
+    Devices which aren't in redis yet are loaded from the database with one
+    query, as are all of them if redis can't be reached.
+
+    Args:
+        devices (list(Device)): devices
+
+    Returns:
+        dict: device id to the same structure as
+            ``device.get_latest_ts_data()``
+    """
+    if not devices:
+        return {}
+
+    try:
+        pipe = redis_util.get_redis().pipeline(transaction=False)
+        for device in devices:
+            pipe.hgetall(current_key(device.pk))
+        hashes = pipe.execute()
+    except RedisError:
+        logger.exception("Unable to read latest readings for %d devices from redis", len(devices))
+        return _load(devices, store=False)
+
+    current = {}
+    cold = []
+
+    for device, fields in zip(devices, hashes):
+        fields = {
+            (k.decode("utf8") if isinstance(k, bytes) else k): v
+            for k, v in fields.items()
+        }
+
+        if LOADED_FIELD not in fields:
+            cold.append(device)
+            continue
+
+        current[device.pk] = {
+            name: _decode(raw) for name, raw in fields.items()
+            if name != LOADED_FIELD
+        }
+
+    if cold:
+        current.update(_load(cold))
+
+    return current
+
+
+def get_recent(device_id, sensor_name=None, count=None):
+    """Most recent readings for a device, newest first
+
+    Args:
+        device_id (int): device
+        sensor_name (str, optional): only return values of this sensor
+        count (int, optional): most readings to return
+
+    Returns:
+        list(dict): readings. Each has "ts" and either "value" (if
+            sensor_name was given) or "values"
+    """
+    raw = redis_util.get_redis().lrange(recent_key(device_id), 0, (count or recent_length()) - 1)
+
+    recent = []
+    for item in raw:
+        ts, values = json.loads(item.decode("utf8") if isinstance(item, bytes) else item)
+
+        if sensor_name is None:
+            recent.append({"ts": from_unix(ts), "values": values})
+        elif sensor_name in values:
+            recent.append({"ts": from_unix(ts), "value": values[sensor_name]})
+
+    return recent
+
+
+def invalidate(device_ids):
+    """Forget the latest and recent readings for some devices, so the latest
+    readings are reloaded"""
+    if not device_ids:
+        return
+
+    keys = [current_key(pk) for pk in device_ids] + [recent_key(pk) for pk in device_ids]
+    try:
+        redis_util.get_redis().delete(*keys)
+    except RedisError:
+        logger.exception("Unable to invalidate latest readings for devices %s", device_ids)
@@ -2,18 +2,42 @@ import logging
 
 from django.apps import apps
 from django.conf import settings
+from django.db import models
 from rest_framework import serializers
 
 from zconnect.serializers import CreateDeviceSerializer, DeviceSerializer
 from zconnect.models import Product
 
+from . import sensor_store
 from .models import DemoDevice
+from .util.fieldsets import SparseFieldsetMixin
+from .util.sensors import has_prefetched_readings, sensors_current_from_prefetch
 
 logger = logging.getLogger(__name__)
 
 
-class DemoDeviceSerializer(DeviceSerializer):
+class DemoDeviceListSerializer(serializers.ListSerializer):
+    """Loads sensors_current for all the devices from the sensor store at once
+
+    See django_demo.sensor_store
+    """
+
+    def to_representation(self, data):
+        devices = list(data.all() if isinstance(data, models.Manager) else data)
+
+        if "sensors_current" in self.child.fields:
+            self.child.preloaded_sensors_current = sensor_store.current_for_devices(devices)
+
+        return super().to_representation(devices)
+
+
+class DemoDeviceSerializer(SparseFieldsetMixin, DeviceSerializer):
+    """Device serializer which supports ``?fields=`` and ``?omit=``"""
+
+    sensors_current = serializers.SerializerMethodField()
+
     class Meta:
+        list_serializer_class = DemoDeviceListSerializer
         model = apps.get_model(settings.ZCONNECT_DEVICE_MODEL)
         fields = ("id", "product", "name", "online", "last_seen", "fw_version",
                   "sensors_current", "orgs", "online", "sim_number", "created_at", "updated_at",
@@ -21,6 +45,22 @@ class DemoDeviceSerializer(DeviceSerializer):
         read_only_fields = ("id", "product", "orgs", "created_at", "updated_at",
                             'online', 'sim_number')
 
+    def get_sensors_current(self, device):
+        """Latest reading for each sensor on the device
+
+        When serializing many devices these are loaded for all of them at once
+        by DemoDeviceListSerializer. Otherwise use prefetched readings if the
+        device was loaded with them, or fall back to loading them per sensor.
+        """
+        preloaded = getattr(self, "preloaded_sensors_current", None)
+        if preloaded is not None and device.pk in preloaded:
+            return preloaded[device.pk]
+
+        if has_prefetched_readings(device):
+            return sensors_current_from_prefetch(device)
+
+        return device.get_latest_ts_data()
+
 class CreateDemoDeviceSerializer(CreateDeviceSerializer):
     class Meta:
         model = DemoDevice
@@ -81,15 +81,29 @@ SITE_ID = 1
 # Middlewares
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
+    # Runs DEMO_BROWSER_MIDDLEWARE - keep this last
+    'django_demo.middleware.BrowserOnlyMiddleware',
+]
+
+# Middleware which is skipped for token authenticated requests under
+# DEMO_LEAN_PATH_PREFIXES, because the API doesn't use sessions, CSRF, messages
+# or framing. Admin and the auth urls always go through it.
+# NOTE: if upgrading to django 2.2+, admin.E408-E410 need to be silenced as the
+# admin checks look for these in MIDDLEWARE.
+DEMO_BROWSER_MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+DEMO_LEAN_PATH_PREFIXES = [
+    "/api/v3/",
+]
+
 # template stuff
 TEMPLATES = [
     {
@@ -136,7 +150,19 @@ REST_AUTH_SERIALIZERS = {
     # db access. It also gives a better error message if a field is missing.
     "LOGIN_SERIALIZER": "zconnect.serializers.TokenWithUserObtainSerializer",
 }
-REST_AUTH_TOKEN_CREATOR = "zconnect.serializers.jwt_create_token"
+# zconnect.serializers.jwt_create_token, plus the claims needed for stateless
+# reads (see DEMO_JWT_AUTH below)
+REST_AUTH_TOKEN_CREATOR = "django_demo.authentication.create_token"
+
+# See django_demo.authentication
+DEMO_JWT_AUTH = {
+    # Maximum number of verified tokens to remember (per process)
+    "cache_size": 10000,
+    # Don't load the user from the database for safe requests to views which
+    # allow it, just use the claims in the token. The user isn't checked to
+    # still be active, so deactivated users can read until their token expires
+    "stateless_reads": False,
+}
 
 AUTHENTICATION_BACKENDS = [
     # Try to load a REST_AUTH_TOKEN_MODEL from the Bearer token in the
@@ -197,8 +223,9 @@ REST_FRAMEWORK = {
     ],
     "DEFAULT_AUTHENTICATION_CLASSES": [
         # NOTE
-        # See notes above
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        # See notes above. This is JWTAuthentication with a cache of verified
+        # tokens - see DEMO_JWT_AUTH below
+        "django_demo.authentication.CachedJWTAuthentication",
         "rest_framework.authentication.SessionAuthentication",
     ],
     'DEFAULT_PAGINATION_CLASS': 'zconnect.pagination.StandardPagination',
@@ -225,6 +252,81 @@ DEFAULT_LISTENER_SETTINGS = {
     "rate_limit_period": 600,
 }
 
+# Batching of readings from the listener (see django_demo.ingest)
+DEMO_INGEST = {
+    # Write a batch when this many readings are waiting...
+    "batch_size": 500,
+    # ...or when the oldest has been waiting this many seconds
+    "max_delay": 0.5,
+    # Listener only: readings waiting to be written before the overflow policy
+    # applies
+    "queue_size": 10000,
+    # Listener only: number of writers. Each uses one database connection, so
+    # this should be no more than MAX_CONNS for django_db_geventpool
+    "writers": 2,
+    # Listener only: what to do when the queue is full - "block" (wait for
+    # space, for up to block_timeout seconds), "shed" (drop the reading) or
+    # "spill" (keep it in redis until there is space)
+    "overflow": "block",
+    "block_timeout": 10,
+    # Listener only: return from the message handler (acknowledging the
+    # message) as soon as the reading is queued, rather than once it has been
+    # written. Faster, but readings which fail to be written, or are still
+    # queued when the listener stops, are lost.
+    "ack_before_write": False,
+    # Resolution of device sensors created when a device first sends a
+    # reading for one of its product's sensor types
+    "sensor_resolution": 900,
+}
+
+# Scheduled event definitions (see django_demo.events.schedule)
+DEMO_SCHEDULER = {
+    # Devices handled by one fire_scheduled_event task
+    "chunk_size": 500,
+    # Most missed occurrences of one definition fired when catching up
+    "max_catch_up": 60,
+    # Seconds before an occurrence which was claimed but never fanned out
+    # (eg, the broker was down) is fired again by a later tick
+    "claim_lease": 300,
+}
+
+# Latest and recent sensor readings kept in redis by the ingest pipeline (see
+# django_demo.sensor_store)
+DEMO_SENSOR_STORE = {
+    # Recent readings kept per device
+    "recent_length": 20,
+    # Seconds before the recent readings of a device which has stopped
+    # sending anything are removed
+    "recent_ttl": 7 * 24 * 60 * 60,
+}
+
+# Multi-process periodic data listener (./manage.py run_sharded_listener). This
+# only subscribes to periodic events - the normal listener should not also be
+# subscribed to them when this is used.
+DEMO_SHARDED_LISTENER = {
+    "shards": 4,
+    # Messages waiting per shard before the dispatcher starts waiting for space
+    "queue_size": 10000,
+    # Seconds to wait for space before dropping a message. None waits (and
+    # leaves messages with the broker) for as long as it takes.
+    "put_timeout": None,
+    # Seconds between logging per-shard lag
+    "report_interval": 30,
+    "topic": "iot-2/type/+/id/+/evt/periodic/fmt/json",
+    # Shared subscription group
+    "group": "demo-ingest",
+}
+
+# Token bucket rate limiting of periodic messages (in the listener's periodic
+# handler and the sharded listener), using the limits from
+# DEFAULT_LISTENER_SETTINGS (see django_demo.ingest.ratelimit)
+DEMO_RATE_LIMITER = {
+    # Tokens taken from redis at once and then handed out locally
+    "lease_size": 10,
+    # Seconds before unused local tokens are given back
+    "lease_ttl": 5.0,
+}
+
 ZCONNECT_DEVICE_MODEL = "django_demo.DemoDevice"
 ZCONNECT_DEVICE_SERIALIZER = "django_demo.serializers.DemoDeviceSerializer"
 ZCONNECT_JWT_SERIALIZER = "zconnect.serializers.JWTUserSerializer"
@@ -233,10 +335,65 @@ ZCONNECT_ADMIN_USER_SERIALIZER = "zconnect.serializers.UserSerializerAdmin"
 ZCONNECT_PRODUCT_SERIALIZER = "django_demo.serializers.DemoProductSerializer"
 AUTH_USER_MODEL = 'zconnect.User'
 
+# Redis cache of serialized devices (see django_demo.device_cache)
+DEMO_DEVICE_CACHE = {
+    "enabled": True,
+    # seconds
+    "ttl": 60 * 60,
+}
+
 # numpy or sql
-# sql doesn't work in sqlite
+# sql doesn't work in sqlite - DEMO_TS_AGGREGATION below has one that does.
+# Only used for demo devices if DEMO_TS_AGGREGATION["device_data"] is False.
 ZCONNECT_TS_AGGREGATION_ENGINE = "numpy"
 
+# Aggregation of readings for devices/{id}/aggregated/ and, through
+# DemoDevice.optimised_data_fetch, zconnect's timeseries and chart endpoints
+# (see django_demo.aggregation). sql aggregates in the database and works in
+# both sqlite and postgres, numpy loads the whole window into memory and
+# numpy_chunked streams it and only keeps one bucket at a time.
+DEMO_TS_AGGREGATION = {
+    "engine": "sql",
+    # Use this for zconnect's endpoints as well, instead of
+    # ZCONNECT_TS_AGGREGATION_ENGINE
+    "device_data": True,
+    # Rows fetched from the database at a time by numpy_chunked (and by sql
+    # for aggregations the database can't do)
+    "chunk_size": 5000,
+}
+
+# Resolutions (in seconds) to keep rollups of readings for, see
+# django_demo.rollups. These match the fridge's periodic_data_interval_short
+# and periodic_data_interval_long.
+DEMO_ROLLUPS = {
+    "resolutions": [900, 21600],
+    # Most rollups which failed to update recomputed by each run of the
+    # repair_rollups task
+    "repair_batch_size": 1000,
+}
+
+# Deleting expired readings, see django_demo.retention
+DEMO_RETENTION = {
+    # Readings deleted in one statement
+    "batch_size": 5000,
+    # Seconds to sleep between batches
+    "pause": 0.1,
+    # Longest one run can take, in seconds. It carries on where it left off
+    # the next hour.
+    "max_seconds": 240,
+}
+
+# Partition readings by time on PostgreSQL 11+, see django_demo.partitions.
+# The table has to be converted once with './manage.py ts_partitions convert'
+# after enabling this.
+DEMO_TS_PARTITIONS = {
+    "enabled": False,
+    # Days of readings in each partition
+    "interval_days": 7,
+    # Partitions created ahead of the current one
+    "premake": 4,
+}
+
 ORGS_SLUGFIELD = 'django_extensions.db.fields.AutoSlugField'
 
 ACTSTREAM_SETTINGS = {
@@ -303,13 +460,35 @@ CELERYD_MAX_TASKS_PER_CHILD = 20
 CELERY_BEAT_SCHEDULE = {
     # Triggers once per minute
     "trigger_scheduled_events": {
-        "task": "zconnect.tasks.trigger_scheduled_events",
+        "task": "django_demo.tasks.trigger_scheduled_events",
         "schedule": crontab(minute='*')
     },
     "generate_all_outstanding_bills": {
         "task": "zconnect.zc_billing.tasks.generate_all_outstanding_bills",
         "schedule": crontab(hour=0)
     },
+    # Write device last_seen/online from redis to the database. This also
+    # decides when devices go offline, so it should run a lot more often than
+    # online_status_threshold_mins.
+    "flush_device_presence": {
+        "task": "django_demo.tasks.flush_device_presence",
+        "schedule": 30.0,
+    },
+    # Delete readings older than each product's retention period
+    "expire_old_readings": {
+        "task": "django_demo.tasks.expire_old_readings",
+        "schedule": crontab(minute=15),
+    },
+    # Recompute rollups which failed to update when readings were written
+    "repair_rollups": {
+        "task": "django_demo.tasks.repair_rollups",
+        "schedule": 300.0,
+    },
+    # Create upcoming partitions when DEMO_TS_PARTITIONS is enabled
+    "maintain_partitions": {
+        "task": "django_demo.tasks.maintain_partitions",
+        "schedule": crontab(hour=1, minute=0),
+    },
 }
 
 # Configure django-db-file-storage. See django-db-file-storage.readthedocs.io
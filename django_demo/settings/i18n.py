@@ -4,7 +4,7 @@ from os.path import join
 from django.utils.translation import ugettext_lazy as _
 
 # project imports
-from .common import MIDDLEWARE, PROJECT_ROOT
+from .common import DEMO_BROWSER_MIDDLEWARE, PROJECT_ROOT
 
 # ##### INTERNATIONALIZATION ##############################
 
@@ -31,7 +31,8 @@ LOCALE_PATHS = (
     join(PROJECT_ROOT, 'locale'),
 )
 
-# Inject the localization middleware into the right position
-MIDDLEWARE = [y for i, x in enumerate(MIDDLEWARE) for y in (
-    ('django.middleware.locale.LocaleMiddleware', x) if MIDDLEWARE[i-1] == \
+# Inject the localization middleware into the right position (after the
+# session middleware, which is only run for non-API requests)
+DEMO_BROWSER_MIDDLEWARE = [y for i, x in enumerate(DEMO_BROWSER_MIDDLEWARE) for y in (
+    ('django.middleware.locale.LocaleMiddleware', x) if DEMO_BROWSER_MIDDLEWARE[i-1] == \
     'django.contrib.sessions.middleware.SessionMiddleware' else (x, ))]
@@ -114,6 +114,11 @@ DATABASES = {
     }
 }
 
+# Each ingest writer in the listener holds a database connection - leave some
+# of the pool for everything else the listener does (events, rate limits, ...)
+INGEST_RESERVED_CONNS = 1
+DEMO_INGEST["writers"] = max(1, int(DATABASES["default"]["OPTIONS"]["MAX_CONNS"]) - INGEST_RESERVED_CONNS)
+
 REDIS = {
     "connection": {
         # "username": getenv("REDIS_USERNAME"),
@@ -0,0 +1,21 @@
+# pylint: disable=unused-wildcard-import, wildcard-import
+"""Development settings with the PostgreSQL database created by
+integration_test_data/init_postgres.sh
+
+Used by ``tox -e postgres`` to run the tests which are skipped on sqlite (eg,
+partitioning, which also needs PostgreSQL 11+)
+"""
+from os import getenv
+
+from .development import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': getenv("POSTGRES_DB", "demo_local_test"),
+        'HOST': getenv("POSTGRES_HOST", "localhost"),
+        'PORT': getenv("POSTGRES_PORT", "5432"),
+        'USER': getenv("POSTGRES_USER", "django"),
+        'PASSWORD': getenv("POSTGRES_PASSWORD", "shae6woifaeTah7Eipax"),
+    }
+}
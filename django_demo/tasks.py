@@ -0,0 +1,184 @@
+"""Periodic tasks for the demo app
+
+Scheduled in CELERY_BEAT_SCHEDULE
+"""
+import logging
+import time
+
+from celery import shared_task
+from django.conf import settings
+
+from zconnect.models import EventDefinition, Product
+
+from . import partitions, presence, retention, rollups
+from .events import evaluate_condition
+from .events import schedule as event_schedule
+from .events.actions import perform_actions
+from .ingest import Reading
+from .models import DemoDevice
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def flush_device_presence():
+    """Write last_seen/online from redis to the database
+
+    See django_demo.presence
+    """
+    updated = presence.flush()
+    went_offline = presence.sweep_offline()
+
+    logger.info("Updated presence for %d devices, %d went offline", updated, len(went_offline))
+
+
+@shared_task
+def expire_old_readings():
+    """Delete readings older than their product's retention period
+
+    If readings are partitioned, whole partitions which have expired for
+    every product are dropped first. See django_demo.retention and
+    django_demo.partitions
+
+    Returns:
+        dict: "partitions" - each partition dropped, with the (estimated)
+            number of readings it had, and "products" - readings deleted and
+            time spent for each product
+    """
+    dropped = {}
+    if partitions.enabled() and partitions.is_partitioned():
+        retentions = list(Product.objects.values_list("periodic_data_retention_short", flat=True))
+        dropped = partitions.drop_expired(time.time(), retentions)
+        if dropped:
+            logger.info(
+                "Dropped expired readings partitions %s, about %d readings",
+                ", ".join(dropped), sum(dropped.values()),
+            )
+
+    report = retention.expire_readings()
+
+    for product_id, result in report.items():
+        logger.info(
+            "Deleted %d expired readings for product %s in %.1fs%s",
+            result["deleted"], product_id, result["seconds"],
+            "" if result["complete"] else " (stopped early, will continue next run)",
+        )
+
+    return {
+        "partitions": dict(dropped),
+        "products": report,
+    }
+
+
+@shared_task
+def maintain_partitions():
+    """Create upcoming readings partitions, if readings are partitioned
+
+    See django_demo.partitions
+    """
+    if not (partitions.enabled() and partitions.is_partitioned()):
+        return
+
+    created = partitions.ensure_partitions(time.time())
+    if created:
+        logger.info("Created readings partitions %s", ", ".join(created))
+
+
+@shared_task
+def repair_rollups():
+    """Recompute rollups which failed to update from the raw readings
+
+    See django_demo.rollups
+
+    Returns:
+        int: number of rollups recomputed
+    """
+    return rollups.repair(getattr(settings, "DEMO_ROLLUPS", {}).get("repair_batch_size", 1000))
+
+
+def _scheduled_definitions():
+    return EventDefinition.objects.filter(enabled=True, scheduled=True)
+
+
+@shared_task
+def trigger_scheduled_events():
+    """Fire scheduled event definitions which are due
+
+    Only definitions which are due are looked at (see
+    django_demo.events.schedule). Each occurrence whose condition holds is
+    fanned out to fire_scheduled_event in chunks of devices, and only acked once every
+    chunk has been enqueued - occurrences which were claimed by a tick that
+    died before fanning them out are fired by a later tick.
+    """
+    options = getattr(settings, "DEMO_SCHEDULER", {})
+    chunk_size = options.get("chunk_size", 500)
+    now = time.time()
+
+    if not event_schedule.index_built():
+        indexed = event_schedule.build_index(_scheduled_definitions(), now)
+        logger.info("Built scheduled event index with %d definitions", indexed)
+
+    def conditions(definition_ids):
+        return dict(_scheduled_definitions().filter(pk__in=definition_ids).values_list("id", "condition"))
+
+    claimed = event_schedule.reclaim_stale(now, lease=options.get("claim_lease", 300))
+    claimed += event_schedule.claim_due(conditions, now, max_catch_up=options.get("max_catch_up", 60))
+    if not claimed:
+        return
+
+    definitions = {
+        pk: (product_id, condition) for pk, product_id, condition in EventDefinition.objects.filter(
+            pk__in={d for d, _ in claimed}).values_list("id", "product_id", "condition")
+    }
+    products = {pk: product_id for pk, (product_id, _) in definitions.items()}
+
+    devices = {}
+    for product_id, device_id in DemoDevice.objects.filter(
+            product_id__in=set(products.values())).order_by("id").values_list("product_id", "id"):
+        devices.setdefault(product_id, []).append(device_id)
+
+    chunks = 0
+    skipped = 0
+    for definition_id, fire_at in claimed:
+        _, condition = definitions.get(definition_id, (None, None))
+        if condition is not None and not event_schedule.parse_schedule(condition).indexed:
+            # Only put in the index to be checked every minute. The condition
+            # doesn't depend on the device, so check it once here rather than
+            # in every chunk.
+            if not evaluate_condition(condition, event_schedule.schedule_context(fire_at)):
+                event_schedule.ack(definition_id, fire_at)
+                skipped += 1
+                continue
+
+        device_ids = devices.get(products.get(definition_id), [])
+        for start in range(0, len(device_ids), chunk_size):
+            fire_scheduled_event.delay(definition_id, fire_at, device_ids[start:start + chunk_size])
+            chunks += 1
+
+        # If enqueueing raised, this and the rest stay pending and are fired
+        # again once their lease runs out
+        event_schedule.ack(definition_id, fire_at)
+
+    logger.info("Fired %d scheduled events in %d chunks", len(claimed) - skipped, chunks)
+
+
+@shared_task
+def fire_scheduled_event(definition_id, fire_at, device_ids):
+    """Perform the actions of a scheduled event definition for some devices
+
+    Args:
+        definition_id (int): event definition
+        fire_at (float): unix time the event was due
+        device_ids (list(int)): devices to perform the actions for
+    """
+    definition = _scheduled_definitions().filter(pk=definition_id).first()
+    if definition is None:
+        return
+
+    # Conditions which aren't indexed were already checked by
+    # trigger_scheduled_events
+    context = event_schedule.schedule_context(fire_at)
+
+    timestamp = event_schedule.fire_time(fire_at)
+    for device in DemoDevice.objects.filter(pk__in=device_ids):
+        perform_actions(device, definition, Reading(device.pk, timestamp, context))
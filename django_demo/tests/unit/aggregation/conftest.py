@@ -0,0 +1,40 @@
+from datetime import timedelta
+import random
+
+import pytest
+
+from zconnect.testutils.factories import DeviceFactory, DeviceSensorFactory, SensorTypeFactory
+from zconnect.zc_timeseries.models import TimeSeriesData
+
+from django_demo.aggregation import REDUCTIONS
+from django_demo.util.timestamps import from_unix
+
+
+@pytest.fixture(name="sensors")
+def fix_sensors():
+    """One sensor for each aggregation type, with irregular readings"""
+    rng = random.Random(4)
+    device = DeviceFactory()
+    start = from_unix(1500000000)
+
+    sensors = {}
+    for aggregation_type in REDUCTIONS:
+        sensor_type = SensorTypeFactory(
+            sensor_name="sensor_{}".format(aggregation_type),
+            aggregation_type=aggregation_type,
+            product=device.product,
+        )
+        sensor = DeviceSensorFactory(device=device, sensor_type=sensor_type, resolution=60)
+        sensors[sensor.pk] = aggregation_type
+
+        offset = 0
+        readings = []
+        while offset < 6 * 60 * 60:
+            readings.append(TimeSeriesData(
+                sensor=sensor, ts=start + timedelta(seconds=offset), value=rng.uniform(-10, 40),
+            ))
+            # Leaves some buckets empty
+            offset += rng.choice([1, 7, 45, 600, 3000])
+        TimeSeriesData.objects.bulk_create(readings)
+
+    return start, sensors
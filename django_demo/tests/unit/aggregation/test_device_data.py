@@ -0,0 +1,41 @@
+"""DemoDevice.optimised_data_fetch against zconnect's own implementation"""
+from datetime import timedelta
+
+from django.test.utils import override_settings
+import pytest
+
+from zconnect.models import AbstractDevice
+
+from django_demo.models import DemoDevice
+
+
+def fetch_both(sensors, resolution, engine="sql"):
+    start, sensors = sensors
+    end = start + timedelta(hours=6)
+    device = DemoDevice.objects.get(sensors__pk=next(iter(sensors)))
+
+    with override_settings(ZCONNECT_TS_AGGREGATION_ENGINE="numpy"):
+        expected = AbstractDevice.optimised_data_fetch(device, start, end, resolution)
+    with override_settings(DEMO_TS_AGGREGATION={"engine": engine, "chunk_size": 50}):
+        result = device.optimised_data_fetch(start, end, resolution)
+
+    return result, expected
+
+
+@pytest.mark.django_db
+class TestDeviceDataFetch:
+    @pytest.mark.parametrize("engine", ["sql", "numpy_chunked"])
+    @pytest.mark.parametrize("resolution", [900, 3600])
+    def test_matches_zconnect(self, sensors, resolution, engine):
+        result, expected = fetch_both(sensors, resolution, engine)
+
+        assert result.keys() == expected.keys()
+        for name, data in expected.items():
+            assert [d.ts for d in result[name]] == [d.ts for d in data]
+            assert [d.value for d in result[name]] == pytest.approx([d.value for d in data])
+
+    def test_raw_at_sensor_resolution(self, sensors):
+        result, expected = fetch_both(sensors, 60)
+
+        assert {name: [d.pk for d in data] for name, data in result.items()} == \
+            {name: [d.pk for d in data] for name, data in expected.items()}
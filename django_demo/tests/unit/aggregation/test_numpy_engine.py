@@ -0,0 +1,39 @@
+from datetime import timedelta
+
+import pytest
+
+from django_demo.aggregation import ChunkedNumpyEngine, NumpyEngine
+
+
+@pytest.mark.django_db
+class TestChunkedNumpyEngine:
+    @pytest.mark.parametrize("chunk_size", [1, 3, 1000])
+    @pytest.mark.parametrize("resolution", [60, 900, 3600])
+    def test_matches_numpy_engine(self, sensors, chunk_size, resolution):
+        start, sensors = sensors
+        end = start + timedelta(hours=6)
+
+        expected = NumpyEngine().aggregate(sensors, start, end, resolution)
+        result = ChunkedNumpyEngine(chunk_size=chunk_size).aggregate(sensors, start, end, resolution)
+
+        assert all(expected.values())
+        # Exactly equal, not approximately
+        assert result == expected
+
+    def test_window(self, sensors):
+        start, sensors = sensors
+        end = start + timedelta(hours=1)
+
+        result = ChunkedNumpyEngine().aggregate(sensors, start, end, 900)
+
+        for buckets in result.values():
+            assert [b["ts"] for b in buckets] == sorted(b["ts"] for b in buckets)
+            assert all(start <= b["ts"] < end for b in buckets)
+
+    def test_no_readings(self, sensors):
+        start, sensors = sensors
+        end = start - timedelta(hours=1)
+
+        assert ChunkedNumpyEngine().aggregate(sensors, end - timedelta(hours=1), end, 900) == {
+            pk: [] for pk in sensors
+        }
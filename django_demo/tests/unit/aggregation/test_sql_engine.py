@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+import pytest
+
+from django_demo.aggregation import NumpyEngine, SqlEngine
+
+
+def assert_matches(result, expected):
+    assert result.keys() == expected.keys()
+    for sensor_id, buckets in expected.items():
+        assert [b["ts"] for b in result[sensor_id]] == [b["ts"] for b in buckets]
+        # Sums are done in a different order in the database
+        assert [b["value"] for b in result[sensor_id]] == pytest.approx([b["value"] for b in buckets])
+
+
+@pytest.mark.django_db
+class TestSqlEngine:
+    @pytest.mark.parametrize("resolution", [60, 900, 3600, 6 * 60 * 60])
+    def test_matches_numpy_engine(self, sensors, resolution):
+        start, sensors = sensors
+        end = start + timedelta(hours=6)
+
+        expected = NumpyEngine().aggregate(sensors, start, end, resolution)
+        result = SqlEngine().aggregate(sensors, start, end, resolution)
+
+        assert all(expected.values())
+        assert_matches(result, expected)
+
+    def test_unaligned_window(self, sensors):
+        start, sensors = sensors
+        start += timedelta(seconds=1234.5)
+        end = start + timedelta(hours=2, seconds=17)
+
+        assert_matches(
+            SqlEngine().aggregate(sensors, start, end, 900),
+            NumpyEngine().aggregate(sensors, start, end, 900),
+        )
+
+    def test_one_query_per_aggregation_type(self, sensors):
+        start, sensors = sensors
+        means = {pk: t for pk, t in sensors.items() if t in ("mean", "max")}
+
+        with CaptureQueriesContext(connection) as context:
+            SqlEngine().aggregate(means, start, start + timedelta(hours=6), 900)
+
+        assert len(context.captured_queries) == 2
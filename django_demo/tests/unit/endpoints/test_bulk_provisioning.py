@@ -0,0 +1,117 @@
+import pytest
+from guardian.shortcuts import assign_perm, get_perms
+
+from zconnect.testutils.factories import DeviceFactory, ProductFactory
+
+from django_demo.models import DemoDevice
+
+
+@pytest.mark.notavern
+class TestBulkProvisioning:
+    route = "/api/v3/devices/bulk/"
+
+    def test_create_many(self, org_admin_client, admin_user, fake_org):
+        product = ProductFactory()
+        items = [
+            {"name": "fridge {}".format(i), "product": product.id, "sim_number": str(i), "orgs": [fake_org.id]}
+            for i in range(20)
+        ]
+
+        response = org_admin_client.post(self.route, items, format="json")
+        assert response.status_code == 200
+        assert all(r["status"] == "created" for r in response.data)
+
+        created = DemoDevice.objects.filter(pk__in=[r["id"] for r in response.data])
+        assert created.count() == 20
+        for device in created:
+            assert list(device.orgs.all()) == [fake_org]
+            assert "view_demodevice" in get_perms(admin_user, device)
+
+    def test_update(self, org_admin_client, fake_org):
+        device = DeviceFactory()
+        device.orgs.add(fake_org)
+
+        response = org_admin_client.post(self.route, [{"id": device.id, "sim_number": "1234", "orgs": []}], format="json")
+        assert response.status_code == 200
+        assert response.data == [{"status": "updated", "id": device.id}]
+
+        device.refresh_from_db()
+        assert device.sim_number == "1234"
+        assert not device.orgs.exists()
+
+    def test_per_item_errors(self, org_admin_client):
+        product = ProductFactory()
+        items = [
+            {"name": "good", "product": product.id},
+            {"name": "no such product", "product": product.id + 1000},
+            {"product": product.id},
+        ]
+
+        response = org_admin_client.post(self.route, items, format="json")
+        assert response.status_code == 200
+
+        good, bad_product, no_name = response.data
+        assert good["status"] == "created"
+        assert "product" in bad_product["errors"]
+        assert "name" in no_name["errors"]
+
+        assert DemoDevice.objects.filter(name="good").exists()
+
+    def test_not_a_list(self, org_admin_client):
+        response = org_admin_client.post(self.route, {"name": "fridge"}, format="json")
+        assert response.status_code == 400
+
+
+@pytest.mark.notavern
+class TestBulkProvisioningPermissions:
+    route = "/api/v3/devices/bulk/"
+
+    def test_view_only_member_cannot_update(self, org_client, fake_org):
+        device = DeviceFactory(name="original")
+        device.orgs.add(fake_org)
+
+        response = org_client.post(self.route, [{"id": device.id, "name": "renamed", "orgs": []}], format="json")
+
+        assert response.status_code == 403
+        assert response.data[0]["status"] == "error"
+        assert response.data[0]["status_code"] == 403
+
+        device.refresh_from_db()
+        assert device.name == "original"
+        assert device.orgs.filter(pk=fake_org.pk).exists()
+
+    def test_object_change_permission(self, org_member, org_client, fake_org):
+        allowed = DeviceFactory()
+        denied = DeviceFactory()
+        for device in (allowed, denied):
+            device.orgs.add(fake_org)
+        assign_perm("change_demodevice", org_member, DemoDevice.objects.get(pk=allowed.pk))
+
+        response = org_client.post(self.route, [
+            {"id": allowed.id, "sim_number": "1"},
+            {"id": denied.id, "sim_number": "2"},
+        ], format="json")
+
+        assert response.status_code == 200
+        assert response.data[0] == {"status": "updated", "id": allowed.id}
+        assert response.data[1]["status_code"] == 403
+
+    def test_no_add_permission(self, org_client):
+        product = ProductFactory()
+
+        response = org_client.post(self.route, [{"name": "fridge", "product": product.id}], format="json")
+
+        assert response.status_code == 403
+        assert not DemoDevice.objects.filter(name="fridge").exists()
+
+    def test_product_not_updated(self, org_admin_client, fake_org):
+        device = DeviceFactory()
+        device.orgs.add(fake_org)
+        other = ProductFactory()
+
+        response = org_admin_client.post(self.route, [{"id": device.id, "product": other.id}], format="json")
+
+        assert response.status_code == 400
+        assert "product" in response.data[0]["errors"]
+        device.refresh_from_db()
+        assert device.product_id != other.id
@@ -0,0 +1,84 @@
+from datetime import datetime
+import time
+
+from django.utils.http import http_date
+
+import pytest
+
+from zconnect.testutils.factories import DeviceFactory, DeviceSensorFactory, SensorTypeFactory
+from zconnect.zc_timeseries.models import TimeSeriesData
+
+
+@pytest.fixture(name="org_device")
+def fix_org_device(fake_org):
+    device = DeviceFactory()
+    device.orgs.add(fake_org)
+    return device
+
+
+@pytest.mark.notavern
+class TestDeviceConditionalGet:
+    route = "/api/v3/devices/{}/"
+
+    def test_not_modified(self, org_client, org_device):
+        path = self.route.format(org_device.id)
+
+        response = org_client.get(path)
+        assert response.status_code == 200
+        etag = response["ETag"]
+        assert response["Last-Modified"]
+
+        response = org_client.get(path, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        assert response["ETag"] == etag
+
+    def test_changed_after_save(self, org_client, org_device):
+        path = self.route.format(org_device.id)
+        etag = org_client.get(path)["ETag"]
+
+        org_device.name = "something else"
+        org_device.save()
+
+        response = org_client.get(path, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert response["ETag"] != etag
+
+    def test_changed_after_reading(self, org_client, org_device):
+        sensor_type = SensorTypeFactory(product=org_device.product)
+        device_sensor = DeviceSensorFactory(device=org_device, sensor_type=sensor_type, resolution=900)
+
+        path = self.route.format(org_device.id)
+        etag = org_client.get(path)["ETag"]
+
+        TimeSeriesData.objects.create(sensor=device_sensor, ts=datetime.utcnow(), value=3.0)
+
+        response = org_client.get(path, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+
+    def test_list_validator(self, org_client, org_device, fake_org):
+        path = "/api/v3/devices/"
+        etag = org_client.get(path)["ETag"]
+
+        assert org_client.get(path, HTTP_IF_NONE_MATCH=etag).status_code == 304
+
+        DeviceFactory().orgs.add(fake_org)
+
+        assert org_client.get(path, HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+    def test_list_without_last_modified(self, org_client, org_device, fake_org):
+        path = "/api/v3/devices/"
+        response = org_client.get(path)
+        assert "Last-Modified" not in response
+
+        # Older than org_device, but new to the list
+        DeviceFactory().orgs.add(fake_org)
+
+        response = org_client.get(path, HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 60))
+        assert response.status_code == 200
+        assert len(response.data["results"]) == 2
+
+    def test_redis_down(self, org_client, org_device, redis_down):
+        response = org_client.get(self.route.format(org_device.id))
+        assert response.status_code == 200
+        assert "ETag" not in response
+        assert "Last-Modified" not in response
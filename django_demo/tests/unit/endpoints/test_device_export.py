@@ -0,0 +1,52 @@
+import csv
+import io
+import json
+
+import pytest
+
+from zconnect.testutils.factories import DeviceFactory
+
+
+def read_streaming(response):
+    return b"".join(response.streaming_content).decode("utf8")
+
+
+@pytest.mark.notavern
+class TestDeviceExport:
+    route = "/api/v3/devices/export/"
+
+    @pytest.fixture(autouse=True)
+    def add_devices(self, fake_org):
+        self.devices = [DeviceFactory() for _ in range(5)]
+        for device in self.devices:
+            device.orgs.add(fake_org)
+
+        # Not in the org - shouldn't be exported
+        DeviceFactory()
+
+    def test_ndjson(self, org_client):
+        response = org_client.get(self.route)
+        assert response.status_code == 200
+        assert response["Content-Type"] == "application/x-ndjson"
+
+        rows = [json.loads(line) for line in read_streaming(response).splitlines()]
+        assert sorted(r["id"] for r in rows) == sorted(d.id for d in self.devices)
+
+    def test_batches(self, org_client, monkeypatch):
+        from django_demo.views import DemoDeviceViewSet
+        monkeypatch.setattr(DemoDeviceViewSet, "export_batch_size", 2)
+
+        response = org_client.get(self.route)
+        assert len(list(response.streaming_content)) == 3
+
+    def test_csv(self, org_client):
+        response = org_client.get(self.route + "?export_format=csv&fields=id,name,orgs")
+        assert response.status_code == 200
+
+        rows = list(csv.DictReader(io.StringIO(read_streaming(response))))
+        assert len(rows) == 5
+        assert set(rows[0].keys()) == {"id", "name", "orgs"}
+
+    def test_bad_format(self, org_client):
+        response = org_client.get(self.route + "?export_format=xml")
+        assert response.status_code == 400
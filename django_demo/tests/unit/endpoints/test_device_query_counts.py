@@ -0,0 +1,94 @@
+"""Regression tests for the number of queries done by the device endpoints
+
+The number of queries to load a page of devices should not depend on the
+number of devices on the page, or on the number of sensors each device has.
+"""
+from datetime import datetime, timedelta
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+import pytest
+
+from zconnect.testutils.factories import DeviceFactory, DeviceSensorFactory, SensorTypeFactory
+from zconnect.zc_timeseries.models import TimeSeriesData
+
+# Upper bound on queries per endpoint, including auth and permission checks
+QUERY_BUDGETS = {
+    "list": 10,
+    "retrieve": 10,
+}
+
+
+def make_fridges(num_devices, fake_org, num_sensors=3, num_readings=2):
+    """Make some devices in fake_org which all have sensor data"""
+    devices = []
+    now = datetime.utcnow()
+
+    for _ in range(num_devices):
+        device = DeviceFactory()
+        device.orgs.add(fake_org)
+
+        for i in range(num_sensors):
+            sensor_type = SensorTypeFactory(
+                sensor_name="sensor_{}".format(i),
+                product=device.product,
+            )
+            device_sensor = DeviceSensorFactory(
+                device=device,
+                resolution=900,
+                sensor_type=sensor_type,
+            )
+            TimeSeriesData.objects.bulk_create([
+                TimeSeriesData(sensor=device_sensor, ts=now - timedelta(minutes=r), value=r)
+                for r in range(num_readings)
+            ])
+
+        devices.append(device)
+
+    return devices
+
+
+def count_queries(client, path):
+    with CaptureQueriesContext(connection) as context:
+        response = client.get(path)
+
+    assert response.status_code == 200
+    return len(context.captured_queries), response
+
+
+@pytest.mark.notavern
+class TestDeviceQueryCounts:
+    route = "/api/v3/devices/"
+
+    def test_list_does_not_scale_with_page_size(self, org_client, fake_org):
+        make_fridges(1, fake_org)
+        single, response = count_queries(org_client, self.route)
+        assert len(response.data["results"]) == 1
+
+        make_fridges(8, fake_org, num_sensors=5)
+        many, response = count_queries(org_client, self.route)
+        assert len(response.data["results"]) == 9
+
+        assert single == many
+        assert many <= QUERY_BUDGETS["list"]
+
+    def test_list_sensors_current(self, org_client, fake_org):
+        """Prefetched readings are the same as the per-device lookup"""
+        devices = make_fridges(3, fake_org)
+
+        _, response = count_queries(org_client, self.route)
+
+        by_id = {d["id"]: d for d in response.data["results"]}
+        for device in devices:
+            expected = device.get_latest_ts_data()
+            assert by_id[device.id]["sensors_current"].keys() == expected.keys()
+
+    def test_retrieve_does_not_scale_with_sensors(self, org_client, fake_org):
+        few, = make_fridges(1, fake_org, num_sensors=1)
+        many, = make_fridges(1, fake_org, num_sensors=8)
+
+        few_queries, _ = count_queries(org_client, "{}{}/".format(self.route, few.id))
+        many_queries, _ = count_queries(org_client, "{}{}/".format(self.route, many.id))
+
+        assert few_queries == many_queries
+        assert many_queries <= QUERY_BUDGETS["retrieve"]
@@ -0,0 +1,43 @@
+import pytest
+
+from zconnect.testutils.factories import DeviceFactory
+
+
+@pytest.mark.notavern
+class TestDeviceKeysetPagination:
+    route = "/api/v3/devices/"
+
+    def test_walk_all_pages(self, org_client, fake_org):
+        devices = [DeviceFactory() for _ in range(7)]
+        for device in devices:
+            device.orgs.add(fake_org)
+
+        seen = []
+        url = self.route + "?pagination=cursor&page_size=3"
+        while url:
+            response = org_client.get(url)
+            assert response.status_code == 200
+            assert "count" not in response.data
+            seen.extend(d["id"] for d in response.data["results"])
+            url = response.data["next"]
+
+        expected = sorted(devices, key=lambda d: (d.product_id, d.id))
+        assert seen == [d.id for d in expected]
+
+    def test_invalid_cursor(self, org_client):
+        response = org_client.get(self.route + "?cursor=notacursor")
+        assert response.status_code == 404
+
+    def test_page_size_capped(self, org_client, fake_org):
+        DeviceFactory().orgs.add(fake_org)
+
+        response = org_client.get(self.route + "?pagination=cursor&page_size=100000")
+        assert response.status_code == 200
+        assert len(response.data["results"]) == 1
+
+    def test_default_pagination_unchanged(self, org_client, fake_org):
+        DeviceFactory().orgs.add(fake_org)
+
+        response = org_client.get(self.route)
+        assert response.status_code == 200
+        assert "cursor" not in (response.data.get("next") or "")
@@ -0,0 +1,56 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+import pytest
+
+from zconnect.testutils.factories import DeviceFactory
+
+
+@pytest.mark.notavern
+class TestSparseFieldsets:
+    route = "/api/v3/devices/"
+
+    @pytest.fixture(autouse=True)
+    def add_devices(self, fake_org):
+        for _ in range(3):
+            DeviceFactory().orgs.add(fake_org)
+
+    def test_fields(self, org_client):
+        response = org_client.get(self.route + "?fields=id,name")
+        assert response.status_code == 200
+        for device in response.data["results"]:
+            assert set(device.keys()) == {"id", "name"}
+
+    def test_without_id(self, org_client):
+        response = org_client.get(self.route + "?fields=name")
+        assert response.status_code == 200
+        assert len(response.data["results"]) == 3
+        for device in response.data["results"]:
+            assert set(device.keys()) == {"name"}
+
+        response = org_client.get(self.route + "?fields=name,online,last_seen")
+        assert response.status_code == 200
+
+        response = org_client.get(self.route + "?omit=id")
+        assert response.status_code == 200
+        assert all("id" not in device for device in response.data["results"])
+
+    def test_omit(self, org_client):
+        response = org_client.get(self.route + "?omit=sensors_current,orgs")
+        assert response.status_code == 200
+        for device in response.data["results"]:
+            assert "sensors_current" not in device
+            assert "orgs" not in device
+            assert "name" in device
+
+    def test_unknown_field(self, org_client):
+        response = org_client.get(self.route + "?fields=id,bloop")
+        assert response.status_code == 400
+
+    def test_omitted_fields_not_loaded(self, org_client):
+        with CaptureQueriesContext(connection) as full:
+            org_client.get(self.route + "?fields=id,name,orgs,sensors_current")
+        with CaptureQueriesContext(connection) as sparse:
+            org_client.get(self.route + "?fields=id,name")
+
+        # No orgs or sensors prefetch
+        assert len(sparse.captured_queries) == len(full.captured_queries) - 2
@@ -0,0 +1,36 @@
+import pytest
+
+from django_demo.events import ConditionSyntaxError, compile_condition, evaluate_condition
+
+
+@pytest.mark.parametrize("condition, values, expected", (
+    ("process_box_temp<4", {"process_box_temp": 3.5}, True),
+    ("process_box_temp<4", {"process_box_temp": 4.0}, False),
+    ("property_door_opened==1", {"property_door_opened": 1.0}, True),
+    ("property_door_opened==1", {}, False),
+    ("(process_box_temp>8||process_box_temp<2)&&property_door_opened==0",
+     {"process_box_temp": 1.0, "property_door_opened": 0.0}, True),
+    ("(process_box_temp>8||process_box_temp<2)&&property_door_opened==0",
+     {"process_box_temp": 5.0, "property_door_opened": 0.0}, False),
+    ("process_box_temp < -1.5", {"process_box_temp": -2}, True),
+    ("4 > process_box_temp", {"process_box_temp": 3}, True),
+))
+def test_evaluate(condition, values, expected):
+    assert evaluate_condition(condition, values) == expected
+
+
+@pytest.mark.parametrize("condition", ("", "a<", "a<<3", "(a<3", "a<3)", "a&&b", "a<3 $"))
+def test_invalid(condition):
+    with pytest.raises(ConditionSyntaxError):
+        compile_condition(condition)
+
+
+def test_shared_slots():
+    slots = {}
+    low, _ = compile_condition("process_box_temp<4", slots)
+    door, _ = compile_condition("property_door_opened==1&&process_box_temp<8", slots)
+
+    assert slots == {"process_box_temp": 0, "property_door_opened": 1}
+    assert low([3.0, 0.0])
+    assert not door([3.0, 0.0])
+    assert door([3.0, 1.0])
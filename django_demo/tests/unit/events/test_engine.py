@@ -0,0 +1,221 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+import pytest
+
+from zconnect.models import EventDefinition
+from zconnect.testutils.factories import (
+    DeviceFactory, DeviceSensorFactory, EventDefinitionFactory, ProductFactory, SensorTypeFactory,
+)
+
+from django_demo.events import device_products, evaluator_cache, process_readings
+from django_demo.events.actions import ACTIONS
+from django_demo.events.engine import DeviceProductCache
+from django_demo.events.state import EventStateStore
+from django_demo.handlers import buffered_periodic_handler
+from django_demo.ingest import Reading, write_readings
+
+
+@pytest.fixture(name="fridge")
+def fix_fridge():
+    evaluator_cache.clear()
+    device_products.clear()
+
+    device = DeviceFactory()
+    EventDefinitionFactory(
+        product=device.product,
+        ref="low box temp",
+        condition="process_box_temp<4",
+        actions={},
+        debounce_window=60,
+        enabled=True,
+        scheduled=False,
+    )
+    return device
+
+
+@pytest.mark.django_db
+class TestProcessReadings:
+    def test_fires_on_rising_edge(self, fridge):
+        now = datetime.utcnow()
+
+        def reading(seconds, temp):
+            return Reading(fridge.id, now + timedelta(seconds=seconds), {"process_box_temp": temp})
+
+        assert len(process_readings([reading(0, 3.0)])) == 1
+        # Still low - doesn't fire again
+        assert not process_readings([reading(1, 3.0)])
+        # Back up and then down again within the debounce window
+        assert not process_readings([reading(2, 5.0), reading(3, 3.0)])
+        # Down again after the debounce window
+        assert not process_readings([reading(100, 5.0)])
+        assert len(process_readings([reading(101, 3.0)])) == 1
+
+    def test_evaluators_cached(self, fridge):
+        process_readings([Reading(fridge.id, datetime.utcnow(), {"process_box_temp": 5.0})])
+
+        with CaptureQueriesContext(connection) as context:
+            process_readings([Reading(fridge.id, datetime.utcnow(), {"process_box_temp": 5.0})])
+        assert not context.captured_queries
+
+    def test_invalidated_when_definition_changes(self, fridge):
+        process_readings([Reading(fridge.id, datetime.utcnow(), {"process_box_temp": 5.0})])
+
+        EventDefinitionFactory(
+            product=fridge.product,
+            ref="warm box",
+            condition="process_box_temp>4",
+            actions={},
+            debounce_window=60,
+            enabled=True,
+            scheduled=False,
+        )
+
+        fired = process_readings([Reading(fridge.id, datetime.utcnow(), {"process_box_temp": 5.0})])
+        assert [definition.ref for _, definition in fired] == ["warm box"]
+
+    @pytest.mark.parametrize("num_definitions", (1, 20))
+    def test_constant_redis_calls(self, fridge, fake_get_redis, num_definitions):
+        for i in range(num_definitions - 1):
+            EventDefinitionFactory(
+                product=fridge.product,
+                ref="def {}".format(i),
+                condition="process_box_temp<{}".format(i),
+                actions={},
+                debounce_window=60,
+                enabled=True,
+                scheduled=False,
+            )
+        readings = [Reading(fridge.id, datetime.utcnow(), {"process_box_temp": 5.0 - i}) for i in range(5)]
+        # Load the definitions
+        process_readings(readings[:1])
+
+        # mockredis can't run Lua, so the state is saved with WATCH/MULTI - one
+        # round trip per device instead of one for all of them
+        with patch.object(fake_get_redis, "pipeline", wraps=fake_get_redis.pipeline) as pipeline, \
+                patch.object(fake_get_redis, "get", side_effect=AssertionError("not pipelined")), \
+                patch.object(EventStateStore, "_use_lua", False):
+            process_readings(readings[1:])
+
+        # Load and save
+        assert pipeline.call_count == 2
+
+    def test_concurrent_evaluation_fires_once(self, fridge):
+        reading = Reading(fridge.id, datetime.utcnow(), {"process_box_temp": 3.0})
+
+        # Another process loads the state before this one fires the event...
+        other = EventStateStore()
+        other.load([fridge.id])
+
+        assert len(process_readings([reading])) == 1
+
+        # ...and then evaluates the same reading, but the event has already
+        # fired
+        assert not process_readings([reading], state=other)
+
+    def test_conflicting_save_not_written(self, fridge):
+        definition = EventDefinition.objects.get(product=fridge.product)
+
+        first = EventStateStore()
+        second = EventStateStore()
+        first.load([fridge.id])
+        second.load([fridge.id])
+
+        assert first.should_fire(fridge.id, definition, True, 1000.0)
+        assert second.should_fire(fridge.id, definition, True, 1000.0)
+
+        assert first.save() == set()
+        assert second.save() == {fridge.id}
+
+        second.reload([fridge.id])
+        assert not second.should_fire(fridge.id, definition, True, 1000.0)
+
+
+@pytest.mark.django_db
+class TestDeviceProducts:
+    def test_invalidated_when_device_saved(self, fridge):
+        assert device_products.get_many([fridge.id]) == {fridge.id: fridge.product_id}
+
+        fridge.product = ProductFactory()
+        fridge.save()
+
+        assert device_products.get_many([fridge.id]) == {fridge.id: fridge.product_id}
+
+    def test_entries_expire(self, fridge):
+        cache = DeviceProductCache(ttl=0)
+        cache.get_many([fridge.id])
+
+        # eg, changed in another process
+        with CaptureQueriesContext(connection) as context:
+            cache.get_many([fridge.id])
+        assert len(context.captured_queries) == 1
+
+
+@pytest.mark.django_db
+class TestActions:
+    def test_registered_action_performed(self, fridge):
+        EventDefinition.objects.filter(product=fridge.product).update(actions={"test_hook": {"level": 2}})
+        evaluator_cache.clear()
+
+        calls = []
+
+        def hook(device, definition, reading, level):
+            calls.append((device.pk, level))
+
+        with patch.dict(ACTIONS, {"test_hook": hook}):
+            process_readings([Reading(fridge.id, datetime.utcnow(), {"process_box_temp": 3.0})])
+
+        assert calls == [(fridge.id, 2)]
+
+    def test_zconnect_action_delegated(self, fridge):
+        params = {"verb": "reported", "description": "Fridge temp is too cold", "notify": True}
+        EventDefinition.objects.filter(product=fridge.product).update(actions={"activity": params})
+        evaluator_cache.clear()
+
+        activity = Mock()
+        now = datetime.utcnow()
+
+        with patch("django_demo.events.actions.get_action_handlers", return_value={"activity": activity}):
+            process_readings([Reading(fridge.id, now, {"process_box_temp": 3.0})])
+
+        assert activity.call_count == 1
+        context, action_args = activity.call_args[0]
+        assert context["device"].pk == fridge.pk
+        assert context["ts_data"] == {"process_box_temp": 3.0}
+        assert action_args == params
+
+    def test_unknown_action_logged(self, fridge, caplog):
+        EventDefinition.objects.filter(product=fridge.product).update(actions={"sms": {}})
+        evaluator_cache.clear()
+
+        with patch("django_demo.events.actions.get_action_handlers", return_value={}):
+            assert len(process_readings([Reading(fridge.id, datetime.utcnow(), {"process_box_temp": 3.0})])) == 1
+
+        assert any(r.levelname == "ERROR" and "sms" in r.getMessage() for r in caplog.records)
+
+
+@pytest.mark.django_db
+class TestEvaluationPath:
+    """Readings from the listener are evaluated once, when they are written"""
+
+    def test_handler_doesnt_evaluate(self, fridge):
+        message = SimpleNamespace(device=fridge, body={"process_box_temp": 3.0}, timestamp=None)
+
+        with patch("django_demo.handlers.get_ingest_pipeline") as pipeline, \
+                patch("django_demo.events.engine.perform_actions") as perform:
+            buffered_periodic_handler(message, None)
+
+        assert pipeline.return_value.submit.call_count == 1
+        assert not perform.called
+
+    def test_written_readings_evaluated_once(self, fridge):
+        sensor_type = SensorTypeFactory(sensor_name="process_box_temp", product=fridge.product)
+        DeviceSensorFactory(device=fridge, sensor_type=sensor_type, resolution=60)
+
+        with patch("django_demo.events.engine.perform_actions") as perform:
+            write_readings([Reading(fridge.id, datetime.utcnow(), {"process_box_temp": 3.0})])
+
+        assert perform.call_count == 1
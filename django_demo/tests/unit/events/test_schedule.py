@@ -0,0 +1,180 @@
+import calendar
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+from zconnect.testutils.factories import DeviceFactory, EventDefinitionFactory
+
+from django_demo import tasks
+from django_demo.events import schedule
+
+# A Sunday
+SUNDAY_NOON = calendar.timegm(datetime(2026, 10, 18, 12, 0).timetuple())
+
+
+def utc(ts):
+    return datetime.utcfromtimestamp(ts)
+
+
+class TestSchedule:
+    def test_weekly(self):
+        weekly = schedule.parse_schedule("time==28800&&day==0")
+
+        first = weekly.next_after(SUNDAY_NOON)
+        assert utc(first) == datetime(2026, 10, 19, 8, 0)
+        assert utc(weekly.next_after(first)) == datetime(2026, 10, 26, 8, 0)
+
+    def test_daily_or(self):
+        sched = schedule.parse_schedule("time==3600||time==46800")
+        assert utc(sched.next_after(SUNDAY_NOON)) == datetime(2026, 10, 18, 13, 0)
+
+    def test_not_indexed(self):
+        sched = schedule.parse_schedule("process_box_temp<4&&time==3600")
+        assert not sched.indexed
+        assert sched.next_after(SUNDAY_NOON + 1) == SUNDAY_NOON + 60
+
+
+class TestClaimDue:
+    def setup_method(self):
+        self.conditions = {1: "time==43200", 2: "time==0"}
+
+    def lookup(self, ids):
+        return {i: self.conditions[i] for i in ids if i in self.conditions}
+
+    def build(self, now):
+        definitions = [SimpleNamespace(pk=pk, condition=c) for pk, c in self.conditions.items()]
+        schedule.build_index(definitions, now)
+
+    def test_only_due_claimed_once(self):
+        self.build(SUNDAY_NOON - 60)
+
+        claimed = schedule.claim_due(self.lookup, SUNDAY_NOON)
+        assert claimed == [(1, SUNDAY_NOON)]
+
+        # Not fired again by an overlapping tick
+        assert schedule.claim_due(self.lookup, SUNDAY_NOON + 30) == []
+
+    def test_catch_up(self):
+        self.build(SUNDAY_NOON - 60)
+
+        # Ticks missed for three days
+        claimed = schedule.claim_due(self.lookup, SUNDAY_NOON + 3 * schedule.DAY_SECONDS)
+
+        assert [c for c in claimed if c[0] == 1] == [
+            (1, SUNDAY_NOON + i * schedule.DAY_SECONDS) for i in range(4)
+        ]
+        assert len([c for c in claimed if c[0] == 2]) == 3
+
+    def test_unacked_fired_again(self):
+        self.build(SUNDAY_NOON - 60)
+
+        claimed = schedule.claim_due(self.lookup, SUNDAY_NOON)
+        assert claimed == [(1, SUNDAY_NOON)]
+
+        # Still within the lease - whoever claimed it may be fanning it out
+        assert schedule.reclaim_stale(SUNDAY_NOON + 60, lease=300) == []
+        # Never acked
+        assert schedule.reclaim_stale(SUNDAY_NOON + 301, lease=300) == claimed
+        assert schedule.reclaim_stale(SUNDAY_NOON + 302, lease=300) == []
+
+        schedule.ack(*claimed[0])
+        assert schedule.reclaim_stale(SUNDAY_NOON + 1000, lease=300) == []
+
+    def test_deleted_removed(self):
+        self.build(SUNDAY_NOON - 60)
+        del self.conditions[1]
+
+        assert schedule.claim_due(self.lookup, SUNDAY_NOON) == []
+
+
+@pytest.mark.django_db
+def test_trigger_fans_out_in_chunks(settings):
+    settings.DEMO_SCHEDULER = {"chunk_size": 2, "max_catch_up": 60}
+
+    device = DeviceFactory()
+    for _ in range(4):
+        DeviceFactory(product=device.product)
+
+    definition = EventDefinitionFactory(
+        product=device.product,
+        condition="time==0",
+        actions={},
+        enabled=True,
+        scheduled=True,
+    )
+    schedule.build_index([definition], SUNDAY_NOON - schedule.DAY_SECONDS)
+
+    with patch.object(tasks, "time") as fake_time, \
+            patch.object(tasks.fire_scheduled_event, "delay") as delay:
+        fake_time.time.return_value = SUNDAY_NOON
+        tasks.trigger_scheduled_events()
+
+    chunks = [call[0][2] for call in delay.call_args_list]
+    assert [len(c) for c in chunks] == [2, 2, 1]
+    assert all(call[0][0] == definition.pk for call in delay.call_args_list)
+
+
+@pytest.mark.django_db
+def test_trigger_broker_error_not_lost(settings):
+    settings.DEMO_SCHEDULER = {"chunk_size": 2, "max_catch_up": 60, "claim_lease": 300}
+
+    device = DeviceFactory()
+    definition = EventDefinitionFactory(
+        product=device.product,
+        condition="time==0",
+        actions={},
+        enabled=True,
+        scheduled=True,
+    )
+    schedule.build_index([definition], SUNDAY_NOON - schedule.DAY_SECONDS)
+
+    with patch.object(tasks, "time") as fake_time, \
+            patch.object(tasks.fire_scheduled_event, "delay", side_effect=ConnectionError) as delay:
+        fake_time.time.return_value = SUNDAY_NOON
+        with pytest.raises(ConnectionError):
+            tasks.trigger_scheduled_events()
+
+    with patch.object(tasks, "time") as fake_time, \
+            patch.object(tasks.fire_scheduled_event, "delay") as delay:
+        fake_time.time.return_value = SUNDAY_NOON + 400
+        tasks.trigger_scheduled_events()
+
+    assert [call[0][:2] for call in delay.call_args_list] == [
+        (definition.pk, SUNDAY_NOON - 12 * 60 * 60),
+    ]
+
+
+@pytest.mark.django_db
+def test_trigger_checks_unindexed_once(settings):
+    settings.DEMO_SCHEDULER = {"chunk_size": 2, "max_catch_up": 60}
+
+    device = DeviceFactory()
+    for _ in range(4):
+        DeviceFactory(product=device.product)
+
+    # Not indexed, so claimed every minute
+    holds, never = [
+        EventDefinitionFactory(
+            product=device.product,
+            condition=condition,
+            actions={},
+            enabled=True,
+            scheduled=True,
+        )
+        for condition in ("time>=3600", "time<60")
+    ]
+    schedule.build_index([holds, never], SUNDAY_NOON - 60)
+
+    with patch.object(tasks, "time") as fake_time, \
+            patch.object(tasks.fire_scheduled_event, "delay") as delay:
+        fake_time.time.return_value = SUNDAY_NOON
+        tasks.trigger_scheduled_events()
+
+    # Nothing enqueued for the condition which doesn't hold
+    assert delay.call_count == 3
+    assert all(call[0][0] == holds.pk for call in delay.call_args_list)
+
+    # ...and it has been acked
+    assert schedule.reclaim_stale(SUNDAY_NOON + 400, lease=300) == []
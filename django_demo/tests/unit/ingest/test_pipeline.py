@@ -0,0 +1,181 @@
+from datetime import datetime
+import queue
+import threading
+from unittest.mock import patch
+
+import pytest
+from redis.exceptions import RedisError
+
+from django_demo.ingest import IngestPipeline, PartialWriteError, Reading, ReadingShed
+from django_demo.ingest.pipeline import _dump_reading
+
+
+def make_reading(device_id):
+    return Reading(device_id, datetime(2018, 1, 1, 12, 0, 0, 5), {"process_box_temp": 4.0})
+
+
+class BlockedWriter:
+    """Writes nothing until released, so the queue fills up"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.written = []
+
+    def __call__(self, readings):
+        self.started.set()
+        self.release.wait(5)
+        self.written.extend(readings)
+
+
+def occupy_writer(pipeline, writer):
+    """Submit one reading and wait for the (only) writer to take it"""
+    pipeline.submit(make_reading(0), wait=False)
+    assert writer.started.wait(5)
+
+
+class TestIngestPipeline:
+    def test_invalid_policy(self):
+        with pytest.raises(ValueError):
+            IngestPipeline(list, overflow="explode")
+
+    def test_written_in_batches(self):
+        batches = []
+        pipeline = IngestPipeline(batches.append, writers=1, batch_size=10, max_delay=0.01)
+
+        for i in range(25):
+            pipeline.submit(make_reading(i), wait=False)
+        pipeline.stop(timeout=5)
+
+        assert sum(len(b) for b in batches) == 25
+        assert all(len(b) <= 10 for b in batches)
+        assert pipeline.stats()["written"] == 25
+
+    def test_wait_until_written(self):
+        written = []
+        pipeline = IngestPipeline(written.extend, writers=1, batch_size=10, max_delay=0.01)
+
+        assert pipeline.submit(make_reading(1))
+        assert written == [make_reading(1)]
+
+        pipeline.stop(timeout=5)
+
+    def test_write_error_raised_to_submitter(self):
+        def fail(readings):
+            raise ValueError("db down")
+
+        pipeline = IngestPipeline(fail, writers=1, batch_size=10, max_delay=0.01)
+
+        with pytest.raises(ValueError):
+            pipeline.submit(make_reading(1))
+        assert pipeline.stats()["failed"] == 1
+
+        pipeline.stop(timeout=5)
+
+    def test_partial_write_error_only_raised_for_failed_devices(self):
+        def fail_one(readings):
+            if any(r.device_id == 1 for r in readings):
+                raise PartialWriteError({1})
+
+        pipeline = IngestPipeline(fail_one, writers=1, batch_size=10, max_delay=0.01)
+        errors = {}
+
+        def submit(device_id):
+            try:
+                pipeline.submit(make_reading(device_id))
+            except PartialWriteError as e:
+                errors[device_id] = e
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in (1, 2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=5)
+
+        assert list(errors) == [1]
+        assert pipeline.stats()["failed"] == 1
+        assert pipeline.stats()["written"] == 1
+
+        pipeline.stop(timeout=5)
+
+    def test_shed(self):
+        writer = BlockedWriter()
+        pipeline = IngestPipeline(writer, writers=1, queue_size=2, overflow="shed", batch_size=1, max_delay=0.01)
+
+        occupy_writer(pipeline, writer)
+
+        results = [pipeline.submit(make_reading(i), wait=False) for i in range(4)]
+
+        assert results == [True, True, False, False]
+        assert pipeline.stats()["shed"] == 2
+
+        writer.release.set()
+        pipeline.stop(timeout=5)
+        assert len(writer.written) == 3
+
+    def test_shed_raised_to_waiting_submitter(self):
+        writer = BlockedWriter()
+        pipeline = IngestPipeline(writer, writers=1, queue_size=1, overflow="shed", batch_size=1, max_delay=0.01)
+
+        occupy_writer(pipeline, writer)
+        pipeline.submit(make_reading(1), wait=False)
+
+        with pytest.raises(ReadingShed):
+            pipeline.submit(make_reading(2))
+
+        writer.release.set()
+        pipeline.stop(timeout=5)
+        assert [r.device_id for r in writer.written] == [0, 1]
+
+    def test_block_timeout(self):
+        writer = BlockedWriter()
+        pipeline = IngestPipeline(writer, writers=1, queue_size=1, overflow="block",
+                                  block_timeout=0.01, batch_size=1, max_delay=0.01)
+
+        occupy_writer(pipeline, writer)
+
+        assert pipeline.submit(make_reading(1), wait=False)
+        assert not pipeline.submit(make_reading(2), wait=False)
+
+        writer.release.set()
+        pipeline.stop(timeout=5)
+
+    def test_spill(self):
+        writer = BlockedWriter()
+        pipeline = IngestPipeline(writer, writers=1, queue_size=2, overflow="spill",
+                                  batch_size=1, max_delay=0.01, spill_key="test_spill")
+
+        occupy_writer(pipeline, writer)
+
+        results = [pipeline.submit(make_reading(i), wait=False) for i in range(1, 6)]
+
+        assert all(results)
+        stats = pipeline.stats()
+        assert stats["spilled"] == 3
+        assert stats["shed"] == 0
+
+        writer.release.set()
+        pipeline.stop(timeout=5)
+
+        # Spilled readings come back out of redis in order
+        assert [r.device_id for r in writer.written] == [0, 1, 2, 3, 4, 5]
+        assert writer.written[-1] == make_reading(5)
+
+    def test_unspill_put_back_fails(self, fake_get_redis):
+        pipeline = IngestPipeline(lambda readings: None, queue_size=10, overflow="spill",
+                                  batch_size=5, spill_key="test_spill")
+        fake_get_redis.rpush("test_spill", *[_dump_reading(make_reading(i)) for i in range(3)])
+
+        # The queue fills up after the first reading, and redis goes away
+        # before the rest can be put back
+        with patch.object(pipeline._queue, "put_nowait", side_effect=[None, queue.Full()]), \
+                patch.object(fake_get_redis, "lpush", side_effect=RedisError):
+            assert pipeline._unspill() == 1
+
+        assert fake_get_redis.llen("test_spill") == 0
+        assert list(pipeline._unspilled) == [make_reading(1), make_reading(2)]
+
+        # They are queued next time, before anything else from redis
+        fake_get_redis.rpush("test_spill", _dump_reading(make_reading(3)))
+        assert pipeline._unspill() == 3
+        assert [pipeline._queue.get_nowait()[1].device_id for _ in range(3)] == [1, 2, 3]
@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+import time
+from unittest.mock import patch
+
+from django.conf import settings
+import pytest
+
+from django_demo.handlers import buffered_periodic_handler
+from django_demo.ingest.ratelimit import TokenBucketLimiter, bucket_key
+
+
+def make_limiter(**kwargs):
+    return TokenBucketLimiter.from_settings(settings.DEFAULT_LISTENER_SETTINGS, **kwargs)
+
+
+class TestTokenBucketLimiter:
+    def test_rate_limiter_event(self):
+        """rate_limiter_event only allows 1 message per period"""
+        limiter = make_limiter()
+
+        assert limiter.admit("rate_limiter_event", 1)
+        assert not limiter.admit("rate_limiter_event", 1)
+
+        # Separate bucket for each device
+        assert limiter.admit("rate_limiter_event", 2)
+
+    def test_unlimited_type(self):
+        limiter = make_limiter()
+        assert all(limiter.admit("not_a_configured_type", 1) for _ in range(100))
+
+    def test_limit_shared_between_processes(self):
+        """Buckets live in redis, so a second limiter sees the same tokens"""
+        first = make_limiter(lease_size=1)
+        second = make_limiter(lease_size=1)
+
+        assert first.admit("rate_limiter_event", 1)
+        assert not second.admit("rate_limiter_event", 1)
+
+    def test_local_preadmission(self, fake_get_redis):
+        limiter = make_limiter(lease_size=10)
+
+        assert limiter.admit("periodic", 1)
+
+        with patch.object(fake_get_redis, "hmget", side_effect=AssertionError("used redis")):
+            assert all(limiter.admit("periodic", 1) for _ in range(9))
+
+    def test_admit_many(self):
+        limiter = make_limiter(lease_size=1)
+
+        results = limiter.admit_many([
+            ("rate_limiter_event", 1),
+            ("rate_limiter_event", 1),
+            ("periodic", 1),
+        ])
+
+        assert results == [True, False, True]
+
+    def test_unused_lease_given_back(self, fake_get_redis):
+        limiter = make_limiter(lease_size=10, lease_ttl=0.01)
+
+        # Leases 10 of the 100 tokens, and uses 1
+        assert limiter.admit("event", 1)
+        assert float(fake_get_redis.hget(bucket_key("event", 1), "tokens")) == pytest.approx(90, abs=0.1)
+
+        time.sleep(0.02)
+
+        # The expired lease is given back along with the next round trip
+        assert limiter.admit("event", 2)
+        assert float(fake_get_redis.hget(bucket_key("event", 1), "tokens")) == pytest.approx(99, abs=0.1)
+
+    def test_given_back_up_to_capacity(self, fake_get_redis):
+        limiter = make_limiter(lease_size=10, lease_ttl=0.01)
+        key = bucket_key("event", 1)
+
+        assert limiter.admit("event", 1)
+        # eg, refilled while the tokens were leased
+        fake_get_redis.hset(key, "tokens", 95)
+
+        time.sleep(0.02)
+        assert limiter.admit("event", 2)
+        assert float(fake_get_redis.hget(key, "tokens")) == pytest.approx(100, abs=0.1)
+
+
+def test_periodic_handler_rate_limited():
+    limiter = TokenBucketLimiter({"periodic": 2}, 600, lease_size=1)
+    message = SimpleNamespace(device=SimpleNamespace(pk=1), body={"process_box_temp": 3.0}, timestamp=None)
+
+    with patch("django_demo.handlers.get_rate_limiter", return_value=limiter), \
+            patch("django_demo.handlers.get_ingest_pipeline") as pipeline:
+        for _ in range(3):
+            buffered_periodic_handler(message, None)
+
+    assert pipeline.return_value.submit.call_count == 2
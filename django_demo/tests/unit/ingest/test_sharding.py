@@ -0,0 +1,182 @@
+from collections import Counter
+import os
+import time
+
+import pytest
+
+from zconnect.testutils.factories import DeviceFactory
+
+from django_demo.ingest.sharding import HashRing, KnownDevices, ShardedListener
+from django_demo.ingest.sources import broker_settings, parse_topic
+
+TOPIC = "iot-2/type/fridge/id/1/evt/periodic/fmt/json"
+
+
+def counting_worker(shard, work_queue, processed, last_lag):
+    """Counts messages, and dies on a b"crash" payload"""
+    while True:
+        item = work_queue.get()
+        if item is None:
+            break
+        if item[2] == b"crash":
+            os._exit(1)
+        with processed.get_lock():
+            processed.value += 1
+
+
+def stuck_worker(shard, work_queue, processed, last_lag):
+    """Never takes anything off its queue"""
+    while True:
+        time.sleep(1)
+
+
+class FakeSource:
+    def __init__(self, on_message):
+        self.on_message = on_message
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class TestHashRing:
+    def test_stable(self):
+        ring = HashRing(4)
+        assert [ring.shard_for(i) for i in range(100)] == [HashRing(4).shard_for(i) for i in range(100)]
+
+    def test_distribution(self):
+        ring = HashRing(4)
+        counts = Counter(ring.shard_for(i) for i in range(10000))
+
+        assert set(counts) == {0, 1, 2, 3}
+        assert min(counts.values()) > 1500
+
+    def test_adding_shard_moves_few_devices(self):
+        before = HashRing(4)
+        after = HashRing(5)
+
+        moved = sum(before.shard_for(i) != after.shard_for(i) for i in range(10000))
+        # Ideally 1/5 - allow some slack
+        assert moved < 3000
+
+
+class TestParseTopic:
+    def test_device_event(self):
+        assert parse_topic("iot-2/type/fridge/id/123/evt/periodic/fmt/json") == ("123", "periodic")
+
+    def test_other_topic(self):
+        assert parse_topic("iot-2/cmd/blah") == (None, None)
+
+
+class TestSupervision:
+    def test_restarts_dead_worker(self):
+        listener = ShardedListener(1, FakeSource, worker=counting_worker, known_devices={1})
+        listener.start()
+        shard = listener.shards[0]
+
+        listener.dispatch(TOPIC, b"crash")
+        shard.process.join(5)
+        assert not shard.process.is_alive()
+
+        assert listener.check_workers() == [0]
+        assert shard.restarts == 1
+        assert shard.process.is_alive()
+
+        # Nothing to do if they're all alive
+        assert listener.check_workers() == []
+
+        listener.stop(timeout=5)
+
+    def test_queued_messages_kept(self):
+        listener = ShardedListener(1, FakeSource, worker=counting_worker, known_devices={1})
+        listener.start()
+        shard = listener.shards[0]
+
+        listener.dispatch(TOPIC, b"crash")
+        for _ in range(3):
+            listener.dispatch(TOPIC, b"{}")
+        shard.process.join(5)
+
+        listener.check_workers()
+        listener.stop(timeout=5)
+
+        # Only the message being handled when it crashed is lost
+        assert shard.processed.value == 3
+
+
+class TestDispatch:
+    def test_unknown_devices_dropped(self):
+        listener = ShardedListener(2, FakeSource, worker=counting_worker, known_devices={1})
+
+        listener.dispatch(TOPIC, b"{}")
+        listener.dispatch(TOPIC.replace("/id/1/", "/id/2/"), b"{}")
+        listener.dispatch(TOPIC.replace("/id/1/", "/id/abc/"), b"{}")
+
+        assert sum(shard.enqueued for shard in listener.shards) == 1
+        assert listener.unknown == 2
+
+    def test_stop_with_full_queue(self):
+        listener = ShardedListener(1, FakeSource, queue_size=1, worker=stuck_worker, known_devices={1})
+        listener.start()
+        shard = listener.shards[0]
+
+        listener.dispatch(TOPIC, b"{}")
+
+        started = time.monotonic()
+        listener.stop(timeout=1)
+
+        assert time.monotonic() - started < 5
+        assert not shard.process.is_alive()
+
+
+@pytest.mark.django_db
+class TestKnownDevices:
+    def test_known(self):
+        device = DeviceFactory()
+        known = KnownDevices()
+
+        assert device.id in known
+        assert device.id + 1000 not in known
+
+    def test_new_device_reloaded(self):
+        known = KnownDevices(min_reload=0)
+        assert DeviceFactory().id in known
+
+        device = DeviceFactory()
+        assert device.id in known
+
+    def test_reloads_limited(self):
+        known = KnownDevices(min_reload=60)
+        assert DeviceFactory().id in known
+
+        device = DeviceFactory()
+        # Not reloaded again yet
+        assert device.id not in known
+
+
+class TestBrokerSettings:
+    def test_broker_url(self):
+        broker = broker_settings({
+            "broker-url": "vernemq",
+            "full_client_id": "g:abcdef:listener:125",
+            "port": 1883,
+        }, "demo-ingest", ":dispatcher")
+
+        assert broker == {
+            "host": "vernemq",
+            "port": 1883,
+            "client_id": "g:abcdef:listener:125:dispatcher",
+            "share": True,
+        }
+
+    def test_ibm_shared(self):
+        broker = broker_settings({"org": "abc123", "type": "shared"}, "demo-ingest", ":dispatcher")
+
+        assert broker == {
+            "host": "abc123.messaging.internetofthings.ibmcloud.com",
+            "port": 8883,
+            "client_id": "A:abc123:demo-ingest",
+            "share": False,
+        }
@@ -0,0 +1,85 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from django_demo.ingest import reading_from_message, reading_from_payload
+from django_demo.ingest.simulator import FRIDGE_SENSORS, FleetSimulator, HandlerDispatcher, VirtualFridge, device_topic
+from django_demo.ingest.sources import LocalBroker, LocalBrokerSource, parse_topic, topic_matches
+
+
+@pytest.mark.parametrize("topic_filter, topic, expected", (
+    ("iot-2/type/+/id/+/evt/periodic/fmt/json", "iot-2/type/sim-fridge/id/1/evt/periodic/fmt/json", True),
+    ("iot-2/type/+/id/+/evt/periodic/fmt/json", "iot-2/type/sim-fridge/id/1/evt/alert/fmt/json", False),
+    ("iot-2/#", "iot-2/type/sim-fridge/id/1/evt/periodic/fmt/json", True),
+    ("iot-2/type/+", "iot-2/type/sim-fridge/id/1", False),
+))
+def test_topic_matches(topic_filter, topic, expected):
+    assert topic_matches(topic_filter, topic) == expected
+
+
+class TestLocalBroker:
+    def test_delivered_in_order(self):
+        received = []
+        broker = LocalBroker()
+        source = LocalBrokerSource(lambda t, p: received.append((t, p)), "iot-2/#", broker)
+        source.start()
+
+        for i in range(10):
+            broker.publish("iot-2/type/x/id/{}/evt/periodic/fmt/json".format(i), b"{}")
+        broker.publish("other/topic", b"{}")
+        broker.stop()
+
+        assert [parse_topic(t)[0] for t, _ in received] == [str(i) for i in range(10)]
+        assert broker.delivered == 11
+
+
+class TestFleetSimulator:
+    def test_payload(self):
+        fridge = VirtualFridge(5, random.Random(1))
+
+        reading = reading_from_payload(5, fridge.payload())
+
+        assert sorted(reading.values) == FRIDGE_SENSORS
+        assert reading.device_id == 5
+
+    def test_publishes_for_every_device(self):
+        published = []
+        simulator = FleetSimulator(lambda t, p: published.append(t), [1, 2, 3], interval=0.05, seed=1)
+
+        simulator.run(0.12)
+
+        # Two or three messages from each device, depending on start offsets
+        for device_id in ("1", "2", "3"):
+            count = sum(parse_topic(t)[0] == device_id for t in published)
+            assert 2 <= count <= 3
+        assert simulator.published == len(published)
+
+
+class TestHandlerDispatcher:
+    def test_decoded_like_the_listener(self):
+        readings = []
+        dispatcher = HandlerDispatcher(
+            {5: SimpleNamespace(pk=5)},
+            handlers={"periodic": lambda message, listener: readings.append(reading_from_message(message))},
+            message_cls=SimpleNamespace,
+        )
+        payload = VirtualFridge(5, random.Random(1)).payload()
+
+        dispatcher(device_topic(5), payload)
+
+        # Including the timestamp it was published with
+        assert readings == [reading_from_payload(5, payload)]
+
+    def test_dropped(self):
+        dispatcher = HandlerDispatcher(
+            {5: SimpleNamespace(pk=5)},
+            handlers={"periodic": pytest.fail},
+            message_cls=SimpleNamespace,
+        )
+
+        dispatcher(device_topic(6), b"{}")
+        dispatcher(device_topic(5), b"not json")
+        dispatcher(device_topic(5, event="alert"), b"{}")
+
+        assert dispatcher.dropped == 3
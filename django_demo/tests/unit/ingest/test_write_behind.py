@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta
+import threading
+from unittest.mock import patch
+
+from django.db import DatabaseError
+import pytest
+
+from zconnect.testutils.factories import DeviceFactory, DeviceSensorFactory, SensorTypeFactory
+from zconnect.zc_timeseries.models import DeviceSensor, TimeSeriesData
+
+from django_demo import presence
+from django_demo.ingest import PartialWriteError, Reading, WriteBehindBuffer, write_readings
+from django_demo.ingest.writer import sensor_cache
+
+
+class TestWriteBehindBuffer:
+    def test_flush_on_size(self):
+        flushed = []
+        buffer = WriteBehindBuffer(flushed.append, max_size=3, max_delay=60)
+
+        threads = [threading.Thread(target=buffer.submit, args=(i,)) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=5)
+
+        assert len(flushed) == 1
+        assert sorted(flushed[0]) == [0, 1, 2]
+
+    def test_flush_on_time(self):
+        flushed = []
+        buffer = WriteBehindBuffer(flushed.append, max_size=100, max_delay=0.01)
+
+        buffer.submit("a")
+        assert flushed == [["a"]]
+
+    def test_error_raised_to_submitter(self):
+        def fail(items):
+            raise ValueError("db down")
+
+        buffer = WriteBehindBuffer(fail, max_size=1)
+
+        with pytest.raises(ValueError):
+            buffer.submit("a")
+        assert buffer.failed_batches == 1
+
+
+@pytest.mark.django_db
+class TestWriteReadings:
+    def setup_method(self):
+        sensor_cache.clear()
+
+    def test_bulk_write(self):
+        devices = [DeviceFactory(online=False) for _ in range(3)]
+        for device in devices:
+            for name in ("process_box_temp", "property_door_opened"):
+                sensor_type = SensorTypeFactory(sensor_name=name, product=device.product)
+                DeviceSensorFactory(device=device, sensor_type=sensor_type, resolution=900)
+
+        now = datetime.utcnow()
+        readings = [
+            Reading(device.id, now - timedelta(seconds=i), {"process_box_temp": 4.0 + i, "property_door_opened": 0.0})
+            for device in devices
+            for i in range(2)
+        ]
+
+        write_readings(readings)
+
+        assert TimeSeriesData.objects.count() == 12
+
+        # last_seen/online are written to the database periodically
+        presence.flush()
+        for device in devices:
+            device.refresh_from_db()
+            assert device.online
+            assert device.last_seen == now
+
+    def test_unknown_sensor_ignored(self):
+        device = DeviceFactory()
+        write_readings([Reading(device.id, datetime.utcnow(), {"blorp": 1.0})])
+        assert TimeSeriesData.objects.count() == 0
+
+    def test_missing_device_sensor_created(self):
+        device = DeviceFactory()
+        SensorTypeFactory(sensor_name="process_box_temp", product=device.product)
+
+        write_readings([Reading(device.id, datetime.utcnow(), {"process_box_temp": 3.0})])
+
+        sensor = DeviceSensor.objects.get(device=device)
+        assert sensor.sensor_type.sensor_name == "process_box_temp"
+        assert TimeSeriesData.objects.filter(sensor=sensor).count() == 1
+
+    def test_cache_invalidated_when_sensor_deleted(self):
+        device = DeviceFactory()
+        SensorTypeFactory(sensor_name="process_box_temp", product=device.product)
+
+        write_readings([Reading(device.id, datetime.utcnow(), {"process_box_temp": 3.0})])
+        # Recreated by the next write
+        DeviceSensor.objects.get(device=device).delete()
+        write_readings([Reading(device.id, datetime.utcnow(), {"process_box_temp": 4.0})])
+
+        assert TimeSeriesData.objects.get(sensor__device=device).value == 4.0
+
+    def test_failing_device_retried_separately(self):
+        devices = [DeviceFactory() for _ in range(2)]
+        sensors = [
+            DeviceSensorFactory(
+                device=device,
+                sensor_type=SensorTypeFactory(sensor_name="process_box_temp", product=device.product),
+                resolution=900,
+            )
+            for device in devices
+        ]
+
+        bulk_create = TimeSeriesData.objects.bulk_create
+
+        def fail_first_device(rows, **kwargs):
+            if any(row.sensor_id == sensors[0].id for row in rows):
+                raise DatabaseError("bad row")
+            return bulk_create(rows, **kwargs)
+
+        now = datetime.utcnow()
+        with patch.object(TimeSeriesData.objects, "bulk_create", side_effect=fail_first_device):
+            with pytest.raises(PartialWriteError) as excinfo:
+                write_readings([Reading(device.id, now, {"process_box_temp": 3.0}) for device in devices])
+
+        assert excinfo.value.device_ids == {devices[0].id}
+        assert list(TimeSeriesData.objects.values_list("sensor_id", flat=True)) == [sensors[1].id]
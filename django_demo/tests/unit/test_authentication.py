@@ -0,0 +1,170 @@
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import SlidingToken
+
+from zconnect.testutils.factories import DeviceFactory
+
+from django_demo.authentication import CachedJWTAuthentication, StatelessUser, VerifiedTokenCache, create_token
+
+
+def fake_token(expires_in=60):
+    return Mock(payload={"exp": time.time() + expires_in})
+
+
+class TestVerifiedTokenCache:
+    def test_hit(self):
+        cache = VerifiedTokenCache(10)
+        token = fake_token()
+        cache.set(b"abc", token)
+        assert cache.get(b"abc") is token
+        assert cache.get(b"def") is None
+
+    def test_expired(self):
+        cache = VerifiedTokenCache(10)
+        cache.set(b"abc", fake_token(expires_in=-1))
+        assert cache.get(b"abc") is None
+        assert len(cache) == 0
+
+    def test_evicts_least_recently_used(self):
+        cache = VerifiedTokenCache(2)
+        cache.set(b"a", fake_token())
+        cache.set(b"b", fake_token())
+        cache.get(b"a")
+        cache.set(b"c", fake_token())
+
+        assert cache.get(b"a") is not None
+        assert cache.get(b"b") is None
+        assert cache.get(b"c") is not None
+
+
+class TestCachedJWTAuthentication:
+    def setup_method(self):
+        CachedJWTAuthentication.token_cache.clear()
+
+    def test_only_verified_once(self, fredbloggs):
+        token = str(SlidingToken.for_user(fredbloggs))
+        request = APIRequestFactory().get("/", HTTP_AUTHORIZATION="Bearer {}".format(token))
+
+        with patch.object(JWTAuthentication, "get_validated_token",
+                          wraps=JWTAuthentication().get_validated_token) as verify:
+            for _ in range(3):
+                user, _ = CachedJWTAuthentication().authenticate(request)
+                assert user == fredbloggs
+
+        assert verify.call_count == 1
+
+    def test_stateless_user(self, fredbloggs, settings):
+        settings.DEMO_JWT_AUTH = {"stateless_reads": True}
+
+        token = str(create_token(SlidingToken, fredbloggs, None))
+        request = APIRequestFactory().get("/", HTTP_AUTHORIZATION="Bearer {}".format(token))
+        request.parser_context = {"view": Mock(action="list", stateless_auth_actions=("list",))}
+
+        user, _ = CachedJWTAuthentication().authenticate(request)
+        assert isinstance(user, StatelessUser)
+        assert user.pk == fredbloggs.pk
+        assert not user.is_superuser
+
+    def test_token_without_claims_loads_user(self, fredbloggs, settings):
+        settings.DEMO_JWT_AUTH = {"stateless_reads": True}
+
+        # eg, created before the claims were added
+        token = str(SlidingToken.for_user(fredbloggs))
+        request = APIRequestFactory().get("/", HTTP_AUTHORIZATION="Bearer {}".format(token))
+        request.parser_context = {"view": Mock(action="list", stateless_auth_actions=("list",))}
+
+        user, _ = CachedJWTAuthentication().authenticate(request)
+        assert user == fredbloggs
+
+    def test_unsafe_loads_user(self, fredbloggs, settings):
+        settings.DEMO_JWT_AUTH = {"stateless_reads": True}
+
+        token = str(create_token(SlidingToken, fredbloggs, None))
+        request = APIRequestFactory().post("/", HTTP_AUTHORIZATION="Bearer {}".format(token))
+        request.parser_context = {"view": Mock(action="list", stateless_auth_actions=("list",))}
+
+        user, _ = CachedJWTAuthentication().authenticate(request)
+        assert user == fredbloggs
+
+
+class TestStatelessUser:
+    def user(self, **claims):
+        return StatelessUser(dict({"user_id": 1}, **claims))
+
+    def test_no_permissions(self):
+        user = self.user()
+        assert not user.has_perm("django_demo.change_demodevice")
+        assert not user.has_perms(["django_demo.view_demodevice"])
+        assert not user.has_module_perms("django_demo")
+        # Nothing needed
+        assert user.has_perms([])
+
+    def test_superuser(self):
+        user = self.user(is_superuser=True)
+        assert user.has_perm("django_demo.change_demodevice")
+        assert user.has_perms(["django_demo.view_demodevice", "django_demo.add_demodevice"])
+        assert user.has_module_perms("django_demo")
+
+
+@pytest.mark.notavern
+class TestStatelessReads:
+    """Reads through DemoDeviceViewSet, with its real permission classes"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, settings, fake_org):
+        settings.DEMO_JWT_AUTH = {"stateless_reads": True}
+        CachedJWTAuthentication.token_cache.clear()
+
+        self.devices = [DeviceFactory() for _ in range(3)]
+        for device in self.devices:
+            device.orgs.add(fake_org)
+        self.other_device = DeviceFactory()
+
+        # Fails the test if the user is loaded from the database
+        with patch.object(CachedJWTAuthentication, "get_user", side_effect=AssertionError("user was loaded")):
+            yield
+
+    def client_for(self, user):
+        """Client using a token from the login endpoint"""
+        user.set_password("hunter22")
+        user.save()
+
+        client = APIClient()
+        response = client.post("/api/v3/auth/login/", {"username": user.username, "password": "hunter22"},
+                               format="json")
+        assert response.status_code == 200
+
+        client.credentials(HTTP_AUTHORIZATION="Bearer {}".format(response.data["token"]))
+        return client
+
+    def test_list(self, org_member):
+        response = self.client_for(org_member).get("/api/v3/devices/")
+        assert response.status_code == 200
+        assert sorted(d["id"] for d in response.data["results"]) == sorted(d.id for d in self.devices)
+
+    def test_retrieve(self, org_member):
+        client = self.client_for(org_member)
+
+        response = client.get("/api/v3/devices/{}/".format(self.devices[0].id))
+        assert response.status_code == 200
+        assert response.data["id"] == self.devices[0].id
+
+        response = client.get("/api/v3/devices/{}/".format(self.other_device.id))
+        assert response.status_code == 404
+
+    def test_export(self, org_member):
+        response = self.client_for(org_member).get("/api/v3/devices/export/")
+        assert response.status_code == 200
+
+        content = b"".join(response.streaming_content).decode("utf8")
+        assert len(content.splitlines()) == len(self.devices)
+
+    def test_superuser(self, admin_user):
+        client = self.client_for(admin_user)
+
+        response = client.get("/api/v3/devices/{}/".format(self.other_device.id))
+        assert response.status_code == 200
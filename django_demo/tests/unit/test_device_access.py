@@ -0,0 +1,55 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from guardian.shortcuts import assign_perm
+
+from zconnect.testutils.factories import DeviceFactory
+
+from django_demo import access
+from django_demo.models import DemoDevice
+
+
+class TestDeviceAccess:
+    def test_org_member(self, fredbloggs, fake_org):
+        in_org = DeviceFactory()
+        in_org.orgs.add(fake_org)
+        DeviceFactory()
+
+        fredbloggs.add_org(fake_org)
+
+        visible = access.DeviceAccess(fredbloggs).filter(DemoDevice.objects.all())
+        assert list(visible) == [in_org]
+
+    def test_guardian_grant(self, fredbloggs):
+        granted = DeviceFactory()
+        DeviceFactory()
+        assign_perm("view_demodevice", fredbloggs, granted)
+
+        visible = access.DeviceAccess(fredbloggs).filter(DemoDevice.objects.all())
+        assert list(visible) == [granted]
+
+    def test_single_query(self, fredbloggs, fake_org):
+        fredbloggs.add_org(fake_org)
+        for _ in range(5):
+            DeviceFactory().orgs.add(fake_org)
+
+        device_access = access.DeviceAccess(fredbloggs)
+        with CaptureQueriesContext(connection) as context:
+            assert len(device_access.filter(DemoDevice.objects.all())) == 5
+
+        assert len(context.captured_queries) == 1
+
+    def test_orgs_cached(self, fredbloggs, fake_org):
+        fredbloggs.add_org(fake_org)
+        access.DeviceAccess(fredbloggs)
+
+        with CaptureQueriesContext(connection) as context:
+            assert access.DeviceAccess(fredbloggs).org_ids == {fake_org.id}
+
+        assert not context.captured_queries
+
+    def test_cache_invalidated_on_membership_change(self, fredbloggs, fake_org):
+        assert access.DeviceAccess(fredbloggs).org_ids == set()
+
+        fredbloggs.add_org(fake_org)
+
+        assert access.DeviceAccess(fredbloggs).org_ids == {fake_org.id}
@@ -0,0 +1,81 @@
+from datetime import datetime
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+import pytest
+
+from zconnect.testutils.factories import DeviceFactory, DeviceSensorFactory, SensorTypeFactory
+from zconnect.zc_timeseries.models import TimeSeriesData
+
+from django_demo import device_cache
+from django_demo.handlers import _reading_device_id
+
+
+@pytest.fixture(name="cached_device")
+def fix_cached_device(org_client, fake_org):
+    device = DeviceFactory()
+    device.orgs.add(fake_org)
+
+    response = org_client.get("/api/v3/devices/{}/".format(device.id))
+    assert response.status_code == 200
+
+    return device
+
+
+class TestDeviceCache:
+    def test_populated_on_read(self, cached_device):
+        assert cached_device.id in device_cache.get_many([cached_device.id])
+
+    def test_list_uses_cache(self, cached_device, org_client):
+        cached = device_cache.get_many([cached_device.id])[cached_device.id]
+        cached["name"] = "from the cache"
+        device_cache.set_many({cached_device.id: cached})
+
+        response = org_client.get("/api/v3/devices/")
+        assert response.status_code == 200
+        assert response.data["results"][0]["name"] == "from the cache"
+
+    def test_invalidated_on_save(self, cached_device):
+        cached_device.name = "new name"
+        cached_device.save()
+        assert device_cache.get_many([cached_device.id]) == {}
+
+    def test_invalidated_on_org_change(self, cached_device, fake_org):
+        cached_device.orgs.remove(fake_org)
+        assert device_cache.get_many([cached_device.id]) == {}
+
+    def test_invalidated_on_reading(self, cached_device):
+        sensor_type = SensorTypeFactory(product=cached_device.product)
+        # Adding the sensor also invalidates, so re-populate afterwards
+        device_sensor = DeviceSensorFactory(device=cached_device, sensor_type=sensor_type, resolution=900)
+        device_cache.set_many({cached_device.id: {"id": cached_device.id}})
+
+        TimeSeriesData.objects.create(sensor=device_sensor, ts=datetime.utcnow(), value=1.0)
+        assert device_cache.get_many([cached_device.id]) == {}
+
+    def test_stale_read_not_cached(self, cached_device):
+        # A read misses the cache (eg, it expired) and loads the device...
+        device_cache.invalidate([cached_device.id])
+        versions = {}
+        assert device_cache.get_many([cached_device.id], versions) == {}
+
+        # ...which is changed before the read stores what it loaded
+        cached_device.name = "new name"
+        cached_device.save()
+        device_cache.set_many({cached_device.id: {"id": cached_device.id, "name": "old name"}}, versions)
+
+        assert device_cache.get_many([cached_device.id]) == {}
+
+    def test_reading_device_id(self, cached_device):
+        sensor_type = SensorTypeFactory(product=cached_device.product)
+        device_sensor = DeviceSensorFactory(device=cached_device, sensor_type=sensor_type, resolution=900)
+
+        reading = TimeSeriesData(sensor=device_sensor, ts=datetime.utcnow(), value=1.0)
+        with CaptureQueriesContext(connection) as context:
+            assert _reading_device_id(reading) == cached_device.id
+        assert not context.captured_queries
+
+        reading = TimeSeriesData(sensor_id=device_sensor.id, ts=datetime.utcnow(), value=1.0)
+        with CaptureQueriesContext(connection) as context:
+            assert _reading_device_id(reading) == cached_device.id
+        assert len(context.captured_queries) == 1
@@ -0,0 +1,29 @@
+from rest_framework.test import APIClient
+
+from zconnect.testutils.factories import DeviceFactory
+
+
+class TestBrowserOnlyMiddleware:
+    def test_token_api_request_skips_session(self, fredbloggs, fake_org):
+        from rest_framework_simplejwt.tokens import SlidingToken
+
+        fredbloggs.add_org(fake_org)
+        DeviceFactory().orgs.add(fake_org)
+
+        client = APIClient()
+        token = str(SlidingToken.for_user(fredbloggs))
+        response = client.get("/api/v3/devices/", HTTP_AUTHORIZATION="Bearer {}".format(token))
+
+        assert response.status_code == 200
+        assert not hasattr(response.wsgi_request, "session")
+        assert "X-Frame-Options" not in response
+
+    def test_browser_request_uses_full_stack(self, client):
+        response = client.get("/admin/login/")
+
+        assert hasattr(response.wsgi_request, "session")
+        assert response["X-Frame-Options"] == "DENY"
+
+    def test_session_api_request_uses_full_stack(self, client):
+        response = client.get("/api/v3/devices/")
+        assert hasattr(response.wsgi_request, "session")
@@ -0,0 +1,139 @@
+"""These need PostgreSQL 11+, eg the one set up by
+integration_test_data/init_postgres.sh, and are skipped otherwise. Run them
+with ``tox -e postgres``."""
+from datetime import datetime
+
+from django.db import connection
+from django.test.utils import override_settings
+import pytest
+
+from zconnect.testutils.factories import DeviceFactory, DeviceSensorFactory, SensorTypeFactory
+from zconnect.zc_timeseries.models import TimeSeriesData
+
+from django_demo import partitions
+from django_demo.util.timestamps import from_unix, to_unix
+
+DAY = 24 * 60 * 60
+
+pytestmark = [
+    pytest.mark.django_db,
+    pytest.mark.skipif(connection.vendor != "postgresql", reason="Partitioning needs PostgreSQL"),
+]
+
+
+@pytest.fixture(name="sensor")
+def fix_sensor():
+    device = DeviceFactory()
+    sensor_type = SensorTypeFactory(sensor_name="process_box_temp", product=device.product)
+    return DeviceSensorFactory(device=device, sensor_type=sensor_type, resolution=60)
+
+
+@pytest.fixture(name="now")
+def fix_now():
+    # A Wednesday
+    return to_unix(datetime(2018, 3, 7, 12))
+
+
+@override_settings(DEMO_TS_PARTITIONS={"enabled": True, "interval_days": 7, "premake": 2})
+class TestPartitions:
+    def test_convert_keeps_readings(self, sensor, now):
+        TimeSeriesData.objects.create(sensor=sensor, ts=from_unix(now - 20 * DAY), value=1.0)
+        TimeSeriesData.objects.create(sensor=sensor, ts=from_unix(now), value=2.0)
+
+        partitions.convert_table(now)
+
+        assert partitions.is_partitioned()
+        names = [p[0] for p in partitions.list_partitions()]
+        # Weekly, from the oldest reading to two weeks ahead
+        assert names[0].endswith("_p20180212")
+        assert names[-1].endswith("_p20180319")
+        assert len(names) == 6
+
+        assert sorted(TimeSeriesData.objects.values_list("value", flat=True)) == [1.0, 2.0]
+        # New readings still get ids
+        assert TimeSeriesData.objects.create(sensor=sensor, ts=from_unix(now), value=3.0).pk
+
+    def test_ensure_partitions(self, now):
+        partitions.convert_table(now)
+
+        created = partitions.ensure_partitions(now + 14 * DAY)
+
+        assert [name[-8:] for name in created] == ["20180326", "20180402"]
+
+    def test_query_pruned(self, sensor, now):
+        partitions.convert_table(now)
+
+        queryset = TimeSeriesData.objects.filter(
+            sensor=sensor, ts__gte=from_unix(now), ts__lt=from_unix(now + DAY),
+        )
+        with connection.cursor() as cursor:
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute("EXPLAIN " + sql, params)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+
+        assert "_p20180305" in plan
+        assert "_p20180312" not in plan
+
+    def test_drop_expired(self, sensor, now):
+        TimeSeriesData.objects.create(sensor=sensor, ts=from_unix(now - 20 * DAY), value=1.0)
+        partitions.convert_table(now)
+
+        assert partitions.drop_expired(now, [7 * DAY, 0]) == {}
+
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE {}".format(connection.ops.quote_name(partitions.partition_name(datetime(2018, 2, 12)))))
+
+        dropped = partitions.drop_expired(now, [7 * DAY, 10 * DAY])
+
+        assert [name[-8:] for name in dropped] == ["20180212"]
+        assert list(dropped.values()) == [1]
+        assert not TimeSeriesData.objects.exists()
+        assert datetime(2018, 2, 19) in [p[1] for p in partitions.list_partitions()]
+
+    def test_drop_only_partitions(self, sensor, now):
+        partitions.convert_table(now)
+
+        with pytest.raises(ValueError):
+            partitions.drop_partition("auth_user")
+        with pytest.raises(ValueError):
+            partitions.drop_partition(partitions.default_partition_name())
+
+        # Detached partitions can still be dropped by name
+        name = partitions.partition_name(datetime(2018, 3, 5))
+        partitions.detach_partition(name)
+        partitions.drop_partition(name)
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", [name])
+            assert cursor.fetchone()[0] is None
+            cursor.execute("SELECT to_regclass('auth_user')")
+            assert cursor.fetchone()[0] is not None
+
+    def test_bounds_read_from_catalog(self, now):
+        partitions.convert_table(now)
+
+        # Existing partitions keep their size
+        with override_settings(DEMO_TS_PARTITIONS={"enabled": True, "interval_days": 1, "premake": 0}):
+            assert (datetime(2018, 3, 5), datetime(2018, 3, 12)) in [p[1:] for p in partitions.list_partitions()]
+            # Overlaps the existing weekly partition
+            assert not partitions.create_partition(datetime(2018, 3, 7))
+
+    def test_new_partition_takes_default_rows(self, sensor, now):
+        partitions.convert_table(now)
+
+        ts = from_unix(now + 35 * DAY)
+        TimeSeriesData.objects.create(sensor=sensor, ts=ts, value=1.0)
+
+        created = partitions.ensure_partitions(now + 35 * DAY, premake=0)
+
+        assert [name[-8:] for name in created] == ["20180409"]
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM {}".format(connection.ops.quote_name(partitions.default_partition_name())))
+            assert cursor.fetchone()[0] == 0
+            cursor.execute("SELECT count(*) FROM {}".format(connection.ops.quote_name(created[0])))
+            assert cursor.fetchone()[0] == 1
+
+    def test_interval_start(self):
+        assert partitions.interval_start(datetime(2018, 3, 7, 12), 7) == datetime(2018, 3, 5)
+        assert partitions.interval_start(datetime(2018, 3, 5), 7) == datetime(2018, 3, 5)
+        assert partitions.interval_start(datetime(2018, 3, 4, 23, 59), 7) == datetime(2018, 2, 26)
@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+import time
+from unittest.mock import patch
+
+import pytest
+
+from zconnect.testutils.factories import DeviceFactory
+
+from django_demo import conditional, presence
+
+
+@pytest.mark.django_db
+class TestPresence:
+    def test_heartbeat_not_written_until_flush(self):
+        device = DeviceFactory(online=False)
+        now = datetime.utcnow().replace(microsecond=0)
+
+        presence.record_heartbeats({device.id: now})
+
+        assert presence.get_many([device.id]) == {device.id: (now, True)}
+        device.refresh_from_db()
+        assert not device.online
+
+        assert presence.flush() == 1
+        device.refresh_from_db()
+        assert device.online
+        assert device.last_seen == now
+
+        # Nothing more to flush
+        assert presence.flush() == 0
+
+    def test_sweep_offline(self):
+        stale = DeviceFactory(online=True)
+        fresh = DeviceFactory(online=True)
+        now = time.time()
+        threshold = presence.threshold_seconds()
+
+        presence.record_heartbeats({
+            stale.id: datetime.utcfromtimestamp(now - threshold - 60),
+            fresh.id: datetime.utcfromtimestamp(now),
+        })
+
+        assert presence.sweep_offline(now) == [stale.id]
+
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        assert not stale.online
+        assert fresh.online
+
+        # Only devices which went offline since the last sweep are looked at
+        assert presence.sweep_offline(now + 1) == []
+        assert presence.sweep_offline(now + threshold + 1) == [fresh.id]
+
+    def test_api_reads_redis(self, org_client, fake_org):
+        device = DeviceFactory(online=False)
+        device.orgs.add(fake_org)
+
+        first = org_client.get("/api/v3/devices/{}/".format(device.id))
+        assert first.json()["online"] is False
+
+        # As write_readings does
+        presence.record_heartbeats({device.id: datetime.utcnow() - timedelta(seconds=5)})
+        conditional.bump_device_states([device.id])
+
+        response = org_client.get("/api/v3/devices/{}/".format(device.id), HTTP_IF_NONE_MATCH=first["ETag"])
+        assert response.status_code == 200
+        assert response.json()["online"] is True
+        assert response.json()["last_seen"] is not None
+
+    def test_etag_follows_presence(self, org_client, fake_org):
+        device = DeviceFactory(online=False)
+        device.orgs.add(fake_org)
+        route = "/api/v3/devices/{}/".format(device.id)
+
+        first = org_client.get(route)
+
+        # Nothing else about the device changes
+        presence.record_heartbeats({device.id: datetime.utcnow() - timedelta(seconds=5)})
+
+        online = org_client.get(route, HTTP_IF_NONE_MATCH=first["ETag"])
+        assert online.status_code == 200
+        assert online.json()["online"] is True
+        assert org_client.get(route, HTTP_IF_NONE_MATCH=online["ETag"]).status_code == 304
+
+        # Goes offline by not sending anything
+        later = time.time() + presence.threshold_seconds() + 10
+        with patch("django_demo.presence.time") as fake_time:
+            fake_time.time.return_value = later
+            offline = org_client.get(route, HTTP_IF_NONE_MATCH=online["ETag"])
+
+        assert offline.status_code == 200
+        assert offline.json()["online"] is False
+
+    def test_late_heartbeat_doesnt_move_back(self):
+        device = DeviceFactory(online=False)
+        now = datetime.utcnow().replace(microsecond=0)
+
+        presence.record_heartbeats({device.id: now})
+        presence.record_heartbeats({device.id: now - timedelta(minutes=5)})
+
+        assert presence.get_many([device.id]) == {device.id: (now, True)}
+
+        presence.flush()
+        device.refresh_from_db()
+        assert device.last_seen == now
+
+    def test_redis_down(self, redis_down):
+        device = DeviceFactory(online=False)
+        now = datetime.utcnow().replace(microsecond=0)
+
+        # Written straight to the database instead
+        presence.record_heartbeats({device.id: now})
+        device.refresh_from_db()
+        assert device.online
+        assert device.last_seen == now
+
+        assert presence.get_many([device.id]) == {}
+
+    def test_api_redis_down(self, redis_down, org_client, fake_org):
+        device = DeviceFactory(online=False)
+        device.orgs.add(fake_org)
+        presence.record_heartbeats({device.id: datetime.utcnow()})
+
+        # last_seen/online and sensors_current come from the database
+        response = org_client.get("/api/v3/devices/{}/".format(device.id))
+        assert response.status_code == 200
+        assert response.json()["online"] is True
@@ -0,0 +1,104 @@
+from datetime import timedelta
+import time
+from unittest.mock import patch
+
+import pytest
+
+from zconnect.testutils.factories import (
+    DeviceFactory, DeviceSensorFactory, ProductFactory, SensorTypeFactory,
+)
+from zconnect.zc_timeseries.models import TimeSeriesData
+
+from django_demo import retention
+from django_demo.util.timestamps import from_unix
+
+DAY = 24 * 60 * 60
+
+
+def make_sensor(retention_seconds):
+    product = ProductFactory(periodic_data_retention_short=retention_seconds)
+    device = DeviceFactory(product=product)
+
+    sensor_type = SensorTypeFactory(sensor_name="process_box_temp", product=product)
+    return DeviceSensorFactory(device=device, sensor_type=sensor_type, resolution=60)
+
+
+def add_readings(sensor, now, ages):
+    TimeSeriesData.objects.bulk_create([
+        TimeSeriesData(sensor=sensor, ts=from_unix(now) - timedelta(seconds=age), value=1.0)
+        for age in ages
+    ])
+
+
+@pytest.mark.django_db
+class TestRetention:
+    def test_deletes_expired_readings(self):
+        now = time.time()
+        sensor = make_sensor(30 * DAY)
+        add_readings(sensor, now, [DAY, 29 * DAY, 31 * DAY, 40 * DAY, 400 * DAY])
+
+        report = retention.expire_readings(now, batch_size=2, pause=0)
+
+        assert report[sensor.device.product_id]["deleted"] == 3
+        assert report[sensor.device.product_id]["complete"]
+        assert TimeSeriesData.objects.filter(sensor=sensor).count() == 2
+
+    def test_per_product(self):
+        now = time.time()
+        short = make_sensor(DAY)
+        long = make_sensor(30 * DAY)
+        add_readings(short, now, [2 * DAY])
+        add_readings(long, now, [2 * DAY])
+
+        retention.expire_readings(now, pause=0)
+
+        assert not TimeSeriesData.objects.filter(sensor=short).exists()
+        assert TimeSeriesData.objects.filter(sensor=long).exists()
+
+    def test_stops_when_out_of_time(self):
+        now = time.time()
+        sensor = make_sensor(DAY)
+        add_readings(sensor, now, [2 * DAY, 3 * DAY])
+
+        report = retention.expire_readings(now, max_seconds=0)
+
+        assert TimeSeriesData.objects.filter(sensor=sensor).count() == 2
+        assert sensor.device.product_id not in report or not report[sensor.device.product_id]["complete"]
+
+    def test_stopped_run_saves_cursor(self):
+        now = time.time()
+        sensor = make_sensor(DAY)
+        add_readings(sensor, now, [2 * DAY])
+
+        retention.expire_readings(now, max_seconds=0)
+        assert retention.load_cursor() == (sensor.device.product_id, 0)
+
+        retention.expire_readings(now, pause=0)
+        assert retention.load_cursor() == (None, None)
+        assert not TimeSeriesData.objects.filter(sensor=sensor).exists()
+
+    def test_starts_from_cursor(self):
+        now = time.time()
+        first = make_sensor(DAY)
+        second = make_sensor(DAY)
+        second_other = DeviceSensorFactory(
+            device=DeviceFactory(product=second.device.product),
+            sensor_type=second.sensor_type,
+            resolution=60,
+        )
+        for sensor in (first, second, second_other):
+            add_readings(sensor, now, [2 * DAY])
+
+        retention.save_cursor(second.device.product_id, second_other.pk)
+
+        with patch("django_demo.retention.expire_product", wraps=retention.expire_product) as expire_product:
+            retention.expire_readings(now, pause=0)
+
+        calls = [(c[0][0].pk, c[1]["start_sensor"]) for c in expire_product.call_args_list]
+        assert calls == [(second.device.product_id, second_other.pk), (first.device.product_id, None)]
+        assert not TimeSeriesData.objects.exists()
+
+    def test_sensors_rotated(self):
+        assert retention._rotate([1, 2, 5, 8], 3) == [5, 8, 1, 2]
+        assert retention._rotate([1, 2, 5, 8], 9) == [1, 2, 5, 8]
+        assert retention._rotate([1, 2, 5, 8], None) == [1, 2, 5, 8]
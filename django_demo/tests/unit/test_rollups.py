@@ -0,0 +1,208 @@
+from datetime import timedelta
+import threading
+from unittest.mock import patch
+
+from django.db import OperationalError, connection
+from django.test.utils import CaptureQueriesContext
+import pytest
+
+from zconnect.testutils.factories import DeviceFactory, DeviceSensorFactory, SensorTypeFactory
+from zconnect.zc_timeseries.models import TimeSeriesData
+
+from django_demo import aggregation, rollups
+from django_demo.ingest import Reading, write_readings
+from django_demo.ingest.writer import sensor_cache
+from django_demo.models import SensorRollup
+from django_demo.util.timestamps import from_unix
+
+
+def make_sensor():
+    device = DeviceFactory()
+    sensor_type = SensorTypeFactory(sensor_name="process_box_temp", aggregation_type="mean", product=device.product)
+    return DeviceSensorFactory(device=device, sensor_type=sensor_type, resolution=60)
+
+
+def snapshot():
+    return sorted(SensorRollup.objects.values_list(
+        "sensor_id", "resolution", "bucket", "count", "sum", "min", "max", "last", "last_ts",
+    ))
+
+
+@pytest.mark.django_db
+class TestRollups:
+    def setup_method(self):
+        sensor_cache.clear()
+
+    def test_written_by_ingest(self):
+        sensor = make_sensor()
+        start = from_unix(1500000000 // 21600 * 21600)
+
+        for offset in range(0, 1800, 300):
+            write_readings([
+                Reading(sensor.device_id, start + timedelta(seconds=offset), {"process_box_temp": float(offset)}),
+            ])
+
+        short = SensorRollup.objects.filter(sensor=sensor, resolution=900).order_by("bucket")
+        assert [(r.count, r.sum, r.min, r.max, r.last) for r in short] == [
+            (3, 900.0, 0.0, 600.0, 600.0),
+            (3, 3600.0, 900.0, 1500.0, 1500.0),
+        ]
+
+        long = SensorRollup.objects.get(sensor=sensor, resolution=21600)
+        assert (long.bucket, long.count, long.last_ts) == (start, 6, start + timedelta(seconds=1500))
+
+    def test_late_reading_recomputes_its_buckets(self):
+        sensor = make_sensor()
+        start = from_unix(1500000000 // 21600 * 21600)
+
+        write_readings([
+            Reading(sensor.device_id, start + timedelta(seconds=offset), {"process_box_temp": 1.0})
+            for offset in (0, 600, 1200, 3600)
+        ])
+        before = {
+            r.bucket: r.sum for r in SensorRollup.objects.filter(resolution=900)
+        }
+
+        # Earlier than the latest reading in its 15 minute and 6 hour buckets
+        write_readings([Reading(sensor.device_id, start + timedelta(seconds=300), {"process_box_temp": 5.0})])
+
+        after = {r.bucket: r.sum for r in SensorRollup.objects.filter(resolution=900)}
+        assert after[start] == before[start] + 5.0
+        # Other buckets untouched
+        assert {b: s for b, s in after.items() if b != start} == {b: s for b, s in before.items() if b != start}
+
+        updated = snapshot()
+        rollups.rebuild()
+        assert snapshot() == updated
+
+    def test_update_counts_late_buckets(self):
+        sensor = make_sensor()
+        start = from_unix(1500000000 // 21600 * 21600)
+
+        assert rollups.update([(sensor.pk, start + timedelta(seconds=600), 1.0)]) == 0
+        assert rollups.update([(sensor.pk, start + timedelta(seconds=700), 1.0)]) == 0
+        # Late in both the 15 minute and 6 hour bucket
+        assert rollups.update([(sensor.pk, start + timedelta(seconds=10), 1.0)]) == 2
+
+    def test_aggregate_reads_rollups(self):
+        sensor = make_sensor()
+        start = from_unix(1500000000 // 21600 * 21600)
+        end = start + timedelta(hours=6)
+
+        write_readings([
+            Reading(sensor.device_id, start + timedelta(seconds=offset), {"process_box_temp": offset / 7})
+            for offset in range(0, 6 * 60 * 60, 450)
+        ])
+
+        with CaptureQueriesContext(connection) as context:
+            result = aggregation.aggregate([sensor], start, end, 900)
+        assert len(context.captured_queries) == 1
+
+        expected = aggregation.aggregate([sensor], start, end, 900, engine="numpy")
+        assert [b["ts"] for b in result[sensor.pk]] == [b["ts"] for b in expected[sensor.pk]]
+        assert [b["value"] for b in result[sensor.pk]] == pytest.approx([b["value"] for b in expected[sensor.pk]])
+
+    def test_unaligned_window_uses_engine(self):
+        start = from_unix(1500000000 // 21600 * 21600)
+
+        engine = aggregation.RollupEngine()
+        assert engine.can_aggregate(start, start + timedelta(hours=1), 900)
+        assert not engine.can_aggregate(start + timedelta(seconds=60), start + timedelta(hours=1), 900)
+        assert not engine.can_aggregate(start, start + timedelta(hours=1), 600)
+
+    def test_failed_update_repaired(self):
+        sensor = make_sensor()
+        start = from_unix(1500000000 // 21600 * 21600)
+
+        with patch("django_demo.rollups._apply", side_effect=OperationalError("deadlock detected")) as apply:
+            write_readings([
+                Reading(sensor.device_id, start + timedelta(seconds=offset), {"process_box_temp": 1.0})
+                for offset in (0, 600, 1200)
+            ])
+
+        # Retried, then given up on
+        assert apply.call_count == 3
+        assert not SensorRollup.objects.exists()
+
+        assert rollups.repair() == 3
+        repaired = snapshot()
+
+        rollups.rebuild()
+        assert snapshot() == repaired
+        # Nothing left to repair
+        assert rollups.repair() == 0
+
+    def test_aggregate_without_rollups_uses_engine(self):
+        sensor = make_sensor()
+        start = from_unix(1500000000 // 21600 * 21600)
+        end = start + timedelta(hours=6)
+
+        # Stored before rollups were kept - bulk_create doesn't send signals
+        TimeSeriesData.objects.bulk_create([
+            TimeSeriesData(sensor=sensor, ts=start + timedelta(seconds=offset), value=offset / 7)
+            for offset in range(0, 6 * 60 * 60, 450)
+        ])
+
+        result = aggregation.aggregate([sensor], start, end, 900)
+        expected = aggregation.aggregate([sensor], start, end, 900, engine="numpy")
+        assert len(result[sensor.pk]) == 24
+        assert [b["value"] for b in result[sensor.pk]] == pytest.approx([b["value"] for b in expected[sensor.pk]])
+
+    def test_rebuild_in_sensor_batches(self):
+        sensors = [make_sensor() for _ in range(3)]
+        start = from_unix(1500000000 // 21600 * 21600)
+
+        write_readings([
+            Reading(sensor.device_id, start + timedelta(seconds=offset), {"process_box_temp": float(offset)})
+            for sensor in sensors
+            for offset in (0, 1000, 30000)
+        ])
+        written = snapshot()
+
+        with patch("django_demo.rollups.REBUILD_SENSOR_BATCH_SIZE", 2):
+            assert rollups.rebuild() == len(written)
+        assert snapshot() == written
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.skipif(connection.vendor != "postgresql", reason="Needs concurrent transactions")
+class TestConcurrentRollups:
+    def setup_method(self):
+        sensor_cache.clear()
+
+    def test_interleaved_writers(self):
+        sensor = make_sensor()
+        start = from_unix(1500000000 // 21600 * 21600)
+
+        write_readings([Reading(sensor.device_id, start + timedelta(seconds=300), {"process_box_temp": 1.0})])
+
+        def write_late():
+            try:
+                write_readings([Reading(sensor.device_id, start + timedelta(seconds=60), {"process_box_temp": 2.0})])
+            finally:
+                connection.close()
+
+        apply = rollups._apply
+        interleaved = []
+
+        def apply_after_late_writer(combined):
+            # The first writer has inserted its readings. Before it updates
+            # the rollups, another writer stores a late reading in the same
+            # buckets and recomputes them.
+            if not interleaved:
+                interleaved.append(True)
+                late_writer = threading.Thread(target=write_late)
+                late_writer.start()
+                late_writer.join(10)
+            return apply(combined)
+
+        with patch("django_demo.rollups._apply", side_effect=apply_after_late_writer):
+            write_readings([Reading(sensor.device_id, start + timedelta(seconds=600), {"process_box_temp": 3.0})])
+
+        assert interleaved
+        short = SensorRollup.objects.get(sensor=sensor, resolution=900)
+        assert (short.count, short.sum, short.last) == (3, 6.0, 3.0)
+
+        written = snapshot()
+        rollups.rebuild()
+        assert snapshot() == written
@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+import pytest
+
+from zconnect.testutils.factories import DeviceFactory, DeviceSensorFactory, SensorTypeFactory
+from zconnect.zc_timeseries.models import TimeSeriesData
+
+from django_demo import sensor_store
+from django_demo.ingest import Reading, write_readings
+from django_demo.ingest.writer import sensor_cache
+
+
+def make_device(names=("process_box_temp", "property_door_opened")):
+    device = DeviceFactory()
+    for name in names:
+        sensor_type = SensorTypeFactory(sensor_name=name, product=device.product)
+        DeviceSensorFactory(device=device, sensor_type=sensor_type, resolution=900)
+    return device
+
+
+@pytest.mark.django_db
+class TestSensorStore:
+    def setup_method(self):
+        sensor_cache.clear()
+
+    def test_written_by_ingest(self):
+        device = make_device()
+        now = datetime.utcnow().replace(microsecond=0)
+        # Loaded once (with nothing in it) - after that it's kept up to date
+        sensor_store.current_for_devices([device])
+
+        write_readings([
+            Reading(device.id, now - timedelta(seconds=10), {"process_box_temp": 3.0, "property_door_opened": 1.0}),
+            Reading(device.id, now, {"process_box_temp": 5.0}),
+        ])
+
+        with CaptureQueriesContext(connection) as context:
+            current = sensor_store.current_for_devices([device])[device.id]
+
+        assert not context.captured_queries
+        assert current == {
+            "process_box_temp": {"value": 5.0, "ts": now},
+            "property_door_opened": {"value": 1.0, "ts": now - timedelta(seconds=10)},
+        }
+
+        recent = sensor_store.get_recent(device.id, "process_box_temp")
+        assert [r["value"] for r in recent] == [5.0, 3.0]
+
+    def test_late_batch_doesnt_overwrite(self):
+        device = make_device()
+        now = datetime.utcnow().replace(microsecond=0)
+        sensor_store.current_for_devices([device])
+
+        write_readings([Reading(device.id, now, {"process_box_temp": 5.0})])
+        # Older, and arrived late
+        write_readings([
+            Reading(device.id, now - timedelta(seconds=30), {"process_box_temp": 3.0, "property_door_opened": 1.0}),
+        ])
+
+        with CaptureQueriesContext(connection) as context:
+            current = sensor_store.current_for_devices([device])[device.id]
+
+        assert not context.captured_queries
+        assert current["process_box_temp"] == {"value": 5.0, "ts": now}
+        assert current["property_door_opened"] == {"value": 1.0, "ts": now - timedelta(seconds=30)}
+
+    def test_loaded_from_database(self):
+        devices = [make_device() for _ in range(3)]
+        now = datetime.utcnow().replace(microsecond=0)
+        for device in devices:
+            TimeSeriesData.objects.create(sensor=device.sensors.first(), ts=now, value=2.0)
+
+        expected = {device.id: device.get_latest_ts_data() for device in devices}
+
+        # One query for all the devices which aren't in redis yet
+        with CaptureQueriesContext(connection) as context:
+            current = sensor_store.current_for_devices(devices)
+        assert len(context.captured_queries) == 1
+
+        for device in devices:
+            assert current[device.id].keys() == expected[device.id].keys()
+
+        with CaptureQueriesContext(connection) as context:
+            assert sensor_store.current_for_devices(devices) == current
+        assert not context.captured_queries
+
+    def test_no_readings_only_loaded_once(self):
+        device = make_device()
+
+        assert sensor_store.current_for_devices([device]) == {device.id: {}}
+
+        with CaptureQueriesContext(connection) as context:
+            assert sensor_store.current_for_devices([device]) == {device.id: {}}
+        assert not context.captured_queries
+
+    def test_recent_expires_and_invalidated(self, fake_get_redis):
+        device = make_device()
+        write_readings([Reading(device.id, datetime.utcnow(), {"process_box_temp": 3.0})])
+
+        assert 0 < fake_get_redis.ttl(sensor_store.recent_key(device.id)) <= sensor_store.recent_ttl()
+
+        sensor_store.invalidate([device.id])
+        assert sensor_store.get_recent(device.id) == []
+
+    def test_redis_down(self, redis_down):
+        device = make_device()
+        now = datetime.utcnow().replace(microsecond=0)
+        TimeSeriesData.objects.create(sensor=device.sensors.first(), ts=now, value=2.0)
+
+        current = sensor_store.current_for_devices([device])
+        assert current[device.id].keys() == device.get_latest_ts_data().keys()
@@ -2,10 +2,47 @@ from unittest.mock import patch
 
 from mockredis import mock_strict_redis_client
 import pytest
+from redis.exceptions import ConnectionError as RedisConnectionError
+from rest_framework.test import APIClient
 
 
 # Always mock redis
 @pytest.fixture(autouse=True)
 def fake_get_redis():
-    with patch("zconnect.tasks.get_redis", return_value=mock_strict_redis_client()):
+    fake_redis = mock_strict_redis_client()
+    with patch("zconnect.tasks.get_redis", return_value=fake_redis), \
+            patch("django_demo.util.redis_util.get_redis", return_value=fake_redis):
+        yield fake_redis
+
+
+@pytest.fixture(name="redis_down")
+def fix_redis_down(fake_get_redis):
+    """Every redis call from the demo app fails to connect"""
+    with patch("django_demo.util.redis_util.get_redis", side_effect=RedisConnectionError("redis is down")):
         yield
+
+
+@pytest.fixture(name="org_member")
+def fix_org_member(fredbloggs, fake_org):
+    """fredbloggs, as a member of fake_org"""
+    fredbloggs.add_org(fake_org)
+    fredbloggs.save()
+    return fredbloggs
+
+
+@pytest.fixture(name="org_client")
+def fix_org_client(org_member):
+    """API client authenticated as a member of fake_org"""
+    client = APIClient()
+    client.force_authenticate(user=org_member)
+    return client
+
+
+@pytest.fixture(name="org_admin_client")
+def fix_org_admin_client(admin_user, fake_org):
+    """API client authenticated as a superuser in fake_org"""
+    admin_user.add_org(fake_org)
+
+    client = APIClient()
+    client.force_authenticate(user=admin_user)
+    return client
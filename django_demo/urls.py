@@ -10,7 +10,7 @@ from rest_framework_extensions.routers import ExtendedSimpleRouter
 
 from zconnect.views import CeleryMQTTTestViewSet, StackSamplerView
 
-from .views import DemoDeviceViewSet
+from .views import DemoDeviceViewSet, DemoProductViewSet
 
 ##############################
 # For this app
@@ -19,6 +19,9 @@ from .views import DemoDeviceViewSet
 router = ExtendedSimpleRouter()
 
 device_router = router.register(r'devices', DemoDeviceViewSet, base_name="devices")
+# Overrides the list/detail routes from zconnect.urls (nested product routes
+# are still handled there)
+router.register(r'products', DemoProductViewSet, base_name="products")
 
 
 ##############################
@@ -0,0 +1,64 @@
+"""Sparse fieldsets - ``?fields=a,b`` and ``?omit=c,d``"""
+from rest_framework.exceptions import ValidationError
+
+FIELDS_QUERY_PARAM = "fields"
+OMIT_QUERY_PARAM = "omit"
+
+
+def _split(value):
+    return {f.strip() for f in value.split(",") if f.strip()}
+
+
+def requested_fields(request, available):
+    """Work out which fields were requested
+
+    Args:
+        request (Request): DRF request. If None, all fields are returned.
+        available (iterable(str)): all fields which could be returned
+
+    Returns:
+        set(str), None: the requested fields, or None if the request did not
+            ask for a sparse fieldset.
+
+    Raises:
+        ValidationError: if an unknown field was given
+    """
+    if request is None:
+        return None
+
+    params = getattr(request, "query_params", request.GET)
+    fields = params.get(FIELDS_QUERY_PARAM)
+    omit = params.get(OMIT_QUERY_PARAM)
+
+    if fields is None and omit is None:
+        return None
+
+    available = set(available)
+    selected = _split(fields) if fields is not None else set(available)
+    omitted = _split(omit) if omit is not None else set()
+
+    unknown = (selected | omitted) - available
+    if unknown:
+        raise ValidationError({
+            FIELDS_QUERY_PARAM: ["Unknown field(s): {}".format(", ".join(sorted(unknown)))],
+        })
+
+    return selected - omitted
+
+
+class SparseFieldsetMixin:
+    """Serializer mixin which drops any fields not asked for in the request
+
+    The request is taken from the serializer context, as set up by
+    GenericAPIView.get_serializer_context.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        selected = requested_fields(self.context.get("request"), self.fields.keys())
+        if selected is None:
+            return
+
+        for name in set(self.fields.keys()) - selected:
+            self.fields.pop(name)
@@ -0,0 +1,36 @@
+"""Shared redis connection for the demo app
+
+Uses the same ``REDIS["connection"]`` settings as zconnect. The client is
+created lazily and shared by everything in the process (redis-py clients are
+thread safe and keep their own connection pool).
+
+Callers should always go through ``redis_util.get_redis()`` rather than
+importing the function directly, so that it can be patched in tests.
+"""
+import logging
+
+from django.conf import settings
+import redis
+
+logger = logging.getLogger(__name__)
+
+_client = None
+
+
+def get_redis():
+    """Get the shared redis client
+
+    Returns:
+        redis.StrictRedis: client using settings.REDIS["connection"]
+    """
+    global _client # pylint: disable=global-statement
+
+    if _client is None:
+        connection = settings.REDIS["connection"]
+        _client = redis.StrictRedis(
+            host=connection["host"],
+            port=connection.get("port", 6379),
+            password=connection.get("password"),
+        )
+
+    return _client
@@ -0,0 +1,73 @@
+"""Helpers for loading the latest sensor readings for many devices at once
+
+``DeviceSerializer.sensors_current`` calls ``device.get_latest_ts_data()``,
+which does one query for the device sensors and then one more query per
+sensor to find the latest reading. On a list page that adds up to
+``page_size * (1 + num_sensors)`` queries.
+
+The helpers in here instead annotate the latest value and timestamp onto each
+``DeviceSensor`` with a correlated subquery, so that all the sensors for a
+whole page (and their latest readings) are loaded in a single query through
+``prefetch_related``.
+"""
+import logging
+
+from django.db.models import OuterRef, Prefetch, Subquery
+
+from zconnect.zc_timeseries.models import DeviceSensor, TimeSeriesData
+
+logger = logging.getLogger(__name__)
+
+
+def latest_readings_prefetch():
+    """Prefetch object which loads device sensors with their latest reading
+
+    Each ``DeviceSensor`` is annotated with ``latest_value`` and
+    ``latest_ts``, and has its ``sensor_type`` loaded via a join.
+
+    Returns:
+        Prefetch: to be passed to ``prefetch_related`` on a device queryset
+    """
+    latest = TimeSeriesData.objects.filter(
+        sensor=OuterRef("pk"),
+    ).order_by("-ts")
+
+    sensors = DeviceSensor.objects.select_related("sensor_type").annotate(
+        latest_value=Subquery(latest.values("value")[:1]),
+        latest_ts=Subquery(latest.values("ts")[:1]),
+    )
+
+    return Prefetch("sensors", queryset=sensors)
+
+
+def has_prefetched_readings(device):
+    """Whether the device was loaded using :func:`latest_readings_prefetch`"""
+    # pylint: disable=protected-access
+    return "sensors" in getattr(device, "_prefetched_objects_cache", {})
+
+
+def sensors_current_from_prefetch(device):
+    """Build the 'sensors_current' dict from prefetched device sensors
+
+    This returns the same structure as ``device.get_latest_ts_data()``, but
+    without doing any extra queries. Sensors which have never reported are
+    not included.
+
+    Args:
+        device (Device): device loaded with :func:`latest_readings_prefetch`
+
+    Returns:
+        dict: mapping of sensor name to the latest value and timestamp
+    """
+    current = {}
+
+    for sensor in device.sensors.all():
+        if sensor.latest_ts is None:
+            continue
+
+        current[sensor.sensor_type.sensor_name] = {
+            "value": sensor.latest_value,
+            "ts": sensor.latest_ts,
+        }
+
+    return current
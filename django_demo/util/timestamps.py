@@ -0,0 +1,28 @@
+"""Conversion between datetimes and unix times
+
+Redis scores, rollup buckets and partition bounds are all kept as unix times.
+Naive datetimes are taken to be UTC (as they are when USE_TZ is off), and
+datetimes are returned aware only when USE_TZ is on, so these work with
+either setting.
+"""
+import datetime
+
+from django.conf import settings
+from django.utils import timezone
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_unix(ts):
+    """Unix time of a datetime (naive datetimes are UTC)"""
+    if timezone.is_aware(ts):
+        ts = timezone.make_naive(ts, timezone.utc)
+    return (ts - EPOCH).total_seconds()
+
+
+def from_unix(value):
+    """Datetime for a unix time, aware if USE_TZ is set"""
+    ts = EPOCH + datetime.timedelta(seconds=float(value))
+    if settings.USE_TZ:
+        ts = timezone.make_aware(ts, timezone.utc)
+    return ts
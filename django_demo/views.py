@@ -1,8 +1,288 @@
-from zconnect.views import DeviceViewSet
+import time
 
+from django.http import StreamingHttpResponse
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from zconnect.views import DeviceViewSet, ProductViewSet
+
+from . import aggregation, conditional, device_cache, export, presence
+from .access import get_access
+from .conditional import ConditionalGetMixin
+from .models import DemoDevice
+from .pagination import KeysetPaginationMixin
+from .provisioning import bulk_provision
 from .serializers import CreateDemoDeviceSerializer, DemoDeviceSerializer
+from .util.fieldsets import requested_fields
+from .util.timestamps import from_unix
+
+
+class DemoDeviceViewSet(ConditionalGetMixin, KeysetPaginationMixin, DeviceViewSet):
+    """Device viewset for DemoDevices
+
+    For list and retrieve, get_queryset only loads the fields needed to
+    paginate and to work out ETag/Last-Modified (see
+    :mod:`django_demo.conditional`). If the client already has the current
+    version a 304 is returned straight away.
+
+    Otherwise the devices are serialized in serialize_devices, taking as many
+    as possible from the device cache (see :mod:`django_demo.device_cache`).
+    The rest are loaded with everything the serializer needs up front, so that
+    a page of devices costs a fixed number of queries regardless of the page
+    size:
+
+    - the devices themselves
+    - the orgs for all devices on the page
+
+    ``sensors_current`` for the whole page is read from redis with one
+    pipelined call (see :mod:`django_demo.sensor_store`), and only devices
+    which aren't there yet have their latest readings loaded from the
+    database.
+
+    ``last_seen`` and ``online`` are read from redis for the whole page at once
+    (see :mod:`django_demo.presence`). They are also part of the ETag, as they
+    change without the device changing.
 
+    ``product`` is serialized as a primary key, so it is read straight from
+    ``product_id`` and never needs a join.
+
+    Which devices the user can see is resolved once per request and applied
+    as a single filter in get_queryset (see :mod:`django_demo.access`).
+
+    A sparse fieldset (``?fields=`` / ``?omit=``) narrows what is loaded as
+    well as what is returned - orgs and sensors are only loaded if they
+    were asked for, and only the requested columns are selected. These
+    requests skip the device cache, as it only holds full representations.
+
+    Devices can be created/updated in batches by POSTing a list to
+    ``devices/bulk/`` (see :mod:`django_demo.provisioning`).
+
+    The whole (filtered) fleet can be streamed as NDJSON or CSV from
+    ``devices/export/`` (see :mod:`django_demo.export`).
+
+    Listing with ``?pagination=cursor`` pages on (product_id, id), which
+    matches the default ordering and is indexed (see migration 0006).
+    """
 
-class DemoDeviceViewSet(DeviceViewSet):
     normal_serializer = DemoDeviceSerializer
     create_serializer = CreateDemoDeviceSerializer
+
+    keyset_ordering = ("product_id", "id")
+
+    # Reads only need the user's id and superuser status, so the user doesn't
+    # need to be loaded from the database (see django_demo.authentication)
+    stateless_auth_actions = ("list", "retrieve", "export")
+
+    # Actions which serialize devices with serialize_devices
+    prefetch_actions = ("list", "retrieve")
+
+    # Loaded by get_queryset for prefetch_actions
+    lean_fields = ("id", "product_id", "updated_at")
+
+    # Fields which need extra queries or redis lookups to serialize
+    expensive_fields = ("orgs", "sensors_current", "last_seen", "online")
+
+    # Fields read from redis when serializing (see django_demo.presence)
+    presence_fields = ("last_seen", "online")
+
+    def get_fieldset(self):
+        """Fields requested with ``?fields=`` / ``?omit=``, or None for all"""
+        if not hasattr(self, "_fieldset"):
+            self._fieldset = requested_fields(self.request, DemoDeviceSerializer.Meta.fields)
+        return self._fieldset
+
+    def get_prefetch_lookups(self):
+        """Related objects needed to serialize the requested fields"""
+        fieldset = self.get_fieldset()
+
+        # sensors_current is read from the sensor store by the serializer, so
+        # only orgs need prefetching
+        if fieldset is None or "orgs" in fieldset:
+            return ["orgs"]
+
+        return []
+
+    def narrow_columns(self, queryset):
+        """Only select the columns for the requested fields"""
+        fieldset = self.get_fieldset()
+
+        if fieldset is not None:
+            columns = {f.name for f in DemoDevice._meta.concrete_fields} & fieldset
+            queryset = queryset.only("id", *columns)
+
+        return queryset
+
+    def with_prefetch(self, queryset):
+        """Load everything needed by normal_serializer along with the devices"""
+        return self.narrow_columns(queryset).prefetch_related(*self.get_prefetch_lookups())
+
+    def get_queryset(self):
+        # Permissions are resolved once per request and applied as a single
+        # filter - see django_demo.access
+        queryset = get_access(self.request).filter(DemoDevice.objects.all())
+
+        if self.action in self.prefetch_actions:
+            queryset = queryset.only(*self.lean_fields)
+
+        return queryset
+
+    def get_object_states(self, pks):
+        fieldset = self.get_fieldset()
+        if fieldset is not None and not fieldset.intersection(self.expensive_fields):
+            # Nothing requested can change without updated_at changing
+            return {}
+
+        states = conditional.get_device_states(pks)
+        if states is None or (fieldset is not None and not fieldset.intersection(self.presence_fields)):
+            return states
+
+        # These can change without the state version changing
+        return presence.validator_states(states, pks)
+
+    def serialize_devices(self, devices):
+        """Serialize devices, using cached representations where possible
+
+        Args:
+            devices (list(DemoDevice)): devices loaded from get_queryset. These
+                only need to have their id loaded.
+
+        Returns:
+            list(dict): serialized devices, in the same order
+        """
+        ids = [device.pk for device in devices]
+
+        use_cache = device_cache.enabled() and self.get_fieldset() is None
+        # Versions from before anything is loaded, see django_demo.device_cache
+        versions = {}
+        cached = device_cache.get_many(ids, versions) if use_cache else {}
+
+        missing = [i for i in ids if i not in cached]
+        if missing:
+            # These have already been through get_queryset, so don't need to
+            # be filtered again
+            loaded = list(self.with_prefetch(DemoDevice.objects.filter(pk__in=missing)))
+            serializer = self.get_serializer(loaded, many=True)
+            # Paired up by position, as "id" might not be one of the requested
+            # fields
+            fresh = {device.pk: data for device, data in zip(loaded, serializer.data)}
+            if use_cache and versions:
+                device_cache.set_many(fresh, versions)
+            cached.update(fresh)
+
+        # last_seen/online in the database (and so in the cache) lag behind
+        # redis - see django_demo.presence
+        found = [i for i in ids if i in cached]
+        return presence.overlay([cached[i] for i in found], found)
+
+    serialize_many = serialize_devices
+
+    # Devices loaded and serialized at a time when exporting
+    export_batch_size = 500
+
+    @action(detail=False, methods=["get"], url_path="export")
+    def export(self, request):
+        """Stream all devices visible to the user
+
+        Use ``?export_format=csv`` for CSV, otherwise NDJSON is returned.
+        ``?fields=`` and ``?omit=`` can be used to choose the columns.
+        """
+        export_format = request.query_params.get("export_format", "ndjson")
+        if export_format not in export.CONTENT_TYPES:
+            raise ValidationError({
+                "export_format": ["Must be one of {}".format(", ".join(export.CONTENT_TYPES))],
+            })
+
+        queryset = self.filter_queryset(self.get_queryset()).order_by(*self.keyset_ordering)
+        queryset = self.narrow_columns(queryset)
+
+        batches = export.iter_batches(queryset, self.export_batch_size, self.get_prefetch_lookups())
+
+        def serialize(batch):
+            return presence.overlay(self.get_serializer(batch, many=True).data, [d.pk for d in batch])
+
+        if export_format == "csv":
+            fields = list(self.get_serializer().fields)
+            content = export.stream_csv(batches, serialize, fields)
+        else:
+            content = export.stream_ndjson(batches, serialize)
+
+        response = StreamingHttpResponse(content, content_type=export.CONTENT_TYPES[export_format])
+        response["Content-Disposition"] = 'attachment; filename="devices.{}"'.format(export_format)
+        return response
+
+    # Longest window which can be aggregated at once, in seconds
+    aggregated_max_window = 31 * 24 * 60 * 60
+
+    @action(detail=True, methods=["get"], url_path="aggregated")
+    def aggregated(self, request, pk=None):
+        """Readings for the device aggregated into time buckets
+
+        ``?start=`` and ``?end=`` are unix times (end defaults to now and start
+        to a day before end), ``?resolution=`` is the bucket size in seconds
+        and ``?sensor=`` optionally limits it to some sensor names (comma
+        separated). Each sensor is aggregated by its aggregation_type.
+        """
+        params = request.query_params
+        try:
+            end = float(params.get("end", time.time()))
+            start = float(params.get("start", end - 24 * 60 * 60))
+            resolution = int(params.get("resolution", 900))
+        except ValueError:
+            raise ValidationError({"non_field_errors": ["start, end and resolution must be numbers"]})
+
+        if resolution <= 0:
+            raise ValidationError({"resolution": ["Must be positive"]})
+        if not 0 < end - start <= self.aggregated_max_window:
+            raise ValidationError({
+                "non_field_errors": ["end must be after start, and at most {} seconds after it".format(
+                    self.aggregated_max_window)],
+            })
+
+        device = self.get_object()
+        sensors = device.sensors.select_related("sensor_type")
+        if params.get("sensor"):
+            sensors = sensors.filter(sensor_type__sensor_name__in=params["sensor"].split(","))
+        sensors = list(sensors)
+
+        data = aggregation.aggregate(sensors, from_unix(start), from_unix(end), resolution)
+
+        return Response({
+            s.sensor_type.sensor_name: data[s.pk] for s in sensors
+        })
+
+    # Maximum number of devices in one bulk request
+    bulk_max_items = 5000
+
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk(self, request):
+        """Create or update many devices
+
+        Returns one result per device in the request. If no devices could be
+        created or updated this returns a 400, or a 403 if the user wasn't
+        allowed to create or change any of them.
+        """
+        items = request.data
+        if not isinstance(items, list):
+            raise ValidationError({"non_field_errors": ["Expected a list of devices"]})
+        if len(items) > self.bulk_max_items:
+            raise ValidationError({
+                "non_field_errors": ["At most {} devices can be sent at once".format(self.bulk_max_items)],
+            })
+
+        results = bulk_provision(items, request.user, get_access(request), self.get_queryset())
+
+        if items and all(r["status"] == "error" for r in results):
+            if all(r["status_code"] == status.HTTP_403_FORBIDDEN for r in results):
+                return Response(results, status=status.HTTP_403_FORBIDDEN)
+            return Response(results, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(results)
+
+
+class DemoProductViewSet(ConditionalGetMixin, KeysetPaginationMixin, ProductViewSet):
+    """Product viewset which also supports ``?pagination=cursor`` and
+    conditional GETs"""
+
+    keyset_ordering = ("id",)